@@ -0,0 +1,53 @@
+import os
+import hashlib
+from datetime import datetime, timedelta
+from typing import Optional
+
+import models, database
+from utils import LRUCache
+
+AI_CACHE_MEMORY_SIZE = int(os.getenv("AI_CACHE_MEMORY_SIZE", "2048"))
+AI_CACHE_MEMORY_TTL = float(os.getenv("AI_CACHE_MEMORY_TTL", "3600"))
+AI_CACHE_DB_TTL_DAYS = int(os.getenv("AI_CACHE_DB_TTL_DAYS", "0"))
+
+
+_memory = LRUCache(AI_CACHE_MEMORY_SIZE, AI_CACHE_MEMORY_TTL)
+
+
+def make_key(kind: str, content_hash: str, model: str, prompt: str) -> str:
+    raw = "\n".join([kind, model, hashlib.sha256(prompt.encode("utf-8")).hexdigest(), content_hash])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get(key: str) -> Optional[str]:
+    value = _memory.get(key)
+    if value is not None:
+        return value
+
+    db = database.SessionLocal()
+    try:
+        row = db.get(models.AIResult, key)
+        if row is None:
+            return None
+        if AI_CACHE_DB_TTL_DAYS and row.created_at and row.created_at < datetime.now() - timedelta(days=AI_CACHE_DB_TTL_DAYS):
+            return None
+        _memory.set(key, row.content)
+        return row.content
+    except Exception as e:
+        print(f"[AI Cache] 读取缓存失败: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def put(key: str, kind: str, value: str):
+    _memory.set(key, value)
+    db = database.SessionLocal()
+    try:
+        db.merge(models.AIResult(cache_key=key, kind=kind, content=value, created_at=datetime.now()))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"[AI Cache] 写入缓存失败: {e}")
+    finally:
+        db.close()
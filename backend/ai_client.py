@@ -0,0 +1,313 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import contextlib
+from typing import AsyncIterator, Optional
+
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError
+
+import metrics
+
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "60"))
+AI_CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", "5"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+AI_RPM = float(os.getenv("AI_RPM", "500"))
+AI_TPM = float(os.getenv("AI_TPM", "200000"))
+AI_BURST_SECONDS = float(os.getenv("AI_BURST_SECONDS", "10"))
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "4"))
+AI_RETRY_BASE = float(os.getenv("AI_RETRY_BASE", "0.5"))
+AI_RETRY_MAX = float(os.getenv("AI_RETRY_MAX", "20"))
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "5"))
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))
+# 图片按 detail=auto 的最大计费估算，用于 TPM 预扣
+AI_IMAGE_TOKENS = int(os.getenv("AI_IMAGE_TOKENS", "1105"))
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class TokenBucket:
+    """按分钟配额匀速补充的令牌桶；桶容量为 AI_BURST_SECONDS 秒的配额，允许小幅突发。"""
+
+    def __init__(self, per_minute: float, burst_seconds: float = AI_BURST_SECONDS):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1.0):
+        if self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断，冷却期内直接拒绝；冷却结束放行一个探测请求，成功则恢复。"""
+
+    def __init__(self, threshold: int = AI_BREAKER_FAILURES, cooldown: float = AI_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def before(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError("AI 服务暂不可用（熔断中）")
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                raise CircuitOpenError("AI 服务暂不可用（熔断探测中）")
+            self._probing = True
+
+    def accepting(self) -> bool:
+        # 只读判断，不改变状态：冷却中或探测请求未返回时，新请求必然被拒绝
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return not (self.state == "half_open" and self._probing)
+
+    def retry_in(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def release_probe(self):
+        self._probing = False
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def failure(self) -> bool:
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            opened = self.state != "open"
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            return opened
+        return False
+
+
+def _status(error: Exception) -> Optional[int]:
+    return error.status_code if isinstance(error, APIStatusError) else None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class AIClient:
+    """所有模型调用共用的异步客户端。
+
+    AsyncOpenAI 跑在独立的事件循环线程上，并发上限、令牌桶、熔断状态都归这个循环所有；
+    同步调用方（后台任务线程、线程池）用 chat()/embeddings() 阻塞等待，异步接口用 achat() 直接 await。
+    """
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.breaker = CircuitBreaker()
+        self.requests = TokenBucket(AI_RPM)
+        self.tokens = TokenBucket(AI_TPM)
+        self.stats = {"calls": 0, "retries": 0, "timeouts": 0, "rate_limited": 0,
+                      "failures": 0, "rejected": 0, "breaker_trips": 0,
+                      "prompt_tokens": 0, "completion_tokens": 0}
+        self._slots = None
+        self._client = None
+        self._loop = None
+        self._thread = None
+        self._guard = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._guard:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, name="ai-client", daemon=True)
+                self._thread.start()
+                self._loop = loop
+            return self._loop
+
+    def _ensure_client(self):
+        if self._client is None:
+            self._slots = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+            self._client = AsyncOpenAI(
+                api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                timeout=httpx.Timeout(AI_TIMEOUT, connect=AI_CONNECT_TIMEOUT),
+            )
+        return self._client
+
+    @staticmethod
+    def _estimate_tokens(kwargs: dict) -> float:
+        total = kwargs.get("max_tokens") or 0
+        for message in kwargs.get("messages", []):
+            content = message.get("content")
+            parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+            for part in parts:
+                if part.get("type") == "image_url":
+                    total += AI_IMAGE_TOKENS
+                else:
+                    total += len(part.get("text") or "") // 2 + 4
+        for item in kwargs.get("input", []) if isinstance(kwargs.get("input"), list) else []:
+            total += len(item) // 2 + 1
+        return total
+
+    def _record_usage(self, usage):
+        if usage is not None:
+            prompt, completion = usage.prompt_tokens or 0, getattr(usage, "completion_tokens", 0) or 0
+            self.stats["prompt_tokens"] += prompt
+            self.stats["completion_tokens"] += completion
+            metrics.AI_TOKENS.labels("prompt").inc(prompt)
+            metrics.AI_TOKENS.labels("completion").inc(completion)
+
+    async def _call(self, kind: str, kwargs: dict, timeout: Optional[float] = None, hold_slot: bool = True):
+        client = self._ensure_client()
+        create = client.chat.completions.create if kind == "chat" else client.embeddings.create
+        endpoint = f"{kind}_stream" if kwargs.get("stream") else kind
+        if timeout is not None:
+            kwargs = dict(kwargs, timeout=timeout)
+        cost = self._estimate_tokens(kwargs)
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before()
+            except CircuitOpenError:
+                self.stats["rejected"] += 1
+                raise
+            await self.requests.acquire()
+            await self.tokens.acquire(cost)
+
+            started = time.perf_counter()
+            try:
+                async with self._slots if hold_slot else contextlib.nullcontext():
+                    self.stats["calls"] += 1
+                    started = time.perf_counter()
+                    result = await create(**kwargs)
+            except asyncio.CancelledError:
+                metrics.AI_SECONDS.labels(endpoint, "cancelled").observe(time.perf_counter() - started)
+                # 调用方已放弃（如客户端断开），释放探测名额但不计为服务端故障
+                self.breaker.release_probe()
+                raise
+            except (APITimeoutError, APIConnectionError, APIStatusError) as e:
+                status = _status(e)
+                retryable = status is None or status == 429 or status >= 500
+                outcome = "timeout" if isinstance(e, APITimeoutError) else "rate_limited" if status == 429 else "error"
+                metrics.AI_SECONDS.labels(endpoint, outcome).observe(time.perf_counter() - started)
+                if isinstance(e, APITimeoutError):
+                    self.stats["timeouts"] += 1
+                if status == 429:
+                    self.stats["rate_limited"] += 1
+                    self.breaker.release_probe()
+                elif retryable:
+                    self.stats["failures"] += 1
+                    if self.breaker.failure():
+                        self.stats["breaker_trips"] += 1
+                        print(f"[AI] 连续 {self.breaker.failures} 次失败，熔断 {self.breaker.cooldown:.0f}s")
+                else:
+                    self.breaker.release_probe()
+                if not retryable or attempt >= AI_MAX_RETRIES:
+                    raise
+                attempt += 1
+                self.stats["retries"] += 1
+                # 指数退避 + full jitter；429 优先遵循服务端的 Retry-After
+                delay = _retry_after(e) if status == 429 else None
+                if delay is None:
+                    delay = random.uniform(0, min(AI_RETRY_MAX, AI_RETRY_BASE * 2 ** attempt))
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                metrics.AI_SECONDS.labels(endpoint, "error").observe(time.perf_counter() - started)
+                self.breaker.release_probe()
+                raise
+            metrics.AI_SECONDS.labels(endpoint, "ok").observe(time.perf_counter() - started)
+            self.breaker.success()
+            self._record_usage(getattr(result, "usage", None))
+            return result
+
+    async def _stream(self, kwargs: dict, timeout: Optional[float], emit):
+        self._ensure_client()
+        kwargs = dict(kwargs, stream=True, stream_options={"include_usage": True})
+        # 流式响应的整个生成过程都占用并发名额；重试只覆盖建立连接阶段，开始输出后出错直接抛给调用方
+        async with self._slots:
+            stream = await self._call("chat", kwargs, timeout, hold_slot=False)
+            try:
+                async for chunk in stream:
+                    self._record_usage(chunk.usage)
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        emit(delta)
+            finally:
+                await stream.close()
+
+    def submit(self, kind: str, kwargs: dict, timeout: Optional[float] = None):
+        return asyncio.run_coroutine_threadsafe(self._call(kind, kwargs, timeout), self._ensure_loop())
+
+    def chat(self, timeout: Optional[float] = None, **kwargs):
+        return self.submit("chat", kwargs, timeout).result()
+
+    def embeddings(self, timeout: Optional[float] = None, **kwargs):
+        return self.submit("embeddings", kwargs, timeout).result()
+
+    async def achat(self, timeout: Optional[float] = None, **kwargs):
+        return await asyncio.wrap_future(self.submit("chat", kwargs, timeout))
+
+    async def astream(self, timeout: Optional[float] = None, **kwargs) -> AsyncIterator[str]:
+        """逐段产出 chat completion 的文本增量；调用方提前退出（如客户端断开）时取消上游生成。"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        end = object()
+
+        def emit(item):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        future = asyncio.run_coroutine_threadsafe(self._stream(kwargs, timeout, emit), self._ensure_loop())
+        future.add_done_callback(lambda f: emit(end))
+        try:
+            while True:
+                item = await queue.get()
+                if item is end:
+                    break
+                yield item
+            future.result()
+        finally:
+            if not future.done():
+                future.cancel()
+
+    def get_stats(self) -> dict:
+        return dict(self.stats, breaker_state=self.breaker.state)
+
+    def close(self):
+        with self._guard:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.close(), loop).result(timeout=5)
+            self._client = None
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(timeout=5)
+        loop.close()
@@ -1,134 +1,450 @@
 import base64
 import os
 import json
-from openai import OpenAI
+import time
+import asyncio
+import itertools
+import threading
+from contextlib import aclosing
+from concurrent.futures import Future
 from dotenv import load_dotenv
+from openai import APIStatusError
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from starlette.concurrency import run_in_threadpool
+
+import ai_cache, ai_client, utils, metrics
 
 load_dotenv()
 
-client = OpenAI(
+client = ai_client.AIClient(
     api_key=os.getenv("OPENAI_API_KEY"),
     base_url=os.getenv("OPENAI_BASE_URL")
 )
 
+AI_MODEL = "gpt-4o-mini"
+TAG_PROMPT = "你是一个图像标签生成器。请分析图片内容，返回 3-5 个精准的中文标签。请务必以 JSON 格式返回，格式为：{\"tags\": [\"标签1\", \"标签2\"]}"
+TAG_BATCH_PROMPT = "你是一个图像标签生成器。下面会依次给出多张图片，每张图片前标注了它的 id。请分别分析每张图片的内容，为每张返回 3-5 个精准的中文标签。请务必以 JSON 格式返回，格式为：{\"results\": [{\"id\": \"图片id\", \"tags\": [\"标签1\", \"标签2\"]}]}"
+DESCRIBE_PROMPT = "你是一个热情、专业的视觉助手。请仔细观察这张图片，用生动、简洁的中文描述图片的内容。如果图片里有人物，描述他们的动作；如果是风景，描述氛围。字数控制在 100 字以内。"
+
+AI_TAG_TIMEOUT = float(os.getenv("AI_TAG_TIMEOUT", "30"))
+AI_DESCRIBE_TIMEOUT = float(os.getenv("AI_DESCRIBE_TIMEOUT", "30"))
+AI_RERANK_TIMEOUT = float(os.getenv("AI_RERANK_TIMEOUT", "15"))
+AI_TAG_BATCH_SIZE = int(os.getenv("AI_TAG_BATCH_SIZE", "4"))
+AI_TAG_BATCH_BYTES = int(os.getenv("AI_TAG_BATCH_BYTES", str(4 * 1024 * 1024)))
+AI_TAG_BATCH_WAIT = float(os.getenv("AI_TAG_BATCH_WAIT", "0.3"))
+
+_stats_lock = threading.Lock()
+ai_stats = {"image_calls": 0, "bytes_sent": 0, "source_bytes": 0,
+            "describe_streams": 0, "describe_stream_cancelled": 0, "describe_ttfb_ms_total": 0.0}
+
+def get_ai_stats():
+    with _stats_lock:
+        stats = dict(ai_stats)
+        stats.update(tag_batcher.stats)
+    ttfb_total = stats.pop("describe_ttfb_ms_total")
+    stats["describe_ttfb_ms_avg"] = round(ttfb_total / stats["describe_streams"], 1) if stats["describe_streams"] else None
+    stats.update(client.get_stats())
+    return stats
+
+@metrics.collector
+def ai_metrics():
+    stats = get_ai_stats()
+    events = CounterMetricFamily("sims_ai_client_events", "AI 客户端事件计数", labels=["event"])
+    for name in ("calls", "retries", "timeouts", "rate_limited", "failures", "rejected", "breaker_trips",
+                 "tag_batches", "tag_batched_images", "tag_fallbacks", "describe_streams", "describe_stream_cancelled"):
+        events.add_metric([name], stats[name])
+    sent = CounterMetricFamily("sims_ai_image_bytes", "发送给模型的图片字节数", labels=["kind"])
+    sent.add_metric(["encoded"], stats["bytes_sent"])
+    sent.add_metric(["source"], stats["source_bytes"])
+    breaker = GaugeMetricFamily("sims_ai_breaker_state", "熔断器当前状态（取值为 1 的那一项）", labels=["state"])
+    for state in ("closed", "half_open", "open"):
+        breaker.add_metric([state], 1 if stats["breaker_state"] == state else 0)
+    return [events, sent, breaker]
+
 def encode_image(image_path):
     try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        data, mime_type = utils.prepare_ai_image(image_path)
+        source_size = os.path.getsize(image_path)
     except Exception as e:
         print(f"读取图片失败: {e}")
         return None
 
-def generate_image_tags(image_path):
-    base64_image = encode_image(image_path)
-    if not base64_image: return []
+    encoded = base64.b64encode(data).decode('utf-8')
+    with _stats_lock:
+        ai_stats["image_calls"] += 1
+        ai_stats["bytes_sent"] += len(encoded)
+        ai_stats["source_bytes"] += source_size
+    print(f"[AI] 发送图片 {len(encoded)} 字节 ({mime_type}，原图 {source_size} 字节)")
+    return f"data:{mime_type};base64,{encoded}"
+
+def _cache_key(kind, image_path, content_hash, prompt):
+    if not content_hash:
+        try:
+            content_hash = utils.file_sha256(image_path)
+        except OSError:
+            return None
+    return ai_cache.make_key(kind, content_hash, AI_MODEL, prompt)
+
+def _tag_request(image_url):
+    return dict(
+        model=AI_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": TAG_PROMPT
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "请分析这张图"},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": image_url}
+                    },
+                ],
+            }
+        ],
+        response_format={"type": "json_object"},
+        max_tokens=200,
+        timeout=AI_TAG_TIMEOUT,
+    )
 
+def _batch_tag_request(items):
+    content = []
+    for item in items:
+        content.append({"type": "text", "text": f"id={item.key}"})
+        content.append({"type": "image_url", "image_url": {"url": item.image_url}})
+    return dict(
+        model=AI_MODEL,
+        messages=[
+            {"role": "system", "content": TAG_BATCH_PROMPT},
+            {"role": "user", "content": content},
+        ],
+        response_format={"type": "json_object"},
+        max_tokens=120 * len(items),
+        timeout=AI_TAG_TIMEOUT,
+    )
+
+def _parse_batch_tags(response):
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "你是一个图像标签生成器。请分析图片内容，返回 3-5 个精准的中文标签。请务必以 JSON 格式返回，格式为：{\"tags\": [\"标签1\", \"标签2\"]}"
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "请分析这张图"},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                        },
-                    ],
-                }
-            ],
-            response_format={"type": "json_object"},
-            max_tokens=200
-        )
-        
-        result = json.loads(response.choices[0].message.content)
-        tags = result.get("tags", [])
+        results = json.loads(response.choices[0].message.content).get("results", [])
+        return {
+            str(item["id"]): item["tags"] for item in results
+            if isinstance(item, dict) and isinstance(item.get("tags"), list)
+        }
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        print(f"[AI] 批量标签结果解析失败，逐张重试: {e}")
+        return {}
+
+class _TagItem:
+    __slots__ = ("key", "image_url", "future")
+
+    def __init__(self, key, image_url):
+        self.key = str(key)
+        self.image_url = image_url
+        self.future = Future()
+
+class TagBatcher:
+    """把等待打标签的图片按张数 / 字节数攒批，凑满或等待超时后合成一次多图请求；批量结果缺失或解析失败的图片逐张回退。"""
+
+    def __init__(self, max_images=AI_TAG_BATCH_SIZE, max_bytes=AI_TAG_BATCH_BYTES, max_wait=AI_TAG_BATCH_WAIT):
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        # 合批请求的提示词与解析方式都不同于单张请求，缓存键按它和批大小单独计算
+        self.batch_prompt = f"{TAG_BATCH_PROMPT}\nmax_images={max_images}"
+        self.stats = {"tag_batches": 0, "tag_batched_images": 0, "tag_fallbacks": 0}
+        self._cond = threading.Condition()
+        self._pending = []
+        self._bytes = 0
+        self._first_at = 0.0
+        self._thread = None
+
+    def submit(self, key, image_url):
+        item = _TagItem(key, image_url)
+        if self.max_images <= 1:
+            self._send_single(item)
+            return item.future
+
+        ready = []
+        with self._cond:
+            if self._pending and self._bytes + len(image_url) > self.max_bytes:
+                ready.append(self._take())
+            if not self._pending:
+                self._first_at = time.monotonic()
+            self._pending.append(item)
+            self._bytes += len(image_url)
+            if len(self._pending) >= self.max_images or self._bytes >= self.max_bytes:
+                ready.append(self._take())
+            elif self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tag-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        for batch in ready:
+            self._dispatch(batch)
+        return item.future
+
+    def _take(self):
+        batch, self._pending, self._bytes = self._pending, [], 0
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                remaining = self._first_at + self.max_wait - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                batch = self._take()
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        if len(batch) == 1:
+            self._send_single(batch[0])
+            return
+        with _stats_lock:
+            self.stats["tag_batches"] += 1
+            self.stats["tag_batched_images"] += len(batch)
+        print(f"[AI] 批量打标签: {len(batch)} 张")
+        client.submit("chat", _batch_tag_request(batch)).add_done_callback(lambda f: self._resolve(batch, f))
+
+    def _resolve(self, batch, done):
+        try:
+            tags_by_key = _parse_batch_tags(done.result())
+        except APIStatusError as e:
+            # 请求本身被拒（如多图超出请求体上限）时拆成单张；429 / 5xx 已由客户端重试过，交给任务队列退避
+            if e.status_code == 429 or e.status_code >= 500:
+                for item in batch: item.future.set_exception(e)
+                return
+            tags_by_key = {}
+        except Exception as e:
+            for item in batch: item.future.set_exception(e)
+            return
+        for item in batch:
+            tags = tags_by_key.get(item.key)
+            if tags is None:
+                with _stats_lock:
+                    self.stats["tag_fallbacks"] += 1
+                self._send_single(item)
+            else:
+                item.future.set_result((tags, self.batch_prompt))
+
+    def _send_single(self, item):
+        client.submit("chat", _tag_request(item.image_url)).add_done_callback(lambda f: self._resolve_single(item, f))
+
+    @staticmethod
+    def _resolve_single(item, done):
+        try:
+            item.future.set_result((json.loads(done.result().choices[0].message.content).get("tags", []), TAG_PROMPT))
+        except Exception as e:
+            item.future.set_exception(e)
+
+tag_batcher = TagBatcher()
+_tag_keys = itertools.count(1)
+
+def _tag_cache_keys(image_path, content_hash):
+    if not content_hash:
+        try:
+            content_hash = utils.file_sha256(image_path)
+        except OSError:
+            return {}
+    prompts = (TAG_PROMPT, tag_batcher.batch_prompt)
+    return {prompt: ai_cache.make_key("tags", content_hash, AI_MODEL, prompt) for prompt in prompts}
+
+def generate_image_tags(image_path, content_hash=None, image_id=None):
+    # 结果按实际使用的提示词（单张或合批）缓存，查找时任一命中即可
+    cache_keys = _tag_cache_keys(image_path, content_hash)
+    for cache_key in cache_keys.values():
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            print(f"[AI Cache] 命中标签缓存: {image_path}")
+            return json.loads(cached)
+
+    image_url = encode_image(image_path)
+    if not image_url: return []
+
+    try:
+        key = image_id if image_id is not None else f"n{next(_tag_keys)}"
+        with metrics.AI_CALL_SECONDS.labels("tag").time():
+            tags, prompt = tag_batcher.submit(key, image_url).result()
+        if tags and prompt in cache_keys:
+            ai_cache.put(cache_keys[prompt], "tags", json.dumps(tags, ensure_ascii=False))
         return tags
     except Exception as e:
         print(f"AI 识别标签失败: {e}")
-        return []
+        raise
+
+def _describe_request(image_url):
+    return dict(
+        model=AI_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": DESCRIBE_PROMPT
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "这张图里有什么？"},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": image_url}
+                    },
+                ],
+            }
+        ],
+        max_tokens=300,
+        timeout=AI_DESCRIBE_TIMEOUT,
+    )
 
-def get_image_description(image_path):
-    base64_image = encode_image(image_path)
-    if not base64_image: return "无法读取图片文件。"
+def _cached_description(image_path, content_hash):
+    cache_key = _cache_key("describe", image_path, content_hash, DESCRIBE_PROMPT)
+    return cache_key, ai_cache.get(cache_key) if cache_key else None
+
+def get_image_description(image_path, content_hash=None):
+    cache_key, cached = _cached_description(image_path, content_hash)
+    if cached is not None:
+        return cached
+
+    image_url = encode_image(image_path)
+    if not image_url: return "无法读取图片文件。"
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "你是一个热情、专业的视觉助手。请仔细观察这张图片，用生动、简洁的中文描述图片的内容。如果图片里有人物，描述他们的动作；如果是风景，描述氛围。字数控制在 100 字以内。"
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "这张图里有什么？"},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                        },
-                    ],
-                }
-            ],
-            max_tokens=300
-        )
-        return response.choices[0].message.content
+        with metrics.AI_CALL_SECONDS.labels("describe").time():
+            response = client.chat(**_describe_request(image_url))
+        description = response.choices[0].message.content
+        if description and cache_key:
+            ai_cache.put(cache_key, "describe", description)
+        return description
     except Exception as e:
         print(f"AI 描述失败: {e}")
         return "无法描述这张图片。"
 
+async def get_image_description_async(image_path, content_hash=None):
+    # 缓存读写与图片编码都是阻塞 IO，放到线程池；模型调用直接 await，不占用事件循环
+    cache_key, cached = await run_in_threadpool(_cached_description, image_path, content_hash)
+    if cached is not None:
+        return cached
+
+    image_url = await run_in_threadpool(encode_image, image_path)
+    if not image_url: return "无法读取图片文件。"
+
+    try:
+        with metrics.AI_CALL_SECONDS.labels("describe").time():
+            response = await client.achat(**_describe_request(image_url))
+        description = response.choices[0].message.content
+        if description and cache_key:
+            await run_in_threadpool(ai_cache.put, cache_key, "describe", description)
+        return description
+    except ai_client.CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"AI 描述失败: {e}")
+        return "无法描述这张图片。"
+
+async def stream_image_description(image_path, content_hash=None):
+    # 逐段产出描述文本；完整生成后写入缓存，中途断开的半截结果不缓存
+    started = time.monotonic()
+    cache_key, cached = await run_in_threadpool(_cached_description, image_path, content_hash)
+    if cached is not None:
+        yield cached
+        return
+
+    image_url = await run_in_threadpool(encode_image, image_path)
+    if not image_url:
+        yield "无法读取图片文件。"
+        return
+
+    parts = []
+    try:
+        async with aclosing(client.astream(**_describe_request(image_url))) as stream:
+            async for delta in stream:
+                if not parts:
+                    ttfb_ms = (time.monotonic() - started) * 1000
+                    metrics.AI_CALL_SECONDS.labels("describe_stream_ttfb").observe(ttfb_ms / 1000)
+                    with _stats_lock:
+                        ai_stats["describe_streams"] += 1
+                        ai_stats["describe_ttfb_ms_total"] += ttfb_ms
+                    print(f"[AI] 描述首字耗时 {ttfb_ms:.0f}ms")
+                parts.append(delta)
+                yield delta
+    except (GeneratorExit, asyncio.CancelledError):
+        with _stats_lock:
+            ai_stats["describe_stream_cancelled"] += 1
+        print(f"[AI] 客户端已断开，取消描述生成（已生成 {len(parts)} 段）")
+        raise
+
+    metrics.AI_CALL_SECONDS.labels("describe_stream").observe(time.monotonic() - started)
+    description = "".join(parts)
+    if description and cache_key:
+        await run_in_threadpool(ai_cache.put, cache_key, "describe", description)
+
+_RERANK_PROMPT = (
+    "你是一个专业的图片搜索引擎。用户会输入搜索词，我会给你一个图片列表（包含ID、标签、文件名）。\n"
+    "请根据用户的搜索词，判断每张图片的相关性分数（0-100分）。\n"
+    "评分标准：\n"
+    "1. 语义完全匹配（如搜'狗'，标签有'金毛'）得 90-100 分。\n"
+    "2. 概念相关（如搜'二叉树'，标签有'二叉搜索树'或'数据结构'）得 70-89 分。\n"
+    "3. 弱相关得 40-69 分。\n"
+    "4. 不相关得 0-39 分。\n\n"
+    "请筛选出 **60分以上** 的图片。\n"
+    "必须返回标准的 JSON 格式，结构为：{\"results\": [{\"id\": 1, \"score\": 95}, {\"id\": 2, \"score\": 75}]}"
+)
+
+def _rerank_request(user_query, images_data):
+    images_context = json.dumps(images_data, ensure_ascii=False)
+    return dict(
+        model=AI_MODEL, 
+        messages=[
+            {"role": "system", "content": _RERANK_PROMPT},
+            {
+                "role": "user", 
+                "content": f"用户搜索: '{user_query}'\n\n候选图片列表:\n{images_context}"
+            }
+        ],
+        response_format={"type": "json_object"},
+        max_tokens=1000,
+        timeout=AI_RERANK_TIMEOUT,
+    )
+
+def _ranked_ids(user_query, images_data, response):
+    content = response.choices[0].message.content
+    result_json = json.loads(content)
+    results = result_json.get("results", [])
+
+    results.sort(key=lambda x: x["score"], reverse=True)
+
+    ranked_ids = [item["id"] for item in results]
+    
+    print(f"📊 [AI Rerank] 搜索 '{user_query}' | 上下文 {len(images_data)} 张 | 命中 {len(ranked_ids)} 张")
+    return ranked_ids
+
 def rank_images_by_relevance(user_query, images_data):
     if not images_data:
         return []
 
     try:
-        images_context = json.dumps(images_data, ensure_ascii=False)
-
-        system_prompt = (
-            "你是一个专业的图片搜索引擎。用户会输入搜索词，我会给你一个图片列表（包含ID、标签、文件名）。\n"
-            "请根据用户的搜索词，判断每张图片的相关性分数（0-100分）。\n"
-            "评分标准：\n"
-            "1. 语义完全匹配（如搜'狗'，标签有'金毛'）得 90-100 分。\n"
-            "2. 概念相关（如搜'二叉树'，标签有'二叉搜索树'或'数据结构'）得 70-89 分。\n"
-            "3. 弱相关得 40-69 分。\n"
-            "4. 不相关得 0-39 分。\n\n"
-            "请筛选出 **60分以上** 的图片。\n"
-            "必须返回标准的 JSON 格式，结构为：{\"results\": [{\"id\": 1, \"score\": 95}, {\"id\": 2, \"score\": 75}]}"
-        )
-
-        response = client.chat.completions.create(
-            model="gpt-4o-mini", 
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {
-                    "role": "user", 
-                    "content": f"用户搜索: '{user_query}'\n\n候选图片列表:\n{images_context}"
-                }
-            ],
-            response_format={"type": "json_object"},
-            max_tokens=1000 
-        )
-
-        content = response.choices[0].message.content
-        result_json = json.loads(content)
-        results = result_json.get("results", [])
-
-        results.sort(key=lambda x: x["score"], reverse=True)
-
-        ranked_ids = [item["id"] for item in results]
-        
-        print(f"📊 [AI Rerank] 搜索 '{user_query}' | 上下文 {len(images_data)} 张 | 命中 {len(ranked_ids)} 张")
-        return ranked_ids
-
+        with metrics.AI_CALL_SECONDS.labels("rerank").time():
+            response = client.chat(**_rerank_request(user_query, images_data))
+        return _ranked_ids(user_query, images_data, response)
     except Exception as e:
         print(f"排序失败: {e}")
+        return None
+
+async def rank_images_by_relevance_async(user_query, images_data):
+    if not images_data:
         return []
 
+    try:
+        with metrics.AI_CALL_SECONDS.labels("rerank").time():
+            response = await client.achat(**_rerank_request(user_query, images_data))
+        return _ranked_ids(user_query, images_data, response)
+    except Exception as e:
+        # 失败返回 None，与“模型认为都不相关”的空列表区分，调用方退回向量检索的顺序
+        print(f"排序失败: {e}")
+        return None
+
 def analyze_search_intent(user_query):
     return [user_query]
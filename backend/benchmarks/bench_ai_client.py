@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_openai import create_app, serve_in_thread
+
+
+def percentile(values, p):
+    return float(np.percentile(np.array(values), p)) if values else 0.0
+
+
+REQUEST = dict(
+    model="gpt-4o-mini",
+    messages=[{"role": "system", "content": "bench"}, {"role": "user", "content": "这张图里有什么？"}],
+    max_tokens=50,
+)
+
+
+async def scenario(ai_client, port, calls, concurrency, **fault):
+    app = create_app(**fault)
+    server, thread = serve_in_thread(app, port)
+    client = ai_client.AIClient(api_key="bench", base_url=f"http://127.0.0.1:{port}/v1")
+    latencies, outcomes = [], {"ok": 0, "failed": 0, "rejected": 0}
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with gate:
+            start = time.perf_counter()
+            try:
+                await client.achat(**REQUEST)
+                outcomes["ok"] += 1
+            except ai_client.CircuitOpenError:
+                outcomes["rejected"] += 1
+            except Exception:
+                outcomes["failed"] += 1
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(calls)))
+    elapsed = time.perf_counter() - started
+    stats = client.get_stats()
+    client.close()
+    server.should_exit = True
+    thread.join(timeout=5)
+    return {
+        "calls": calls,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(calls / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "outcomes": outcomes,
+        "client": stats,
+        "server_max_in_flight": app.state.stats["max_in_flight"],
+        "server_requests": app.state.stats["requests"],
+    }
+
+
+async def run(args):
+    import ai_client
+
+    result = {"max_concurrency": ai_client.AI_MAX_CONCURRENCY, "rpm": ai_client.AI_RPM, "callers": args.callers}
+    result["healthy"] = await scenario(ai_client, args.port, args.calls, args.callers, latency=args.latency, jitter=args.latency / 4)
+    result["flaky"] = await scenario(ai_client, args.port + 1, args.calls, args.callers, latency=args.latency, jitter=args.latency / 4,
+                                     error_rate=0.15, rate_limit_rate=0.1, retry_after=0.2)
+    result["outage"] = await scenario(ai_client, args.port + 2, args.calls, args.callers, latency=args.latency, jitter=0, error_rate=1.0)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AI 客户端压测：并发上限、重试与熔断在模拟 OpenAI 服务上的表现")
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--callers", type=int, default=64, help="同时发起调用的协程数")
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--rpm", type=int, default=60000, help="客户端令牌桶的每分钟请求数上限")
+    args = parser.parse_args()
+
+    # ai_client 在导入时读取配置，需先写入环境变量
+    os.environ.setdefault("AI_MAX_CONCURRENCY", str(args.max_concurrency))
+    os.environ.setdefault("AI_RPM", str(args.rpm))
+    os.environ.setdefault("AI_TPM", str(args.rpm * 1000))
+    os.environ.setdefault("AI_RETRY_BASE", "0.05")
+    os.environ.setdefault("AI_BREAKER_COOLDOWN", "2")
+    asyncio.run(run(args))
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import io
+import json
+import random
+import time
+
+import httpx
+import numpy as np
+from PIL import Image
+
+from bench_upload import login, percentile
+
+SMART_QUERIES = ["风景", "海边 日落", "城市 夜景", "猫", "beach", "mountain snow"]
+
+
+def small_jpeg(seed):
+    rng = np.random.default_rng(seed)
+    img = Image.fromarray(rng.integers(0, 255, size=(48, 64, 3), dtype=np.uint8))
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=80)
+    return buffer.getvalue()
+
+
+async def ensure_images(client, headers, count):
+    resp = await client.get("/api/v1/images", params={"limit": 500, "fields": "grid"}, headers=headers)
+    resp.raise_for_status()
+    ids = [item["id"] for item in resp.json()]
+    if len(ids) >= count:
+        return ids
+    files = [("files", (f"load_{i}.jpg", small_jpeg(i), "image/jpeg")) for i in range(count - len(ids))]
+    resp = await client.post("/api/v1/upload/batch", files=files, headers=headers)
+    resp.raise_for_status()
+    return ids + [item["image"]["id"] for item in resp.json()["results"] if item["ok"]]
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(base_url=args.url, timeout=60, limits=limits) as client:
+        headers = await login(client, args.username, args.password)
+        ids = await ensure_images(client, headers, args.images)
+        print(f"图库中共 {len(ids)} 张图片，{args.clients} 个并发客户端，持续 {args.duration}s")
+
+        requests_by_kind = {
+            "list": lambda: client.get("/api/v1/images", params={"limit": 50, "fields": "grid"}, headers=headers),
+            "detail": lambda: client.get(f"/api/v1/images/{random.choice(ids)}", headers=headers),
+            "smart": lambda: client.get("/api/v1/search/smart", params={"query": random.choice(SMART_QUERIES)}, headers=headers),
+        }
+        kinds = list(requests_by_kind)
+        weights = [args.list_weight, args.detail_weight, args.smart_weight]
+        latencies = {kind: [] for kind in kinds}
+        errors = {kind: 0 for kind in kinds}
+        deadline = time.perf_counter() + args.duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                kind = random.choices(kinds, weights)[0]
+                start = time.perf_counter()
+                try:
+                    resp = await requests_by_kind[kind]()
+                    ok = resp.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                latencies[kind].append(time.perf_counter() - start)
+                if not ok:
+                    errors[kind] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.clients)))
+        elapsed = time.perf_counter() - started
+
+    total = sum(len(v) for v in latencies.values())
+    result = {
+        "clients": args.clients,
+        "elapsed_s": round(elapsed, 2),
+        "requests": total,
+        "errors": sum(errors.values()),
+        "requests_per_s": round(total / elapsed, 1),
+        "endpoints": {
+            kind: {
+                "requests": len(values),
+                "errors": errors[kind],
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+            }
+            for kind, values in latencies.items()
+        },
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="读接口并发压测：列表 / 详情 / 智能搜索混合负载，统计 requests/sec")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", default="bench_user")
+    parser.add_argument("--password", default="bench_password")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--images", type=int, default=200, help="图库不足该数量时先批量上传小图补齐")
+    parser.add_argument("--list-weight", type=float, default=6)
+    parser.add_argument("--detail-weight", type=float, default=3)
+    parser.add_argument("--smart-weight", type=float, default=1)
+    asyncio.run(run(parser.parse_args()))
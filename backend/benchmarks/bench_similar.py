@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from search_index import VectorIndex
+
+
+def percentile(values, p):
+    return float(np.percentile(np.array(values), p)) if values else 0.0
+
+
+def synthetic_image(rng):
+    base = rng.integers(0, 255, size=(6, 8, 3), dtype=np.uint8)
+    img = Image.fromarray(base).resize((400, 300), Image.Resampling.BICUBIC)
+    noise = rng.integers(-20, 20, size=(300, 400, 3))
+    return Image.fromarray(np.clip(np.asarray(img, dtype=np.int32) + noise, 0, 255).astype(np.uint8))
+
+
+def build(directory, vectors, dtype):
+    index = VectorIndex(directory, vectors.shape[1], "bench", dtype=dtype)
+    index.reset(len(vectors))
+    started = time.perf_counter()
+    for start in range(0, len(vectors), 10000):
+        index.upsert_many(list(range(start + 1, start + 1 + len(vectors[start:start + 10000]))), vectors[start:start + 10000])
+    return index, time.perf_counter() - started
+
+
+def timed(index, queries, top_k):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, top_k)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="以图搜图压测：视觉描述子提取耗时 + int8 / float32 向量表 top-k 查询延迟")
+    parser.add_argument("--images", type=int, default=100_000, help="向量表规模")
+    parser.add_argument("--distinct", type=int, default=2000, help="实际提取描述子的合成图片数，其余向量由其加噪扩充")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    started = time.perf_counter()
+    base = np.stack([utils.visual_features(synthetic_image(rng)) for _ in range(args.distinct)])
+    extract_ms = (time.perf_counter() - started) / args.distinct * 1000
+
+    picks = rng.integers(0, args.distinct, size=args.images)
+    vectors = base[picks] + rng.normal(0, 0.02, size=(args.images, utils.VISUAL_DIM)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = vectors[rng.integers(0, args.images, size=args.queries)]
+
+    result = {"images": args.images, "dim": utils.VISUAL_DIM, "extract_ms_per_image": round(extract_ms, 2)}
+    with tempfile.TemporaryDirectory() as root:
+        exact, _ = build(os.path.join(root, "f32"), vectors, np.float32)
+        quantized, build_s = build(os.path.join(root, "i8"), utils.quantize(vectors), np.int8)
+        result["float32"] = dict(timed(exact, queries, args.top_k), bytes=args.images * utils.VISUAL_DIM * 4)
+        result["int8"] = dict(timed(quantized, queries, args.top_k), bytes=args.images * utils.VISUAL_DIM,
+                              build_s=round(build_s, 2))
+
+        overlap = []
+        for query in queries[:50]:
+            truth = {i for i, _ in exact.search(query, args.top_k)}
+            overlap.append(len(truth & {i for i, _ in quantized.search(query, args.top_k)}) / args.top_k)
+        result["int8_recall_at_k"] = round(float(np.mean(overlap)), 3)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
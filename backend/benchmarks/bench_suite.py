@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from bench_upload import login, percentile
+from fake_nominatim import create_app as create_nominatim
+from fake_openai import create_app as create_openai, serve_in_thread
+from seed import TAG_WORDS, make_photo, random_place, random_time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+FLOWS = ["upload", "list", "search", "smart", "detail", "describe"]
+SMART_QUERIES = ["海边 日落", "城市 夜景", "雪山", "猫", "美食 火锅", "beach sunset", "杭州 风景", "合影"]
+
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=10)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BACKEND_DIR,
+                               capture_output=True, text=True, timeout=30)
+        return out.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "") if out.returncode == 0 else None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def backend_env(args, workdir, db_url):
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": db_url,
+        "DATA_DIR": os.path.join(workdir, "data"),
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.ai_port}/v1",
+        "NOMINATIM_DOMAIN": f"127.0.0.1:{args.geo_port}",
+        "NOMINATIM_SCHEME": "http",
+        "GEOCODE_MIN_INTERVAL": "0",
+        "AI_RPM": str(args.rpm),
+        "AI_TPM": str(args.rpm * 5000),
+        "SMART_SEARCH_RERANK": "1" if args.rerank else "0",
+        "PYTHONUNBUFFERED": "1",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+def start_backend(args, workdir, env):
+    log = open(os.path.join(workdir, "server.log"), "ab")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+         "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"后端启动失败，见 {log.name}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{args.port}/metrics", timeout=2).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+    proc.kill()
+    raise RuntimeError(f"后端 {args.startup_timeout}s 内未就绪，见 {log.name}")
+
+
+def stop_backend(proc):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def summarize(latencies, errors, elapsed):
+    values = [seconds * 1000 for seconds in latencies]
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(float(np.mean(values)), 1) if values else 0.0,
+        "p50_ms": round(percentile(values, 50), 1),
+        "p90_ms": round(percentile(values, 90), 1),
+        "p95_ms": round(percentile(values, 95), 1),
+        "p99_ms": round(percentile(values, 99), 1),
+        "max_ms": round(max(values), 1) if values else 0.0,
+    }
+
+
+async def run_flow(name, make_request, concurrency, duration, warmup):
+    async def drive(seconds, latencies, errors):
+        deadline = time.perf_counter() + seconds
+
+        async def worker(slot):
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    resp = await make_request(slot)
+                    ok = resp.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append(time.perf_counter() - start)
+                if not ok:
+                    errors[0] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(slot) for slot in range(concurrency)))
+        return time.perf_counter() - started
+
+    if warmup > 0:
+        await drive(warmup, [], [0])
+    latencies, errors = [], [0]
+    elapsed = await drive(duration, latencies, errors)
+    result = summarize(latencies, errors[0], elapsed)
+    print(f"[Bench] {name}: {result['requests_per_s']} req/s，p50 {result['p50_ms']}ms，p99 {result['p99_ms']}ms，失败 {result['errors']}")
+    return result
+
+
+async def run_flows(args):
+    rng = np.random.default_rng(args.seed + 1)
+    picker = random.Random(args.seed)
+    # 上传用的照片提前生成，避免客户端编码 JPEG 的开销混进延迟
+    photos = []
+    for _ in range(args.upload_pool if "upload" in args.flows else 0):
+        _, lat, lon = random_place(rng)
+        photos.append(make_photo(rng, args.width, args.height, lat, lon, random_time(rng)))
+    photo_counter = iter(range(10 ** 9))
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=args.timeout, limits=limits) as client:
+        sessions = []
+        for u in range(args.users):
+            headers = await login(client, f"bench_user_{u}", args.password)
+            resp = await client.get("/api/v1/images", params={"limit": 500, "fields": "grid"}, headers=headers)
+            resp.raise_for_status()
+            sessions.append((headers, [item["id"] for item in resp.json()]))
+        if not any(ids for _, ids in sessions):
+            raise RuntimeError("压测账号下没有图片，请先灌数据（去掉 --skip-seed）")
+
+        def session(slot):
+            return sessions[slot % len(sessions)]
+
+        def pick_id(slot):
+            headers, ids = session(slot)
+            return headers, picker.choice(ids)
+
+        def upload(slot):
+            headers, _ = session(slot)
+            n = next(photo_counter)
+            files = {"file": (f"bench_{n}.jpg", photos[n % len(photos)], "image/jpeg")}
+            return client.post("/api/v1/upload", files=files, headers=headers)
+
+        def list_page(slot):
+            return client.get("/api/v1/images", params={"limit": 50, "fields": "grid"}, headers=session(slot)[0])
+
+        def search(slot):
+            params = {"tag": picker.choice(TAG_WORDS[:args.search_words]), "limit": 50, "fields": "grid"}
+            return client.get("/api/v1/images", params=params, headers=session(slot)[0])
+
+        def smart(slot):
+            return client.get("/api/v1/search/smart", params={"query": picker.choice(SMART_QUERIES)}, headers=session(slot)[0])
+
+        def detail(slot):
+            headers, image_id = pick_id(slot)
+            return client.get(f"/api/v1/images/{image_id}", headers=headers)
+
+        def describe(slot):
+            headers, image_id = pick_id(slot)
+            return client.post(f"/api/v1/chat/describe/{image_id}", headers=headers)
+
+        requests = {"upload": upload, "list": list_page, "search": search, "smart": smart, "detail": detail, "describe": describe}
+        results = {}
+        for name in args.flows:
+            results[name] = await run_flow(name, requests[name], args.concurrency, args.duration, args.warmup)
+        return results
+
+
+def main(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="sims-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    db_url = args.db_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    ai = create_openai(latency=args.ai_latency, jitter=args.ai_latency / 4, error_rate=args.ai_error_rate)
+    geo = create_nominatim(latency=args.geo_latency, jitter=args.geo_latency / 4)
+    servers = [serve_in_thread(ai, args.ai_port), serve_in_thread(geo, args.geo_port)]
+    env = backend_env(args, workdir, db_url)
+    proc = None
+    try:
+        seeded = None
+        if not args.skip_seed:
+            cmd = [sys.executable, os.path.join(BENCH_DIR, "seed.py"), "--reset", "--users", str(args.users),
+                   "--images-per-user", str(args.images_per_user), "--tags", str(args.tags),
+                   "--templates", str(args.templates), "--password", args.password, "--seed", str(args.seed)]
+            out = subprocess.run(cmd, cwd=workdir, env=env, capture_output=True, text=True)
+            if out.returncode != 0:
+                raise RuntimeError(f"灌数据失败:\n{out.stdout}{out.stderr}")
+            seeded = json.loads(out.stdout[out.stdout.index("{"):])
+            print(f"[Bench] 灌数据完成: {seeded}")
+
+        proc = start_backend(args, workdir, env)
+        flows = asyncio.run(run_flows(args))
+    finally:
+        if proc is not None:
+            stop_backend(proc)
+        for server, thread in servers:
+            server.should_exit = True
+            thread.join(timeout=5)
+
+    result = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "database": db_url.split("://", 1)[0],
+        "config": {
+            "users": args.users, "images_per_user": args.images_per_user, "tags": args.tags, "seed": args.seed,
+            "concurrency": args.concurrency, "duration_s": args.duration, "ai_latency_s": args.ai_latency,
+            "geo_latency_s": args.geo_latency, "rerank": args.rerank, "env": args.env,
+        },
+        "seed": seeded,
+        "flows": flows,
+        "fake_openai": dict(ai.state.stats),
+        "fake_nominatim": dict(geo.state.stats),
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+    if not args.workdir and not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="可复现的端到端压测：灌入固定种子的数据集，用本地模拟的 OpenAI / Nominatim 启动后端，"
+                    "依次压测上传、列表、搜索、智能搜索、详情与描述接口，输出吞吐与延迟分位数 JSON 便于跨提交对比")
+    parser.add_argument("--db-url", help="默认在工作目录下新建 SQLite；也可指向 MySQL 空库（会被 --reset 清空）")
+    parser.add_argument("--workdir", help="后端工作目录（static/、data/、server.log），默认临时目录并在结束后删除")
+    parser.add_argument("--keep", action="store_true", help="保留临时工作目录")
+    parser.add_argument("--skip-seed", action="store_true", help="复用 --workdir / --db-url 中已有的数据")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--images-per-user", type=int, default=2000)
+    parser.add_argument("--tags", type=int, default=300)
+    parser.add_argument("--templates", type=int, default=24, help="不同图片内容数；描述结果按内容哈希缓存，模板越少描述接口命中缓存越多")
+    parser.add_argument("--password", default="bench_password")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--flows", type=lambda s: [f for f in s.split(",") if f], default=FLOWS,
+                        help=f"逗号分隔，按顺序执行：{','.join(FLOWS)}")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20, help="每个流程的计时时长（秒）")
+    parser.add_argument("--warmup", type=float, default=3, help="每个流程计时前的预热时长（秒）")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--upload-pool", type=int, default=200, help="预先生成的上传照片数，用完后循环（之后的上传会命中内容去重）")
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--search-words", type=int, default=30, help="搜索词取自标签词表的前 N 个")
+    parser.add_argument("--ai-latency", type=float, default=0.4, help="模拟 OpenAI 的平均延迟（秒）")
+    parser.add_argument("--ai-error-rate", type=float, default=0.0)
+    parser.add_argument("--geo-latency", type=float, default=0.3, help="模拟 Nominatim 的平均延迟（秒）")
+    parser.add_argument("--rpm", type=int, default=3000, help="后端 AI_RPM")
+    parser.add_argument("--rerank", action="store_true", help="智能搜索启用模型重排")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="额外传给后端的环境变量，可重复")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--ai-port", type=int, default=8190)
+    parser.add_argument("--geo-port", type=int, default=8191)
+    parser.add_argument("--startup-timeout", type=float, default=120)
+    parser.add_argument("--output", help="结果 JSON 另存到该文件")
+    main(parser.parse_args())
@@ -0,0 +1,99 @@
+import argparse
+import base64
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_openai import create_app, serve_in_thread
+
+
+def synthetic_url(rng):
+    base = rng.integers(0, 255, size=(6, 8, 3), dtype=np.uint8)
+    img = Image.fromarray(base).resize((1024, 768), Image.Resampling.BICUBIC)
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=85)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def run(ai_service, batcher, urls, workers):
+    # 与后台任务 worker 一致：每个线程一次处理一张图，阻塞等待标签结果
+    queue = list(enumerate(urls))
+    lock = threading.Lock()
+    failures = []
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                key, url = queue.pop()
+            try:
+                batcher.submit(key, url).result()
+            except Exception as e:
+                failures.append(str(e))
+
+    before = ai_service.client.get_stats()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.perf_counter() - started
+    after = ai_service.client.get_stats()
+    delta = {k: after[k] - before[k] for k in ("calls", "prompt_tokens", "completion_tokens", "retries")}
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "images_per_min": round(len(urls) / elapsed * 60, 1),
+        "requests": delta["calls"],
+        "prompt_tokens": delta["prompt_tokens"],
+        "completion_tokens": delta["completion_tokens"],
+        "tokens_per_image": round((delta["prompt_tokens"] + delta["completion_tokens"]) / len(urls), 1),
+        "failures": len(failures),
+        "batcher": dict(batcher.stats),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="批量打标签压测：逐张请求 vs 多图合批请求的吞吐与 token 用量（模拟 OpenAI 服务）")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=16, help="并发打标签的 worker 线程数（对应 TAGGING_WORKERS）")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--batch-wait", type=float, default=0.3)
+    parser.add_argument("--latency", type=float, default=0.6, help="模拟服务每次请求的固定延迟（秒）")
+    parser.add_argument("--per-image-latency", type=float, default=0.15, help="请求中每张图片额外增加的延迟（秒）")
+    parser.add_argument("--image-tokens", type=int, default=255)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--rpm", type=int, default=500, help="客户端每分钟请求数上限（AI_RPM）")
+    parser.add_argument("--port", type=int, default=8092)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ["OPENAI_API_KEY"] = "bench"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ.setdefault("AI_RPM", str(args.rpm))
+    os.environ.setdefault("AI_TPM", str(args.rpm * 5000))
+    import ai_service
+
+    app = create_app(latency=args.latency, jitter=args.latency / 5, per_image_latency=args.per_image_latency,
+                     image_tokens=args.image_tokens, malformed_rate=args.malformed_rate)
+    server, thread = serve_in_thread(app, args.port)
+
+    rng = np.random.default_rng(args.seed)
+    urls = [synthetic_url(rng) for _ in range(args.images)]
+    result = {"images": args.images, "workers": args.workers, "rpm": args.rpm}
+    result["single"] = run(ai_service, ai_service.TagBatcher(max_images=1), urls, args.workers)
+    result["batched"] = run(ai_service, ai_service.TagBatcher(max_images=args.batch_size, max_wait=args.batch_wait), urls, args.workers)
+    result["speedup"] = round(result["batched"]["images_per_min"] / result["single"]["images_per_min"], 2)
+    result["token_saving"] = round(1 - result["batched"]["tokens_per_image"] / result["single"]["tokens_per_image"], 3)
+
+    ai_service.client.close()
+    server.should_exit = True
+    thread.join(timeout=5)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
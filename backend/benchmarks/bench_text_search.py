@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CJK_TAGS = ["风景", "日落", "海滩", "北京", "上海", "杭州", "西湖", "雪山", "猫", "狗", "美食", "建筑",
+            "夜景", "人像", "森林", "花", "天空", "城市", "街道", "校园", "运动", "汽车", "桥", "湖泊"]
+CITIES = ["北京市 海淀区", "上海市 浦东新区", "浙江省 杭州市", "广东省 深圳市", "四川省 成都市", "云南省 大理白族自治州"]
+CATEGORIES = ["风景", "人物", "动物", "美食", "建筑", "其他"]
+
+
+def make_vocab(size, rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set(CJK_TAGS)
+    while len(words) < size:
+        if rng.random() < 0.3:
+            words.add(rng.choice(CJK_TAGS) + rng.choice(CJK_TAGS))
+        else:
+            words.add("".join(rng.choice(letters) for _ in range(rng.randint(4, 9))))
+    return sorted(words)
+
+
+def percentile(values, p):
+    return float(np.percentile(np.array(values), p)) if values else 0.0
+
+
+def seed(args):
+    import models, database
+    from sqlalchemy import insert
+
+    models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+    rng = random.Random(args.seed)
+    vocab = make_vocab(args.vocab, rng)
+    base = datetime(2015, 1, 1)
+    started = time.perf_counter()
+    with database.engine.begin() as conn:
+        conn.execute(insert(models.User), [{"id": 1, "username": "bench_user", "email": "bench@sims-bench.org",
+                                            "password_hash": "x", "is_active": True}])
+        conn.execute(insert(models.Tag), [{"id": i + 1, "name": name} for i, name in enumerate(vocab)])
+        for start in range(0, args.images, 5000):
+            rows, links = [], []
+            for image_id in range(start + 1, min(start + 5000, args.images) + 1):
+                rows.append({
+                    "id": image_id, "owner_id": 1, "filename": f"IMG_{image_id:06d}.jpg",
+                    "file_path": f"static/uploads/{image_id}.jpg", "file_size": 1,
+                    "capture_date": base + timedelta(minutes=rng.randint(0, 5_000_000)),
+                    "location": rng.choice(CITIES) if rng.random() < 0.6 else None,
+                    "category": rng.choice(CATEGORIES), "view_count": rng.randint(0, 500),
+                })
+                for tag_id in rng.sample(range(1, len(vocab) + 1), rng.randint(3, 6)):
+                    links.append({"image_id": image_id, "tag_id": tag_id})
+            conn.execute(insert(models.Image), rows)
+            conn.execute(models.image_tags.insert(), links)
+    print(f"写入 {args.images} 张图片、{len(vocab)} 个标签，用时 {time.perf_counter() - started:.1f}s")
+    return vocab
+
+
+def like_query(db, owner_id, term):
+    import models
+
+    return [row.id for row in db.query(models.Image.id).filter(models.Image.owner_id == owner_id).filter(
+        (models.Image.tags.any(models.Tag.name.like(f"%{term}%"))) |
+        (models.Image.filename.like(f"%{term}%")) |
+        (models.Image.location.like(f"%{term}%")) |
+        (models.Image.category.like(f"%{term}%"))
+    ).order_by(models.Image.capture_date.desc())]
+
+
+def index_query(db, owner_id, term):
+    return [image_id for image_id, _ in text_index.search(db, owner_id, term)]
+
+
+def timed(fn, db, terms, repeat):
+    latencies, hits = [], 0
+    for _ in range(repeat):
+        for term in terms:
+            start = time.perf_counter()
+            hits += len(fn(db, 1, term))
+            latencies.append(time.perf_counter() - start)
+    return {
+        "queries": len(latencies),
+        "avg_hits": round(hits / len(latencies), 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "total_s": round(sum(latencies), 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="标签/文本搜索压测：LIKE '%term%' 全表扫描 vs 进程内倒排索引")
+    parser.add_argument("--db", default="sqlite:///bench_text_search.db", help="数据库 URL（默认本地 SQLite 文件）")
+    parser.add_argument("--images", type=int, default=100_000)
+    parser.add_argument("--vocab", type=int, default=3000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reuse", action="store_true", help="复用已有数据，不重新写入")
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = args.db
+    import database, text_index
+
+    rng = random.Random(args.seed + 1)
+    if args.reuse:
+        import models
+        with database.SessionLocal() as db:
+            vocab = [t.name for t in db.query(models.Tag.name)]
+    else:
+        vocab = seed(args)
+    terms = [rng.choice(vocab) for _ in range(args.queries)]
+    terms += [rng.choice(vocab)[:2] for _ in range(args.queries // 5)] + ["北京", "杭州", "IMG_0012"]
+
+    with database.SessionLocal() as db:
+        started = time.perf_counter()
+        text_index.search(db, 1, terms[0])
+        build_s = time.perf_counter() - started
+        result = {
+            "images": args.images,
+            "index_build_s": round(build_s, 2),
+            "like": timed(like_query, db, terms, args.repeat),
+            "inverted_index": timed(index_query, db, terms, args.repeat),
+        }
+    result["speedup_p50"] = round(result["like"]["p50_ms"] / max(result["inverted_index"]["p50_ms"], 1e-3), 1)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import io
+import json
+import time
+
+import httpx
+import numpy as np
+from PIL import Image
+
+
+def make_jpeg(width, height, seed, quality=92):
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, size=(height // 16, width // 16, 3), dtype=np.uint8)
+    img = Image.fromarray(small).resize((width, height), Image.Resampling.BILINEAR)
+    noise = rng.integers(0, 24, size=(height, width, 3), dtype=np.uint8)
+    img = Image.fromarray(np.asarray(img, dtype=np.uint8) + noise)
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return float(np.percentile(np.array(values), p))
+
+
+async def login(client, username, password):
+    await client.post("/api/v1/auth/register", json={
+        "username": username, "email": f"{username}@sims-bench.org", "password": password,
+    })
+    resp = await client.post("/api/v1/auth/login", data={"username": username, "password": password})
+    resp.raise_for_status()
+    return {"Authorization": f"Bearer {resp.json()['access_token']}"}
+
+
+async def run(args):
+    payloads = [make_jpeg(args.width, args.height, seed) for seed in range(args.distinct)]
+    print(f"生成 {len(payloads)} 张 {args.width}x{args.height} JPEG，平均 {sum(map(len, payloads)) / len(payloads) / 1e6:.1f} MB")
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=300) as client:
+        headers = await login(client, args.username, args.password)
+        latencies = []
+        errors = 0
+        queue = asyncio.Queue()
+        for start in range(0, args.count, args.batch):
+            queue.put_nowait(range(start, min(start + args.batch, args.count)))
+
+        async def worker():
+            nonlocal errors
+            while True:
+                try:
+                    batch = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                start = time.perf_counter()
+                if args.batch > 1:
+                    resp = await client.post(
+                        "/api/v1/upload/batch",
+                        files=[("files", (f"bench_{i}.jpg", payloads[i % len(payloads)], "image/jpeg")) for i in batch],
+                        headers=headers,
+                    )
+                    latencies.append(time.perf_counter() - start)
+                    errors += resp.json()["failed"] if resp.status_code == 200 else len(batch)
+                else:
+                    i = batch[0]
+                    resp = await client.post(
+                        "/api/v1/upload",
+                        files={"file": (f"bench_{i}.jpg", payloads[i % len(payloads)], "image/jpeg")},
+                        headers=headers,
+                    )
+                    latencies.append(time.perf_counter() - start)
+                    if resp.status_code != 200:
+                        errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    result = {
+        "uploads": args.count,
+        "concurrency": args.concurrency,
+        "batch": args.batch,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "uploads_per_s": round(args.count / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="上传吞吐压测：并发上传大尺寸 JPEG，统计 uploads/sec 与 p99 延迟")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", default="bench_user")
+    parser.add_argument("--password", default="bench_password")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--batch", type=int, default=1, help="每个请求携带的图片数，>1 时走 /api/v1/upload/batch")
+    parser.add_argument("--distinct", type=int, default=4)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import math
+import random
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+# (省, 市, 纬度, 经度)：合成照片的 GPS 落在这些城市附近，逆地理编码按最近城市返回
+CITIES = [
+    ("浙江省", "杭州市", 30.2741, 120.1551),
+    ("浙江省", "宁波市", 29.8683, 121.5440),
+    ("上海市", "上海市", 31.2304, 121.4737),
+    ("北京市", "北京市", 39.9042, 116.4074),
+    ("广东省", "广州市", 23.1291, 113.2644),
+    ("广东省", "深圳市", 22.5431, 114.0579),
+    ("四川省", "成都市", 30.5728, 104.0668),
+    ("陕西省", "西安市", 34.3416, 108.9398),
+    ("云南省", "昆明市", 25.0389, 102.7183),
+    ("新疆维吾尔自治区", "乌鲁木齐市", 43.8256, 87.6168),
+    ("海南省", "三亚市", 18.2528, 109.5119),
+    ("黑龙江省", "哈尔滨市", 45.8038, 126.5350),
+]
+# 超出最近城市这个距离（度）视为野外，返回 Nominatim 的 "Unable to geocode"
+MAX_DEGREES = 1.0
+
+
+def nearest_city(lat, lon):
+    city = min(CITIES, key=lambda c: (c[2] - lat) ** 2 + (c[3] - lon) ** 2)
+    return city, math.hypot(city[2] - lat, city[3] - lon)
+
+
+def create_app(latency=0.3, jitter=0.1, error_rate=0.0):
+    """本地模拟的 Nominatim 逆地理编码服务（/reverse），供压测时替代 nominatim.openstreetmap.org。"""
+    app = FastAPI(title="Fake Nominatim")
+    app.state.stats = {"requests": 0, "errors": 0, "misses": 0}
+
+    @app.get("/reverse")
+    async def reverse(lat: float, lon: float):
+        stats = app.state.stats
+        stats["requests"] += 1
+        await asyncio.sleep(max(0.0, random.uniform(latency - jitter, latency + jitter)))
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": "模拟的服务错误"}, status_code=503)
+        (state, city, _, _), distance = nearest_city(lat, lon)
+        if distance > MAX_DEGREES:
+            stats["misses"] += 1
+            return {"error": "Unable to geocode"}
+        return {
+            "place_id": abs(hash((round(lat, 3), round(lon, 3)))),
+            "lat": str(lat),
+            "lon": str(lon),
+            "display_name": f"{city}, {state}, 中国",
+            "address": {"city": city, "state": state, "country": "中国", "country_code": "cn"},
+        }
+
+    @app.get("/stats")
+    async def get_stats():
+        return app.state.stats
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模拟 Nominatim 逆地理编码接口（/reverse），可注入延迟与错误")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--latency", type=float, default=0.3, help="每次请求的平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 503 的比例")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, args.jitter, args.error_rate), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+_ID_RE = re.compile(r"^id=(\S+)$")
+DESCRIPTION = "这是一张用于压测的模拟图片描述。画面中央是一片开阔的草地，远处有连绵的山峦和几朵白云，阳光从左侧斜照过来，整体氛围安静而明亮。"
+
+
+def _estimate_prompt_tokens(messages, image_tokens):
+    # 粗略计费：文本约 2 字符 / token，每张图片按固定 token 数计
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            total += image_tokens if part.get("type") == "image_url" else len(part.get("text") or "") // 2 + 4
+    return total
+
+
+def create_app(latency=0.2, jitter=0.1, error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, dim=1024,
+               per_image_latency=0.0, image_tokens=255, malformed_rate=0.0, stream_delay=0.02):
+    """本地模拟的 OpenAI 兼容服务：按配置注入延迟、5xx、429 与格式错误的回复，供压测与离线联调使用。"""
+    app = FastAPI(title="Fake OpenAI")
+    app.state.stats = {"requests": 0, "errors": 0, "rate_limited": 0, "malformed": 0, "in_flight": 0, "max_in_flight": 0,
+                       "images": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                       "streamed_chunks": 0, "stream_cancelled": 0}
+
+    async def simulate(extra=0.0):
+        stats = app.state.stats
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(max(0.0, latency + extra + random.uniform(-jitter, jitter)))
+        finally:
+            stats["in_flight"] -= 1
+        roll = random.random()
+        if roll < rate_limit_rate:
+            stats["rate_limited"] += 1
+            return JSONResponse({"error": {"message": "rate limited", "type": "rate_limit_error"}},
+                                status_code=429, headers={"Retry-After": str(retry_after)})
+        if roll < rate_limit_rate + error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"message": "upstream error", "type": "server_error"}}, status_code=503)
+        return None
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        parts = [p for m in messages if isinstance(m.get("content"), list) for p in m["content"]]
+        images = sum(1 for p in parts if p.get("type") == "image_url")
+        failure = await simulate(per_image_latency * images)
+        if failure is not None:
+            return failure
+
+        system = next((m["content"] for m in messages if m.get("role") == "system"), "")
+        ids = [m.group(1) for p in parts if p.get("type") == "text" for m in [_ID_RE.match(p.get("text") or "")] if m]
+        if body.get("response_format", {}).get("type") != "json_object":
+            content = DESCRIPTION
+        elif ids:
+            content = json.dumps({"results": [{"id": i, "tags": ["测试", "风景", f"图{i}"]} for i in ids]}, ensure_ascii=False)
+        elif "搜索" in system:
+            content = json.dumps({"results": []}, ensure_ascii=False)
+        else:
+            content = json.dumps({"tags": ["测试", "风景", "天空"]}, ensure_ascii=False)
+        if random.random() < malformed_rate:
+            app.state.stats["malformed"] += 1
+            content = content[:len(content) // 2]
+
+        prompt_tokens = _estimate_prompt_tokens(messages, image_tokens)
+        completion_tokens = len(content) // 2 + 1
+        stats = app.state.stats
+        stats["images"] += images
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+        if body.get("stream"):
+            return StreamingResponse(stream_chunks(body, content, prompt_tokens, completion_tokens), media_type="text/event-stream")
+        return {
+            "id": f"chatcmpl-fake-{time.monotonic_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    async def stream_chunks(body, content, prompt_tokens, completion_tokens):
+        # 每 2 个字符一段，模拟逐 token 输出；客户端断开时记录被放弃的生成
+        base = {"id": f"chatcmpl-fake-{time.monotonic_ns()}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": body.get("model", "fake")}
+        try:
+            for i in range(0, len(content), 2):
+                await asyncio.sleep(stream_delay)
+                app.state.stats["streamed_chunks"] += 1
+                chunk = dict(base, choices=[{"index": 0, "delta": {"content": content[i:i + 2]}, "finish_reason": None}])
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield f"data: {json.dumps(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))}\n\n"
+            if (body.get("stream_options") or {}).get("include_usage"):
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                         "total_tokens": prompt_tokens + completion_tokens}
+                yield f"data: {json.dumps(dict(base, choices=[], usage=usage))}\n\n"
+            yield "data: [DONE]\n\n"
+        except (asyncio.CancelledError, GeneratorExit):
+            app.state.stats["stream_cancelled"] += 1
+            raise
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        failure = await simulate()
+        if failure is not None:
+            return failure
+        inputs = body.get("input") or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        size = body.get("dimensions") or dim
+        data = []
+        for i, text in enumerate(inputs):
+            rng = random.Random(text)
+            data.append({"object": "embedding", "index": i, "embedding": [rng.uniform(-1, 1) for _ in range(size)]})
+        return {"object": "list", "data": data, "model": body.get("model", "fake"),
+                "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}}
+
+    @app.get("/stats")
+    async def stats():
+        return app.state.stats
+
+    return app
+
+
+def serve_in_thread(app, port, host="127.0.0.1"):
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模拟 OpenAI 接口（/v1/chat/completions、/v1/embeddings），可注入延迟与错误")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.2, help="每次请求的平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 503 的比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回 429 的比例")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--per-image-latency", type=float, default=0.0, help="请求中每多一张图片增加的延迟（秒）")
+    parser.add_argument("--image-tokens", type=int, default=255, help="每张图片计入的 prompt token 数")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="回复被截断成非法 JSON 的比例")
+    parser.add_argument("--stream-delay", type=float, default=0.02, help="流式输出每段之间的间隔（秒）")
+    args = parser.parse_args()
+
+    app = create_app(args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.retry_after,
+                     per_image_latency=args.per_image_latency, image_tokens=args.image_tokens, malformed_rate=args.malformed_rate,
+                     stream_delay=args.stream_delay)
+    print(f"Fake OpenAI 运行于 http://{args.host}:{args.port}/v1")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
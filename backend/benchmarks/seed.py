@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 模板图在本进程内分析即可，不必拉起进程池
+os.environ.setdefault("IMAGE_PROCESS_WORKERS", "0")
+
+from fake_nominatim import CITIES
+
+TAG_WORDS = [
+    "风景", "山", "海", "海滩", "日落", "日出", "天空", "云", "雪", "森林", "湖", "河流", "草地", "花", "树",
+    "城市", "夜景", "建筑", "街道", "桥", "寺庙", "古镇", "公园", "人物", "自拍", "合影", "儿童", "猫", "狗", "鸟",
+    "美食", "咖啡", "甜点", "火锅", "水果", "汽车", "自行车", "地铁", "飞机", "书", "电脑", "手机", "运动", "篮球",
+    "足球", "音乐会", "婚礼", "生日", "旅行", "室内", "beach", "mountain", "sunset", "city", "night", "food", "cat",
+    "dog", "portrait", "landscape",
+]
+CATEGORIES = ["风景", "人物", "动物", "美食", "建筑", "交通", "其他"]
+GPS_SHARE = 0.7
+DAYS_BACK = 5 * 365
+
+
+def tag_vocabulary(n):
+    words = list(TAG_WORDS[:n])
+    i = 2
+    while len(words) < n:
+        words += [f"{w}{i}" for w in TAG_WORDS[:n - len(words)]]
+        i += 1
+    return words
+
+
+def _dms(value):
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round(((value - degrees) * 60 - minutes) * 60, 4)
+    return degrees, minutes, seconds
+
+
+def make_photo(rng, width=1600, height=1200, lat=None, lon=None, taken=None, quality=88):
+    """合成一张带 EXIF 拍摄时间与 GPS 的 JPEG：低频色块放大后叠加噪声，体积与编解码开销接近手机照片。"""
+    base = rng.integers(0, 255, size=(max(1, height // 64), max(1, width // 64), 3), dtype=np.uint8)
+    img = Image.fromarray(base).resize((width, height), Image.Resampling.BICUBIC)
+    noise = rng.integers(0, 16, size=(height, width, 3), dtype=np.uint8)
+    img = Image.fromarray(np.asarray(img, dtype=np.uint8) + noise)
+
+    exif = Image.Exif()
+    if taken is not None:
+        stamp = taken.strftime("%Y:%m:%d %H:%M:%S")
+        exif[0x0132] = stamp
+        exif.get_ifd(0x8769)[0x9003] = stamp
+    if lat is not None and lon is not None:
+        exif.get_ifd(0x8825).update({
+            1: "N" if lat >= 0 else "S", 2: _dms(lat),
+            3: "E" if lon >= 0 else "W", 4: _dms(lon),
+        })
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=quality, exif=exif)
+    return buffer.getvalue()
+
+
+def random_place(rng):
+    state, city, lat, lon = CITIES[rng.integers(len(CITIES))]
+    return f"{state} {city}" if state != city else city, lat + rng.normal(0, 0.05), lon + rng.normal(0, 0.05)
+
+
+def random_time(rng):
+    return datetime.now().replace(microsecond=0) - timedelta(seconds=int(rng.integers(DAYS_BACK * 86400)))
+
+
+def _templates(rng, count, width, height):
+    import storage, utils
+
+    templates = []
+    for i in range(count):
+        _, lat, lon = random_place(rng)
+        payload = make_photo(rng, width, height, lat, lon, random_time(rng))
+        saved = utils.save_stream(io.BytesIO(payload), f"template_{i}.jpg")
+        info = asyncio.run(utils.analyze_saved(saved, f"template_{i}.jpg"))
+        storage.commit(info)
+        templates.append(info)
+    return templates
+
+
+def seed(users, images_per_user, tags, templates, width, height, password, rng_seed, reset=False, chunk=1000):
+    from sqlalchemy import func, insert, select
+    import database, models, security, storage
+
+    if reset:
+        models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+
+    rng = np.random.default_rng(rng_seed)
+    picker = random.Random(rng_seed)
+    started = time.perf_counter()
+    infos = _templates(rng, templates, width, height)
+    vocabulary = tag_vocabulary(tags)
+    # Zipf 分布：少数热门标签覆盖大部分图片，接近真实图库
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    password_hash = security.get_password_hash(password)
+
+    with database.SessionLocal() as db:
+        existing = set(db.execute(select(models.Tag.name).where(models.Tag.name.in_(vocabulary))).scalars())
+        if len(existing) < len(vocabulary):
+            db.execute(insert(models.Tag), [{"name": name} for name in vocabulary if name not in existing])
+        tag_ids = dict(db.execute(select(models.Tag.name, models.Tag.id).where(models.Tag.name.in_(vocabulary))).all())
+        tag_pool = [tag_ids[name] for name in vocabulary]
+        db.commit()
+
+        refs = [0] * len(infos)
+        for u in range(users):
+            username = f"bench_user_{u}"
+            user = db.execute(select(models.User).where(models.User.username == username)).scalar_one_or_none()
+            if user is None:
+                user = models.User(username=username, email=f"{username}@sims-bench.org", password_hash=password_hash)
+                db.add(user)
+                db.flush()
+
+            for start in range(0, images_per_user, chunk):
+                count = min(chunk, images_per_user - start)
+                last_id = db.execute(select(func.max(models.Image.id))).scalar() or 0
+                picks = rng.integers(len(infos), size=count)
+                rows = []
+                for n, t in enumerate(picks):
+                    info = infos[t]
+                    refs[t] += 1
+                    location, lat, lon = random_place(rng) if rng.random() < GPS_SHARE else (None, None, None)
+                    rows.append(dict(
+                        filename=f"IMG_{start + n:06d}.jpg",
+                        file_path=info["file_path"],
+                        thumbnail_path=info["thumbnail_path"],
+                        file_size=info["file_size"],
+                        width=info["width"],
+                        height=info["height"],
+                        capture_date=random_time(rng),
+                        location=location,
+                        latitude=lat,
+                        longitude=lon,
+                        category=CATEGORIES[rng.integers(len(CATEGORIES))],
+                        view_count=int(rng.zipf(2.0)) - 1,
+                        content_hash=info["content_hash"],
+                        phash=info["phash"],
+                        visual=info["visual"],
+                        owner_id=user.id,
+                        tag_status="done",
+                    ))
+                db.execute(insert(models.Image), rows)
+                ids = db.execute(
+                    select(models.Image.id).where(models.Image.owner_id == user.id, models.Image.id > last_id).order_by(models.Image.id)
+                ).scalars().all()
+
+                links, renditions = [], []
+                for image_id, t in zip(ids, picks):
+                    for tag_id in set(picker.choices(tag_pool, weights, k=picker.randint(2, 6))):
+                        links.append({"image_id": image_id, "tag_id": tag_id})
+                    renditions += [dict(r, image_id=image_id) for r in infos[t]["renditions"]]
+                db.execute(insert(models.image_tags), links)
+                if renditions:
+                    db.execute(insert(models.ImageDerivative), renditions)
+                db.commit()
+            print(f"[Seed] {username}: {images_per_user} 张图片")
+
+        for info, n in zip(infos, refs):
+            if n:
+                storage.acquire(db, info["content_hash"], info["file_path"], info["file_size"], n)
+        db.commit()
+
+    return {
+        "users": users,
+        "images": users * images_per_user,
+        "tags": len(vocabulary),
+        "templates": len(infos),
+        "elapsed_s": round(time.perf_counter() - started, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="向 DATABASE_URL 指向的库（SQLite / MySQL）灌入压测数据：用户 bench_user_N、带 EXIF/GPS 的合成图片与标签。"
+                    "图片文件写入当前目录下的 static/，请在后端的工作目录中运行")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--images-per-user", type=int, default=2000)
+    parser.add_argument("--tags", type=int, default=300, help="标签词表大小，按 Zipf 分布分配给图片")
+    parser.add_argument("--templates", type=int, default=24, help="实际生成的不同图片数，数据行按内容去重共用这些文件")
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--password", default="bench_password")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reset", action="store_true", help="先删除并重建全部表（会清空库中已有数据）")
+    args = parser.parse_args()
+    result = seed(args.users, args.images_per_user, args.tags, args.templates, args.width, args.height,
+                  args.password, args.seed, args.reset)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
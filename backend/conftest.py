@@ -0,0 +1,35 @@
+import os
+import tempfile
+
+import pytest
+
+# 各模块在导入时读取配置：测试一律用临时目录里的 SQLite 库与本地存储，绝不连到真实环境
+_tmp = tempfile.mkdtemp(prefix="sims-test-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_tmp, "test.db")
+os.environ["DATA_DIR"] = os.path.join(_tmp, "data")
+os.environ["STORAGE_BACKEND"] = "local"
+os.environ["TAGGING_WORKERS"] = "0"
+os.environ["IMAGE_PROCESS_WORKERS"] = "0"
+
+# test_key.py 是手动检查模型服务连通性的脚本，导入即发请求，不作为测试收集
+collect_ignore = ["test_key.py"]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # static/ 下的上传、暂存与 blob 目录都是相对路径
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def db():
+    import database, models
+
+    models.Base.metadata.create_all(bind=database.engine)
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        models.Base.metadata.drop_all(bind=database.engine)
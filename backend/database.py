@@ -1,15 +1,58 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from typing import List
 
 import os
+import metrics
 
 DEFAULT_DB_URL = "mysql+pymysql://sims_user:sims_password@db:3306/image_db"
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", DEFAULT_DB_URL)
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_ASYNC_POOL_SIZE = int(os.getenv("DB_ASYNC_POOL_SIZE", "20"))
+DB_ASYNC_MAX_OVERFLOW = int(os.getenv("DB_ASYNC_MAX_OVERFLOW", "30"))
+
+_ASYNC_DRIVERS = {"mysql": "mysql+aiomysql", "sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def _engine_options(url, pool_size, max_overflow):
+    # pre-ping / recycle 主要针对 MySQL 的 wait_timeout 断连；SQLite 文件库也要放大连接池，
+    # 默认的 5 + 10 个连接会被后台任务 worker 占满；内存库用单连接池，不接受这些参数
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return {}
+        return {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": DB_POOL_TIMEOUT}
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
+def async_url(url):
+    url = make_url(url)
+    return url.set(drivername=_ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+_url = make_url(SQLALCHEMY_DATABASE_URL)
+engine = create_engine(_url, **_engine_options(_url, DB_POOL_SIZE, DB_MAX_OVERFLOW))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(async_url(_url), **_engine_options(_url, DB_ASYNC_POOL_SIZE, DB_ASYNC_MAX_OVERFLOW))
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+metrics.instrument_engine(engine, "sync")
+metrics.instrument_engine(async_engine.sync_engine, "async")
+
 Base = declarative_base()
 
 def get_db():
@@ -18,3 +61,51 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def insert_ignore(db: Session, table, rows: List[dict], keys: List[str]):
+    dialect = db.get_bind().dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_duplicate_key_update({keys[0]: stmt.inserted[keys[0]]})
+    elif dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table).values(rows).on_conflict_do_nothing(index_elements=keys)
+    else:
+        for row in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(table.insert().values(row))
+            except IntegrityError:
+                pass
+        return
+    db.execute(stmt)
+
+def ensure_schema(bind, metadata):
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    with bind.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=bind.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type} NULL"))
+                print(f"[DB] 为表 {table.name} 补充字段 {column.name}")
+
+            existing_indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+                    print(f"[DB] 为表 {table.name} 补充索引 {index.name}")
@@ -0,0 +1,177 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import models, image_events
+from utils import PerOwnerRegistry, Singleton
+
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+# 其他 uvicorn worker 的上传、独立 worker 的 phash 补算不会通知本进程：每次查询先比对库里的版本号，TTL 再兜底
+DEDUPE_INDEX_TTL = float(os.getenv("DEDUPE_INDEX_TTL", "300"))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """按汉明距离组织的 BK 树，节点为 [hash, image_ids, {distance: child}]，相同哈希的图片共用一个节点。"""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value: int, image_id: int):
+        if self.root is None:
+            self.root = [value, [image_id], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                if image_id not in node[1]:
+                    node[1].append(image_id)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [image_id], {}]
+                return
+            node = child
+
+    def remove(self, value: int, image_id: int):
+        node = self.root
+        while node is not None:
+            d = hamming(value, node[0])
+            if d == 0:
+                if image_id in node[1]:
+                    node[1].remove(image_id)
+                return
+            node = node[2].get(d)
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, int]]:
+        found, stack = [], [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= max_distance:
+                found.extend((image_id, d) for image_id in node[1])
+            for child_d, child in node[2].items():
+                if d - max_distance <= child_d <= d + max_distance:
+                    stack.append(child)
+        return found
+
+
+class OwnerHashes:
+    def __init__(self):
+        self.tree = BKTree()
+        self.hashes: Dict[int, int] = {}
+
+    def add(self, image_id: int, phash: str):
+        value = int(phash, 16)
+        old = self.hashes.get(image_id)
+        if old == value:
+            return
+        if old is not None:
+            self.tree.remove(old, image_id)
+        self.hashes[image_id] = value
+        self.tree.add(value, image_id)
+
+    def remove(self, image_id: int):
+        old = self.hashes.pop(image_id, None)
+        if old is not None:
+            self.tree.remove(old, image_id)
+
+
+class DuplicateIndex:
+    def __init__(self, ttl: float = DEDUPE_INDEX_TTL):
+        self._owners = PerOwnerRegistry(self._build, ttl, self._version)
+
+    @staticmethod
+    def _version(db: Session, owner_id: int) -> Tuple[int, int]:
+        # 新增、删除、补算 phash 都会改变 (数量, 最大 id)；走 (owner_id, phash) 索引，不回表
+        return tuple(db.execute(
+            select(func.count(models.Image.phash), func.max(models.Image.id))
+            .where(models.Image.owner_id == owner_id, models.Image.phash.isnot(None))
+        ).one())
+
+    def _build(self, db: Session, owner_id: int) -> OwnerHashes:
+        owner = OwnerHashes()
+        rows = db.execute(
+            select(models.Image.id, models.Image.phash)
+            .where(models.Image.owner_id == owner_id, models.Image.phash.isnot(None))
+        )
+        for image_id, phash in rows:
+            owner.add(image_id, phash)
+        print(f"[Dedupe] 构建 owner {owner_id} 的感知哈希索引，共 {len(owner.hashes)} 张")
+        return owner
+
+    def index_image(self, db: Session, image):
+        with self._owners.lock(image.owner_id):
+            owner = self._owners.peek(image.owner_id)
+            if owner is not None and image.phash and owner.hashes.get(image.id) != int(image.phash, 16):
+                owner.add(image.id, image.phash)
+                self._owners.touch(db, image.owner_id)
+
+    def remove_image(self, db: Session, owner_id: int, image_id: int):
+        with self._owners.lock(owner_id):
+            owner = self._owners.peek(owner_id)
+            if owner is not None:
+                owner.remove(image_id)
+                self._owners.touch(db, owner_id)
+
+    def find(self, db: Session, owner_id: int, phash: str, max_distance: int) -> List[Tuple[int, int]]:
+        with self._owners.lock(owner_id):
+            hits = self._owners.get(db, owner_id).tree.search(int(phash, 16), max_distance)
+        return sorted(hits, key=lambda hit: (hit[1], hit[0]))
+
+    def clusters(self, db: Session, owner_id: int, max_distance: int) -> List[List[int]]:
+        with self._owners.lock(owner_id):
+            owner = self._owners.get(db, owner_id)
+            parent = {image_id: image_id for image_id in owner.hashes}
+
+            def root(x):
+                while parent[x] != x:
+                    parent[x] = parent[parent[x]]
+                    x = parent[x]
+                return x
+
+            for image_id, value in owner.hashes.items():
+                for other, _ in owner.tree.search(value, max_distance):
+                    if other in parent:
+                        a, b = root(image_id), root(other)
+                        if a != b:
+                            parent[max(a, b)] = min(a, b)
+
+        groups: Dict[int, List[int]] = {}
+        for image_id in parent:
+            groups.setdefault(root(image_id), []).append(image_id)
+        return sorted((sorted(ids) for ids in groups.values() if len(ids) > 1), key=lambda ids: ids[0])
+
+
+_default = Singleton(DuplicateIndex)
+
+
+def get_index() -> DuplicateIndex:
+    return _default.get()
+
+
+@image_events.on_changed
+def index_image(db: Session, image):
+    get_index().index_image(db, image)
+
+
+@image_events.on_removed
+def remove_image(db: Session, owner_id: int, image_id: int):
+    get_index().remove_image(db, owner_id, image_id)
+
+
+def find(db: Session, owner_id: int, phash: Optional[str], max_distance: int = PHASH_MAX_DISTANCE) -> Optional[Tuple[int, int]]:
+    if not phash:
+        return None
+    hits = get_index().find(db, owner_id, phash, max_distance)
+    return hits[0] if hits else None
+
+
+def clusters(db: Session, owner_id: int, max_distance: int = PHASH_MAX_DISTANCE) -> List[List[int]]:
+    return get_index().clusters(db, owner_id, max_distance)
@@ -0,0 +1,119 @@
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import extract, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import models, schemas, image_events, tag_service
+from utils import LRUCache
+
+FACET_LIMIT = int(os.getenv("FACET_LIMIT", "50"))
+FACET_CACHE_SIZE = int(os.getenv("FACET_CACHE_SIZE", "4096"))
+# 独立部署的任务 worker 进程改动标签时不会通知本进程，靠 TTL 兜底
+FACET_CACHE_TTL = float(os.getenv("FACET_CACHE_TTL", "60"))
+
+_cache = LRUCache(FACET_CACHE_SIZE, FACET_CACHE_TTL)
+_versions: Dict[int, int] = {}
+_versions_lock = threading.Lock()
+
+
+def _version(owner_id: int) -> int:
+    with _versions_lock:
+        return _versions.get(owner_id, 0)
+
+
+def invalidate(owner_id: int):
+    # 递增版本号即可让该 owner 的所有筛选组合一起失效，旧条目由 LRU 自然淘汰
+    with _versions_lock:
+        _versions[owner_id] = _versions.get(owner_id, 0) + 1
+
+
+@image_events.on_changed
+def image_changed(db: Session, image):
+    invalidate(image.owner_id)
+
+
+@image_events.on_removed
+def image_removed(db: Session, owner_id: int, image_id: int):
+    invalidate(owner_id)
+
+
+def _conditions(owner_id: int, tag: Optional[str], location: Optional[str], category: Optional[str],
+                year: Optional[int], month: Optional[int]):
+    conditions = [models.Image.owner_id == owner_id]
+    if tag:
+        tagged = (
+            select(models.image_tags.c.image_id)
+            .join(models.Tag, models.Tag.id == models.image_tags.c.tag_id)
+            .where(models.Tag.name.in_(tag_service.normalize([tag]) or [tag]))
+        )
+        conditions.append(models.Image.id.in_(tagged))
+    if location:
+        conditions.append(models.Image.location == location)
+    if category:
+        conditions.append(models.Image.category == category)
+    if year:
+        # 按区间比较以便走 (owner_id, capture_date) 索引
+        start = datetime(year, month or 1, 1)
+        end = datetime(year + (month or 12) // 12, (month or 12) % 12 + 1, 1)
+        conditions += [models.Image.capture_date >= start, models.Image.capture_date < end]
+    return conditions
+
+
+def _counts(rows):
+    return [schemas.FacetCount(value=value, count=count) for value, count in rows]
+
+
+async def _compute(db: AsyncSession, conditions) -> schemas.FacetsResponse:
+    total = (await db.execute(select(func.count()).select_from(models.Image).where(*conditions))).scalar()
+
+    count = func.count().label("n")
+    tags = await db.execute(
+        select(models.Tag.name, count)
+        .select_from(models.image_tags)
+        .join(models.Tag, models.Tag.id == models.image_tags.c.tag_id)
+        .join(models.Image, models.Image.id == models.image_tags.c.image_id)
+        .where(*conditions)
+        .group_by(models.Tag.name)
+        .order_by(count.desc(), models.Tag.name)
+        .limit(FACET_LIMIT)
+    )
+
+    async def grouped(column):
+        return await db.execute(
+            select(column, count).where(*conditions, column.isnot(None))
+            .group_by(column).order_by(count.desc(), column).limit(FACET_LIMIT)
+        )
+
+    locations = await grouped(models.Image.location)
+    categories = await grouped(models.Image.category)
+
+    year = extract("year", models.Image.capture_date).label("year")
+    month = extract("month", models.Image.capture_date).label("month")
+    dates = await db.execute(
+        select(year, month, count).where(*conditions, models.Image.capture_date.isnot(None))
+        .group_by(year, month).order_by(year.desc(), month.desc())
+    )
+
+    return schemas.FacetsResponse(
+        total=total,
+        tags=_counts(tags),
+        locations=_counts(locations),
+        categories=_counts(categories),
+        dates=[schemas.DateFacet(year=int(y), month=int(m), count=n) for y, m, n in dates],
+    )
+
+
+async def get_facets(db: AsyncSession, owner_id: int, tag: Optional[str] = None, location: Optional[str] = None,
+                     category: Optional[str] = None, year: Optional[int] = None, month: Optional[int] = None) -> schemas.FacetsResponse:
+    # 版本号在查询前读取：计算期间若有改动，结果写在旧版本下，不会被后续读取命中
+    key = (owner_id, _version(owner_id), tag, location, category, year, month)
+    cached = _cache.get(key)
+    if cached is not None:
+        return cached
+    result = await _compute(db, _conditions(owner_id, tag, location, category, year, month))
+    _cache.set(key, result)
+    return result
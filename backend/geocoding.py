@@ -0,0 +1,181 @@
+import os
+import csv
+import math
+import time
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from geopy.geocoders import Nominatim
+
+import models, database, metrics
+from utils import LRUCache
+
+GEOCODE_GRID = float(os.getenv("GEOCODE_GRID", "0.01"))
+GEOCODE_ONLINE = os.getenv("GEOCODE_ONLINE", "1") == "1"
+GEOCODE_OFFLINE_DATASET = os.getenv("GEOCODE_OFFLINE_DATASET")
+GEOCODE_OFFLINE_MAX_KM = float(os.getenv("GEOCODE_OFFLINE_MAX_KM", "30"))
+GEOCODE_MIN_INTERVAL = float(os.getenv("GEOCODE_MIN_INTERVAL", "1.0"))
+NOMINATIM_DOMAIN = os.getenv("NOMINATIM_DOMAIN", "nominatim.openstreetmap.org")
+NOMINATIM_SCHEME = os.getenv("NOMINATIM_SCHEME", "https")
+
+geolocator = Nominatim(user_agent="zju_image_system_student_demo", domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME)
+
+_MISSING = object()
+_memory = LRUCache(int(os.getenv("GEOCODE_MEMORY_SIZE", "4096")), float(os.getenv("GEOCODE_MEMORY_TTL", "86400")))
+_throttle_lock = threading.Lock()
+_last_online_call = 0.0
+
+
+def grid_key(lat: float, lon: float) -> str:
+    return f"{GEOCODE_GRID:g}:{round(lat / GEOCODE_GRID)}:{round(lon / GEOCODE_GRID)}"
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+
+class OfflineGeocoder:
+    """本地地名数据集 (CSV: name,lat,lon[,admin])，按 1° 经纬度网格分桶做最近邻查找。"""
+
+    def __init__(self, places: List[Tuple[str, float, float]], max_km: float = GEOCODE_OFFLINE_MAX_KM):
+        self.max_km = max_km
+        self._buckets: Dict[Tuple[int, int], List[Tuple[str, float, float]]] = {}
+        for name, lat, lon in places:
+            self._buckets.setdefault((math.floor(lat), math.floor(lon)), []).append((name, lat, lon))
+
+    @classmethod
+    def from_csv(cls, path: str):
+        places = []
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if len(row) < 3:
+                    continue
+                try:
+                    lat, lon = float(row[1]), float(row[2])
+                except ValueError:
+                    continue
+                admin = row[3].strip() if len(row) > 3 else ""
+                name = " ".join(dict.fromkeys(p for p in [admin, row[0].strip()] if p))
+                places.append((name, lat, lon))
+        print(f"[Geo] 加载离线地名 {len(places)} 条: {path}")
+        return cls(places)
+
+    def nearest(self, lat: float, lon: float) -> Optional[str]:
+        cell_lat, cell_lon = math.floor(lat), math.floor(lon)
+        best_name, best_km = None, self.max_km
+        lat_km = 111.0
+        lon_km = max(111.0 * math.cos(math.radians(lat)), 1.0)
+        max_ring = int(math.ceil(self.max_km / min(lat_km, lon_km))) + 1
+        for ring in range(max_ring + 1):
+            if best_name is not None and (ring - 1) * min(lat_km, lon_km) > best_km:
+                break
+            for dlat in range(-ring, ring + 1):
+                for dlon in range(-ring, ring + 1):
+                    if max(abs(dlat), abs(dlon)) != ring:
+                        continue
+                    for name, plat, plon in self._buckets.get((cell_lat + dlat, cell_lon + dlon), ()):
+                        km = _haversine_km(lat, lon, plat, plon)
+                        if km < best_km:
+                            best_name, best_km = name, km
+        return best_name
+
+
+_offline: Optional[OfflineGeocoder] = None
+_offline_loaded = False
+_offline_lock = threading.Lock()
+
+
+def get_offline_geocoder() -> Optional[OfflineGeocoder]:
+    global _offline, _offline_loaded
+    with _offline_lock:
+        if not _offline_loaded:
+            _offline_loaded = True
+            if GEOCODE_OFFLINE_DATASET and os.path.exists(GEOCODE_OFFLINE_DATASET):
+                _offline = OfflineGeocoder.from_csv(GEOCODE_OFFLINE_DATASET)
+        return _offline
+
+
+class Throttled(Exception):
+    def __init__(self, retry_in: float):
+        super().__init__(f"在线逆地理编码限速中，{retry_in:.1f}s 后重试")
+        self.retry_in = retry_in
+
+
+def online_wait() -> float:
+    with _throttle_lock:
+        return max(0.0, _last_online_call + GEOCODE_MIN_INTERVAL - time.monotonic())
+
+
+def _reserve_online():
+    # 不在锁里 sleep：拿不到配额直接抛出，由调用方（任务队列）改期，避免把 worker 全部堵在这里
+    global _last_online_call
+    with _throttle_lock:
+        wait = _last_online_call + GEOCODE_MIN_INTERVAL - time.monotonic()
+        if wait > 0:
+            raise Throttled(wait)
+        _last_online_call = time.monotonic()
+
+
+def lookup_online(lat: float, lon: float) -> Optional[str]:
+    _reserve_online()
+    location = geolocator.reverse((lat, lon), language='zh-cn', timeout=10)
+    if location:
+        address = location.raw.get('address', {})
+        city = address.get('city') or address.get('town') or address.get('county')
+        state = address.get('state')
+        parts = [p for p in [state, city] if p]
+        return " ".join(dict.fromkeys(parts)) or None
+    return None
+
+
+def _remember(key: str, name: Optional[str]):
+    _memory.set(key, name)
+    db = database.SessionLocal()
+    try:
+        db.merge(models.GeocodeCache(grid_key=key, name=name, created_at=datetime.now()))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"[Geo] 写入地理编码缓存失败: {e}")
+    finally:
+        db.close()
+
+
+def lookup_cached(lat: float, lon: float):
+    key = grid_key(lat, lon)
+    name = _memory.get(key, _MISSING)
+    if name is not _MISSING:
+        return True, name
+
+    db = database.SessionLocal()
+    try:
+        row = db.get(models.GeocodeCache, key)
+    finally:
+        db.close()
+    if row is not None:
+        _memory.set(key, row.name)
+        return True, row.name
+
+    offline = get_offline_geocoder()
+    if offline is not None:
+        name = offline.nearest(lat, lon)
+        if name is not None:
+            _remember(key, name)
+            return True, name
+    return False, None
+
+
+def resolve(lat: float, lon: float) -> Optional[str]:
+    found, name = lookup_cached(lat, lon)
+    if found or not GEOCODE_ONLINE:
+        return name
+    center_lat = round(lat / GEOCODE_GRID) * GEOCODE_GRID
+    center_lon = round(lon / GEOCODE_GRID) * GEOCODE_GRID
+    with metrics.timed_stage("geocode_online"):
+        name = lookup_online(center_lat, center_lon)
+    _remember(grid_key(lat, lon), name)
+    return name
@@ -0,0 +1,32 @@
+from typing import Callable, List
+
+from sqlalchemy.orm import Session
+
+_changed: List[Callable] = []
+_removed: List[Callable] = []
+
+
+def on_changed(fn):
+    _changed.append(fn)
+    return fn
+
+
+def on_removed(fn):
+    _removed.append(fn)
+    return fn
+
+
+def changed(db: Session, image):
+    for listener in _changed:
+        try:
+            listener(db, image)
+        except Exception as e:
+            print(f"[Events] {listener.__module__}.{listener.__name__} 处理图片 {image.id} 变更失败: {e}")
+
+
+def removed(db: Session, owner_id: int, image_id: int):
+    for listener in _removed:
+        try:
+            listener(db, owner_id, image_id)
+        except Exception as e:
+            print(f"[Events] {listener.__module__}.{listener.__name__} 处理图片 {image_id} 删除失败: {e}")
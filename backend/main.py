@@ -1,35 +1,66 @@
 import os
 import json
-from typing import List, Optional
-from datetime import timedelta
-
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Query, BackgroundTasks
-from fastapi.staticfiles import StaticFiles
+import time
+import asyncio
+import mimetypes
+from contextlib import asynccontextmanager
+from typing import List, Optional, Union
+from datetime import datetime, timedelta
+
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Query, Request, Response
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-
-from sqlalchemy import create_engine, or_
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-
-import models, schemas, security, database, utils, ai_service
-
-SQLALCHEMY_DATABASE_URL = "mysql+pymysql://sims_user:sims_password@db:3306/image_db"
-
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
+from starlette.concurrency import run_in_threadpool
+
+from sqlalchemy import Column, Float, Integer, MetaData, Table, delete, insert, or_, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, load_only, selectinload
+
+from database import engine, SessionLocal, get_db, get_async_db
+import models, schemas, security, database, utils, ai_client, ai_service, search_index, task_queue, geocoding, renderer, pagination, text_index, image_events, tag_service, view_counter, dedupe, storage, visual_index, facets, metrics
+
+SMART_SEARCH_TOP_K = int(os.getenv("SMART_SEARCH_TOP_K", "50"))
+SMART_SEARCH_MIN_SCORE = float(os.getenv("SMART_SEARCH_MIN_SCORE", "0.15"))
+SMART_SEARCH_RERANK = os.getenv("SMART_SEARCH_RERANK", "0") == "1"
+STATIC_SERVE_MODE = os.getenv("STATIC_SERVE_MODE", "direct")
+STATIC_ACCEL_PREFIX = os.getenv("STATIC_ACCEL_PREFIX", "/protected")
+STATIC_CACHE_CONTROL = "private, max-age=31536000, immutable"
+IMAGE_PAGE_MAX = int(os.getenv("IMAGE_PAGE_MAX", "500"))
+TEXT_SEARCH_ID_CHUNK = int(os.getenv("TEXT_SEARCH_ID_CHUNK", "5000"))
+BATCH_UPLOAD_MAX_FILES = int(os.getenv("BATCH_UPLOAD_MAX_FILES", "1000"))
+BATCH_INSERT_CHUNK = 500
+_GRID_COLUMNS = [getattr(models.Image, name) for name in schemas.ImageGridResponse.model_fields if name != "renditions"]
 
 models.Base.metadata.create_all(bind=engine)
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-app = FastAPI(title="Smart Image System")
+database.ensure_schema(engine, models.Base.metadata)
+
+def _backfill(kind: str, column, label: str):
+    with SessionLocal() as db:
+        if db.query(models.Job.id).filter(models.Job.kind == kind, models.Job.status.in_(["queued", "running"])).first():
+            return
+        ids = [row.id for row in db.query(models.Image.id).filter(column.is_(None))]
+        if ids:
+            task_queue.enqueue_many(db, kind, ids)
+            db.commit()
+            print(f"[Queue] 为 {len(ids)} 张历史图片补算{label}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(utils.warm_process_pool)
+    await run_in_threadpool(_backfill, "phash", models.Image.phash, "感知哈希")
+    await run_in_threadpool(_backfill, "visual", models.Image.visual, "视觉特征")
+    await run_in_threadpool(storage.sweep)
+    task_queue.pool.start()
+    view_counter.counter.start()
+    yield
+    task_queue.pool.stop()
+    await run_in_threadpool(view_counter.counter.stop)
+    utils.shutdown_process_pool()
+    await run_in_threadpool(ai_service.client.close)
+    await database.async_engine.dispose()
+
+app = FastAPI(title="Smart Image System", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,9 +68,67 @@ app.add_middleware(
     allow_credentials=True, 
     allow_methods=["*"],    
     allow_headers=["*"],    
+    expose_headers=["X-Next-Cursor", "X-Duplicate-Of", "Server-Timing"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics(request: Request):
+    if not metrics.allowed(request.client.host if request.client else None, request.headers.get("authorization")):
+        # 配置了令牌时提示客户端带凭据重试；只按网段放行时直接拒绝
+        if metrics.METRICS_TOKEN:
+            raise HTTPException(status_code=401, detail="需要监控指标访问令牌", headers={"WWW-Authenticate": "Bearer"})
+        raise HTTPException(status_code=403, detail="无权访问监控指标")
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+def _find_owned_file(db: Session, path: str, owner_id: int):
+    owned = (
+        db.query(models.Image.id)
+        .filter(models.Image.owner_id == owner_id)
+        .filter((models.Image.file_path == path) | (models.Image.thumbnail_path == path))
+        .first()
+    )
+    if owned:
+        return True
+    return db.query(models.ImageDerivative.id).join(models.Image).filter(
+        models.ImageDerivative.path == path, models.Image.owner_id == owner_id
+    ).first() is not None
+
+@app.api_route("/static/{file_path:path}", methods=["GET", "HEAD"])
+def serve_static(
+    file_path: str,
+    request: Request,
+    current_user: security.Principal = Depends(security.get_current_user_or_cookie),
+    db: Session = Depends(get_db)
+):
+    path = f"static/{file_path}"
+    if not _find_owned_file(db, path, current_user.id):
+        raise HTTPException(404, detail="Not Found")
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+    url = storage.url(path)
+    if url:
+        return RedirectResponse(url, status_code=307, headers={"Cache-Control": "private, no-store"})
+    try:
+        path = storage.local_path(path)
+    except FileNotFoundError:
+        raise HTTPException(404, detail="Not Found")
+
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {"Cache-Control": STATIC_CACHE_CONTROL}
+    if STATIC_SERVE_MODE == "accel":
+        headers["X-Accel-Redirect"] = f"{STATIC_ACCEL_PREFIX}/{file_path}"
+        return Response(headers=headers, media_type=media_type)
+
+    stat = os.stat(path)
+    response = FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+    if utils.is_not_modified(request.headers, response.headers["etag"], stat.st_mtime):
+        return Response(status_code=304, headers={
+            "Cache-Control": STATIC_CACHE_CONTROL,
+            "ETag": response.headers["etag"],
+            "Last-Modified": response.headers["last-modified"],
+        })
+    return response
 
 @app.post("/api/v1/auth/register", response_model=schemas.UserResponse)
 def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
@@ -56,175 +145,655 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
     return new_user
 
 @app.post("/api/v1/auth/login", response_model=schemas.Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def login(response: Response, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.username == form_data.username).first()
     if not user or not security.verify_password(form_data.password, user.password_hash):
         raise HTTPException(status_code=400, detail="用户名或密码错误")
     
-    access_token = security.create_access_token(data={"sub": user.username})
+    access_token = security.create_access_token(data={"sub": user.username, "uid": user.id})
+    response.set_cookie(security.ACCESS_TOKEN_COOKIE, access_token, httponly=True, samesite="lax", path="/")
     return {"access_token": access_token, "token_type": "bearer"}
 
-def bg_generate_tags(image_id: int, file_path: str, db: Session):
-    print(f"[AI] 开始分析图片 ID: {image_id} ...")
+@app.post("/api/v1/auth/logout", status_code=204)
+def logout(response: Response):
+    response.delete_cookie(security.ACCESS_TOKEN_COOKIE, path="/")
+    return None
+
+def _image_values(image_info: dict, owner_id: int):
+    lat_lon = image_info.get("lat_lon")
+    location, needs_geocode = None, False
+    if lat_lon:
+        with metrics.timed_stage("geocode"):
+            found, location = geocoding.lookup_cached(*lat_lon)
+        needs_geocode = not found
+
+    values = dict(
+        filename=image_info["filename"],
+        file_path=image_info["file_path"],
+        thumbnail_path=image_info.get("thumbnail_path"),
+        file_size=image_info["file_size"],
+        width=image_info.get("width"),
+        height=image_info.get("height"),
+        # 推迟分析的上传先以入库时间占位，analyze 任务再按 EXIF 改写
+        capture_date=image_info.get("capture_date") or datetime.now(),
+        location=location, 
+        latitude=lat_lon[0] if lat_lon else None,
+        longitude=lat_lon[1] if lat_lon else None,
+        content_hash=image_info["content_hash"],
+        phash=image_info.get("phash"),
+        visual=image_info.get("visual"),
+        owner_id=owner_id,
+        tag_status="pending",
+    )
+    return values, needs_geocode
+
+def _create_image(db: Session, image_info: dict, owner_id: int):
+    values, needs_geocode = _image_values(image_info, owner_id)
+    db_image = models.Image(
+        **values,
+        renditions=[models.ImageDerivative(**r) for r in image_info.get("renditions", [])]
+    )
+    moved = False
     try:
-        tags = ai_service.generate_image_tags(file_path)
+        db.add(db_image)
+        db.flush()
+        storage.acquire(db, image_info["content_hash"], image_info["file_path"], image_info["file_size"])
+        moved = True
+        storage.commit(image_info)
+        if "phash" not in image_info:  # 推迟分析的上传
+            task_queue.enqueue(db, "analyze", db_image.id)
+        task_queue.enqueue(db, "tag", db_image.id)
+        if needs_geocode:
+            task_queue.enqueue(db, "geocode", db_image.id)
+        db.commit()
     except Exception:
-        return
-
-    if tags:
-        print(f"[AI] 识别成功，标签: {tags}")
-        image = db.query(models.Image).filter(models.Image.id == image_id).first()
-        if image:
-            for tag_name in tags:
-                clean_name = tag_name.strip().lower()
-                tag = db.query(models.Tag).filter(models.Tag.name == clean_name).first()
-                if not tag:
-                    try:
-                        tag = models.Tag(name=clean_name)
-                        db.add(tag)
-                        db.commit()
-                        db.refresh(tag)
-                    except Exception:
-                        db.rollback()
-                        tag = db.query(models.Tag).filter(models.Tag.name == clean_name).first()
-                
-                if tag and tag not in image.tags:
-                    image.tags.append(tag)
-            try:
-                db.commit()
-            except Exception:
-                db.rollback()
-    else:
-        print("[AI] 未生成标签")
+        db.rollback()
+        storage.discard(image_info)
+        if moved:
+            storage.abandon([image_info])
+        raise
+    db.refresh(db_image)
+    image_events.changed(db, db_image)
+    task_queue.notify()
+    return schemas.ImageResponse.model_validate(db_image)
+
+def _create_images(db: Session, image_infos: List[dict], owner_id: int):
+    rows, geocode = [], []
+    for info in image_infos:
+        values, needs_geocode = _image_values(info, owner_id)
+        rows.append(values)
+        geocode.append(needs_geocode)
+
+    keys = [(row["file_path"], row["filename"]) for row in rows]
+    paths = list(dict.fromkeys(path for path, _ in keys))
+    moved = []
+    try:
+        existing = set()
+        for chunk in _chunks(paths, BATCH_INSERT_CHUNK):
+            existing.update(db.execute(
+                select(models.Image.id).where(models.Image.owner_id == owner_id, models.Image.file_path.in_(chunk))
+            ).scalars())
+        for chunk in _chunks(rows, BATCH_INSERT_CHUNK):
+            db.execute(insert(models.Image), chunk)
+        # 相同内容共用同一路径，可能已有图片或在本批中重复出现；按 (路径, 文件名) 依插入顺序对应新 id
+        new_ids = {}
+        for chunk in _chunks(paths, BATCH_INSERT_CHUNK):
+            found = db.execute(
+                select(models.Image.file_path, models.Image.filename, models.Image.id)
+                .where(models.Image.owner_id == owner_id, models.Image.file_path.in_(chunk))
+                .order_by(models.Image.id)
+            )
+            for path, filename, image_id in found:
+                if image_id not in existing:
+                    new_ids.setdefault((path, filename), []).append(image_id)
+        ids = [new_ids[key].pop(0) for key in keys]
+
+        renditions = [
+            dict(r, image_id=image_id) for image_id, info in zip(ids, image_infos) for r in info.get("renditions", [])
+        ]
+        for chunk in _chunks(renditions, BATCH_INSERT_CHUNK):
+            db.execute(insert(models.ImageDerivative), chunk)
+        storage.acquire_many(db, image_infos)
+        for info in image_infos:
+            moved.append(info)
+            storage.commit(info)
+        task_queue.enqueue_many(db, "tag", ids)
+        task_queue.enqueue_many(db, "geocode", [image_id for image_id, needs in zip(ids, geocode) if needs])
+        db.commit()
+    except Exception:
+        db.rollback()
+        for info in image_infos:
+            storage.discard(info)
+        storage.abandon(moved)
+        raise
+    task_queue.notify()
+
+    created = {}
+    for chunk in _chunks(ids, BATCH_INSERT_CHUNK):
+        query = db.query(models.Image).options(selectinload(models.Image.tags), selectinload(models.Image.renditions))
+        for image in query.filter(models.Image.id.in_(chunk)):
+            image_events.changed(db, image)
+            created[image.id] = schemas.ImageResponse.model_validate(image)
+    return [created.get(image_id) for image_id in ids]
+
+def _find_same_content(db: Session, owner_id: int, content_hash: str):
+    row = db.query(models.Image.id).filter(
+        models.Image.owner_id == owner_id, models.Image.content_hash == content_hash
+    ).order_by(models.Image.id).first()
+    return row.id if row else None
+
+def _find_duplicate(db: Session, owner_id: int, phash: Optional[str]):
+    match = dedupe.find(db, owner_id, phash)
+    return match[0] if match else None
+
+def _link_image(db: Session, source: models.Image, filename: str, owner_id: int):
+    # 指向已有文件与派生图，不再落盘、不再调用模型打标签
+    image = models.Image(
+        filename=filename,
+        file_path=source.file_path,
+        thumbnail_path=source.thumbnail_path,
+        file_size=source.file_size,
+        width=source.width,
+        height=source.height,
+        capture_date=source.capture_date,
+        location=source.location,
+        latitude=source.latitude,
+        longitude=source.longitude,
+        category=source.category,
+        content_hash=source.content_hash,
+        phash=source.phash,
+        visual=source.visual,
+        owner_id=owner_id,
+        tag_status=source.tag_status if source.tag_status == "done" else "pending",
+        renditions=[
+            models.ImageDerivative(width=r.width, height=r.height, format=r.format, path=r.path, file_size=r.file_size)
+            for r in source.renditions
+        ],
+    )
+    db.add(image)
+    db.flush()
+    if utils.is_blob_path(source.file_path):
+        storage.acquire(db, source.content_hash, source.file_path, source.file_size)
+    tag_service.add_tags(db, image.id, [t.name for t in source.tags])
+    if image.tag_status != "done":
+        task_queue.enqueue(db, "tag", image.id)
+    db.commit()
+    db.refresh(image)
+    image_events.changed(db, image)
+    task_queue.notify()
+    return schemas.ImageResponse.model_validate(image)
+
+def _reuse_image(db: Session, existing_id: int, filename: str, owner_id: int, mode: str):
+    source = db.get(models.Image, existing_id)
+    if mode == "link":
+        return _link_image(db, source, filename, owner_id)
+    return schemas.ImageResponse.model_validate(source)
 
 @app.post("/api/v1/upload", response_model=schemas.ImageResponse)
-def upload_image(
-    background_tasks: BackgroundTasks, 
+async def upload_image(
+    response: Response,
     file: UploadFile = File(...), 
-    current_user: models.User = Depends(security.get_current_user),
+    dedupe_mode: str = Query("keep", alias="dedupe", pattern="^(keep|skip|link)$"),
+    current_user: security.Principal = Depends(security.get_current_user),
     db: Session = Depends(get_db)
 ):
     if not file.content_type.startswith("image/"):
         raise HTTPException(400, detail="必须上传图片")
 
     try:
-        image_info = utils.process_image(file)
+        saved = await run_in_threadpool(utils.save_upload, file)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
     except Exception as e:
         raise HTTPException(500, detail=f"处理失败: {str(e)}")
 
-    db_image = models.Image(
-        filename=image_info["filename"],
-        file_path=image_info["file_path"],
-        thumbnail_path=image_info["thumbnail_path"],
-        file_size=image_info["file_size"],
-        width=image_info["width"],
-        height=image_info["height"],
-        capture_date=image_info["capture_date"],
-        location=image_info.get("location"), 
-        owner_id=current_user.id
-    )
-    db.add(db_image)
-    db.commit()
-    db.refresh(db_image)
+    existing_id = await run_in_threadpool(_find_same_content, db, current_user.id, saved["content_hash"])
+    if existing_id:
+        response.headers["X-Duplicate-Of"] = str(existing_id)
+        if dedupe_mode != "keep":
+            storage.discard(saved)
+            return await run_in_threadpool(_reuse_image, db, existing_id, file.filename, current_user.id, dedupe_mode)
 
-    background_tasks.add_task(bg_generate_tags, db_image.id, db_image.file_path, db)
+    if dedupe_mode == "keep":
+        # 原图已落盘即可入库返回；缩略图、派生图、EXIF 与感知哈希交给 analyze 任务。
+        # skip / link 需要感知哈希判断近似重复，仍在请求内分析
+        return await run_in_threadpool(_create_image, db, dict(saved, filename=file.filename), current_user.id)
 
-    return db_image
+    try:
+        image_info = await utils.analyze_saved(saved, file.filename)
+    except Exception as e:
+        raise HTTPException(500, detail=f"处理失败: {str(e)}")
 
-@app.post("/api/v1/chat/describe/{image_id}")
-async def describe_cloud_image(
-    image_id: int,
-    current_user: models.User = Depends(security.get_current_user),
+    existing_id = await run_in_threadpool(_find_duplicate, db, current_user.id, image_info["phash"])
+    if existing_id:
+        response.headers["X-Duplicate-Of"] = str(existing_id)
+        storage.discard(image_info)
+        return await run_in_threadpool(_reuse_image, db, existing_id, file.filename, current_user.id, dedupe_mode)
+
+    return await run_in_threadpool(_create_image, db, image_info, current_user.id)
+
+@app.post("/api/v1/upload/batch", response_model=schemas.BatchUploadResponse)
+async def upload_batch(
+    files: List[UploadFile] = File(...),
+    dedupe_mode: str = Query("keep", alias="dedupe", pattern="^(keep|skip|link)$"),
+    current_user: security.Principal = Depends(security.get_current_user),
     db: Session = Depends(get_db)
 ):
-    image = db.query(models.Image).filter(models.Image.id == image_id, models.Image.owner_id == current_user.id).first()
+    results: List[dict] = []
+    tasks = []
+
+    async def analyze(item: dict, saved: dict):
+        try:
+            item["info"] = await utils.analyze_saved(saved, item["filename"])
+        except Exception as e:
+            item["error"] = f"处理失败: {str(e)}"
+
+    def accept(filename: str, saved):
+        item = {"filename": filename}
+        results.append(item)
+        if len(results) > BATCH_UPLOAD_MAX_FILES:
+            if isinstance(saved, dict): storage.discard(saved)
+            item["error"] = f"超出单次上传上限 ({BATCH_UPLOAD_MAX_FILES} 张)"
+        elif isinstance(saved, Exception):
+            item["error"] = f"处理失败: {str(saved)}"
+        else:
+            tasks.append(asyncio.create_task(analyze(item, saved)))
+
+    try:
+        for file in files:
+            if utils.is_archive_name(file.filename):
+                members = utils.save_archive_members(file.file)
+                try:
+                    while (member := await run_in_threadpool(next, members, None)) is not None:
+                        accept(*member)
+                except Exception as e:
+                    results.append({"filename": file.filename, "error": f"压缩包解析失败: {str(e)}"})
+                finally:
+                    members.close()
+            elif (file.content_type or "").startswith("image/") or utils.is_image_name(file.filename):
+                try:
+                    saved = await run_in_threadpool(utils.save_upload, file)
+                except Exception as e:
+                    saved = e
+                accept(file.filename, saved)
+            else:
+                results.append({"filename": file.filename, "error": "必须上传图片或 zip/tar 压缩包"})
+    finally:
+        await asyncio.gather(*tasks)
+
+    for item in results:
+        if "info" not in item:
+            continue
+        item["duplicate_of"] = await run_in_threadpool(_find_duplicate, db, current_user.id, item["info"]["phash"])
+        if item["duplicate_of"] and dedupe_mode != "keep":
+            storage.discard(item.pop("info"))
+
+    pending = [item for item in results if "info" in item]
+    if pending:
+        created = await run_in_threadpool(_create_images, db, [item["info"] for item in pending], current_user.id)
+        for item, image in zip(pending, created):
+            item["image"] = image
+    items = []
+    for item in results:
+        if "info" in item:
+            image = item.get("image")
+        elif item.get("duplicate_of"):
+            image = await run_in_threadpool(_reuse_image, db, item["duplicate_of"], item["filename"], current_user.id, dedupe_mode)
+        else:
+            image = None
+        items.append(schemas.BatchUploadItem(
+            filename=item["filename"], ok=image is not None, image=image, error=item.get("error"),
+            duplicate_of=item.get("duplicate_of"),
+        ))
+    succeeded = sum(1 for item in items if item.ok)
+    return schemas.BatchUploadResponse(total=len(items), succeeded=succeeded, failed=len(items) - succeeded, results=items)
+
+async def _describe_source(db: AsyncSession, image_id: int, owner_id: int):
+    image = (await db.execute(
+        select(models.Image).where(models.Image.id == image_id, models.Image.owner_id == owner_id)
+    )).scalar_one_or_none()
     if not image:
         raise HTTPException(404, detail="图片不存在或无权访问")
 
-    if not os.path.exists(image.file_path):
+    try:
+        source_path = await run_in_threadpool(storage.local_path, image.file_path)
+    except FileNotFoundError:
          raise HTTPException(404, detail="服务器磁盘上找不到该文件")
 
+    if not image.content_hash:
+        image.content_hash = await run_in_threadpool(utils.file_sha256, source_path)
+        await db.commit()
+    return image, source_path
+
+@app.post("/api/v1/chat/describe/{image_id}")
+async def describe_cloud_image(
+    image_id: int,
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    image, source_path = await _describe_source(db, image_id, current_user.id)
+
     try:
-        description = ai_service.get_image_description(image.file_path)
+        description = await ai_service.get_image_description_async(source_path, image.content_hash)
         return {
             "description": description,
             "image_url": f"/static/{image.filename}" 
         }
+    except ai_client.CircuitOpenError:
+        raise HTTPException(503, detail="AI 服务暂不可用，请稍后再试")
     except Exception as e:
         print(f"Cloud Image Describe Error: {e}")
         raise HTTPException(status_code=500, detail=f"AI 分析失败: {str(e)}")
 
+def _sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.post("/api/v1/chat/describe/{image_id}/stream")
+async def describe_cloud_image_stream(
+    image_id: int,
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    started = time.perf_counter()
+    image, source_path = await _describe_source(db, image_id, current_user.id)
+    image_url = f"/static/{image.filename}"
+
+    # 先等到第一段文本再发送响应头，熔断或上游失败时仍能返回正常的错误状态码
+    chunks = ai_service.stream_image_description(source_path, image.content_hash)
+    try:
+        first = await anext(chunks, None)
+    except ai_client.CircuitOpenError:
+        await chunks.aclose()
+        raise HTTPException(503, detail="AI 服务暂不可用，请稍后再试")
+    except Exception as e:
+        await chunks.aclose()
+        print(f"Cloud Image Describe Error: {e}")
+        raise HTTPException(status_code=500, detail=f"AI 分析失败: {str(e)}")
+    ttfb_ms = (time.perf_counter() - started) * 1000
+
+    async def events():
+        parts = [first] if first else []
+        try:
+            if first:
+                yield _sse("delta", {"text": first})
+            async for delta in chunks:
+                parts.append(delta)
+                yield _sse("delta", {"text": delta})
+            yield _sse("done", {"description": "".join(parts), "image_url": image_url})
+        except Exception as e:
+            print(f"Cloud Image Describe Error: {e}")
+            yield _sse("error", {"detail": "AI 分析中断，请稍后再试"})
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "Server-Timing": f"ttfb;dur={ttfb_ms:.1f}",
+    })
+
+def _vector_search(owner_id: int, query: str, top_k: int):
+    with SessionLocal() as db:
+        return search_index.search(db, owner_id, query, top_k)
+
+def _text_search(owner_id: int, query: str):
+    with SessionLocal() as db:
+        return text_index.search(db, owner_id, query)
+
+def _full_image_options():
+    return (selectinload(models.Image.tags), selectinload(models.Image.renditions))
+
 @app.get("/api/v1/search/smart", response_model=List[schemas.ImageResponse])
-def smart_search(
+async def smart_search(
     query: str,
-    current_user: models.User = Depends(security.get_current_user),
-    db: Session = Depends(get_db)
+    top_k: int = Query(SMART_SEARCH_TOP_K, ge=1, le=200),
+    rerank: Optional[bool] = None,
+    current_user: security.Principal = Depends(security.get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     if not query.strip(): return []
+    if rerank is None: rerank = SMART_SEARCH_RERANK
 
-    all_images = db.query(models.Image).filter(models.Image.owner_id == current_user.id).all()
-    
-    if not all_images:
+    hits = await run_in_threadpool(_vector_search, current_user.id, query.strip(), top_k)
+    if not rerank:
+        hits = [(image_id, score) for image_id, score in hits if score >= SMART_SEARCH_MIN_SCORE]
+    if not hits:
         return []
 
-    images_payload = []
-    for img in all_images:
-        tag_names = [t.name for t in img.tags]
-        images_payload.append({
-            "id": img.id,
-            "filename": img.filename,
-            "tags": tag_names,
-            "category": img.category,
-            "location": img.location
-        })
-
-    sorted_ids = ai_service.rank_images_by_relevance(query, images_payload)
+    candidate_ids = [image_id for image_id, _ in hits]
+    candidates = (await db.scalars(
+        select(models.Image)
+        .options(*_full_image_options())
+        .where(models.Image.owner_id == current_user.id, models.Image.id.in_(candidate_ids))
+    )).all()
+    img_map = {img.id: schemas.ImageResponse.model_validate(img) for img in candidates}
+
+    sorted_ids = candidate_ids
+    if rerank:
+        images_payload = []
+        for image_id in candidate_ids:
+            img = img_map.get(image_id)
+            if not img: continue
+            images_payload.append({
+                "id": img.id,
+                "filename": img.filename,
+                "tags": [t.name for t in img.tags],
+                "category": img.category,
+                "location": img.location
+            })
+        ranked = await ai_service.rank_images_by_relevance_async(query, images_payload)
+        if ranked is not None:
+            sorted_ids = ranked
+
+    return [img_map[image_id] for image_id in sorted_ids if image_id in img_map]
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# 连接私有的临时表，存放文本检索命中的 id 与得分：排序、LIMIT 与游标条件都在同一条 SQL 里按数据库的排序规则完成
+_candidates = Table("tmp_search_candidates", MetaData(),
+                    Column("image_id", Integer, primary_key=True), Column("score", Float))
+
+async def _load_candidates(db: AsyncSession, hits):
+    await db.execute(text(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS tmp_search_candidates (image_id INTEGER PRIMARY KEY, score DOUBLE PRECISION)"
+    ))
+    # 连接会被连接池复用；行随请求结束时的回滚一起丢弃，这里再清一次以防万一
+    await db.execute(delete(_candidates))
+    for chunk in _chunks(hits, TEXT_SEARCH_ID_CHUNK):
+        await db.execute(insert(_candidates), [{"image_id": image_id, "score": score} for image_id, score in chunk])
+
+def _limit(stmt, limit):
+    # 多取一行，据此判断是否还有下一页
+    return stmt.limit(limit + 1) if limit else stmt
+
+async def _page(db: AsyncSession, stmt, sort_by, cursor, limit):
+    if cursor:
+        stmt = pagination.after(stmt, sort_by, cursor)
+    stmt = pagination.order_by(stmt, sort_by)
+    return (await db.scalars(_limit(stmt, limit))).all()
+
+async def _page_ranked(db: AsyncSession, stmt, cursor, limit):
+    score = _candidates.c.score
+    stmt = stmt.add_columns(score).join(_candidates, _candidates.c.image_id == models.Image.id)
+    if cursor:
+        stmt = pagination.after_ranked(stmt, score, cursor)
+    stmt = stmt.order_by(score.desc(), models.Image.id.desc())
+    rows = (await db.execute(_limit(stmt, limit))).all()
+    return [image for image, _ in rows], [s for _, s in rows]
+
+@app.get("/api/v1/images", response_model=Union[List[schemas.ImageResponse], List[schemas.ImageGridResponse]])
+async def get_my_images(
+    response: Response,
+    tag: Optional[str] = None,
+    sort_by: Optional[str] = Query("date_desc"),
+    limit: Optional[int] = Query(None, ge=1, le=IMAGE_PAGE_MAX),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = Query(None, pattern="^(full|grid)$"),
+    current_user: security.Principal = Depends(security.get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    sort_by = pagination.sort_spec(sort_by)
+    if sort_by == pagination.RELEVANCE and not tag:
+        sort_by = "date_desc"
+    stmt = select(models.Image).where(models.Image.owner_id == current_user.id)
+    if fields == "grid":
+        stmt = stmt.options(load_only(*_GRID_COLUMNS), selectinload(models.Image.renditions))
+        schema = schemas.ImageGridResponse
+    else:
+        stmt = stmt.options(*_full_image_options())
+        schema = schemas.ImageResponse
 
-    if not sorted_ids:
-        return []
+    try:
+        scores = None
+        if not tag:
+            images = await _page(db, stmt, sort_by, cursor, limit)
+        else:
+            # 索引里可能还有已删除的图片，连接后再分页，页内不会因此缺行
+            hits = await run_in_threadpool(_text_search, current_user.id, tag)
+            images = []
+            if hits:
+                await _load_candidates(db, hits)
+                if sort_by == pagination.RELEVANCE:
+                    images, scores = await _page_ranked(db, stmt, cursor, limit)
+                else:
+                    stmt = stmt.join(_candidates, _candidates.c.image_id == models.Image.id)
+                    images = await _page(db, stmt, sort_by, cursor, limit)
+    except pagination.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if limit and len(images) > limit:
+        images = images[:limit]
+        next_score = scores[limit - 1] if scores else None
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(sort_by, images[-1], next_score)
+    return [schema.model_validate(image) for image in images]
+
+@app.get("/api/v1/search/suggest", response_model=List[str])
+def suggest_terms(
+    prefix: str = Query(..., min_length=1),
+    limit: int = Query(10, ge=1, le=50),
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: Session = Depends(get_db)
+):
+    return text_index.suggest(db, current_user.id, prefix, limit)
 
-    result_images = db.query(models.Image).filter(models.Image.id.in_(sorted_ids)).all()
-    img_map = {img.id: img for img in result_images}
-    
-    final_result = []
-    for replace_id in sorted_ids:
-        if replace_id in img_map:
-            final_result.append(img_map[replace_id])
-            
-    return final_result
-
-@app.get("/api/v1/images", response_model=List[schemas.ImageResponse])
-def get_my_images(
+@app.get("/api/v1/images/duplicates", response_model=List[schemas.DuplicateCluster])
+def list_duplicates(
+    max_distance: int = Query(dedupe.PHASH_MAX_DISTANCE, ge=0, le=16),
+    current_user: security.Principal = Depends(security.get_current_user),
+    db: Session = Depends(get_db)
+):
+    clusters = dedupe.clusters(db, current_user.id, max_distance)
+    ids = [image_id for cluster in clusters for image_id in cluster]
+    images = {}
+    for chunk in _chunks(ids, TEXT_SEARCH_ID_CHUNK):
+        query = db.query(models.Image).options(selectinload(models.Image.renditions))
+        images.update((image.id, image) for image in query.filter(models.Image.id.in_(chunk)))
+    return [
+        schemas.DuplicateCluster(images=[schemas.ImageGridResponse.model_validate(images[i]) for i in cluster if i in images])
+        for cluster in clusters
+    ]
+
+@app.get("/api/v1/images/facets", response_model=schemas.FacetsResponse)
+async def image_facets(
     tag: Optional[str] = None,
-    sort_by: Optional[str] = Query("date_desc"),
-    current_user: models.User = Depends(security.get_current_user),
+    location: Optional[str] = None,
+    category: Optional[str] = None,
+    year: Optional[int] = Query(None, ge=1900, le=2999),
+    month: Optional[int] = Query(None, ge=1, le=12),
+    current_user: security.Principal = Depends(security.get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if month and not year:
+        raise HTTPException(status_code=400, detail="按月筛选需同时指定年份")
+    return await facets.get_facets(db, current_user.id, tag, location, category, year, month)
+
+@app.get("/api/v1/images/{image_id}/similar", response_model=List[schemas.SimilarImageResponse])
+def similar_images(
+    image_id: int,
+    limit: int = Query(20, ge=1, le=200),
+    current_user: security.Principal = Depends(security.get_current_user),
     db: Session = Depends(get_db)
 ):
-    query = db.query(models.Image).filter(models.Image.owner_id == current_user.id)
-    if tag:
-        query = query.filter(
-            (models.Image.tags.any(models.Tag.name.like(f"%{tag}%"))) |
-            (models.Image.filename.like(f"%{tag}%")) | 
-            (models.Image.location.like(f"%{tag}%")) | 
-            (models.Image.category.like(f"%{tag}%"))
-        )
-    if sort_by == "date_asc": query = query.order_by(models.Image.capture_date.asc())
-    elif sort_by == "view_desc": query = query.order_by(models.Image.view_count.desc())
-    elif sort_by == "name_asc": query = query.order_by(models.Image.filename.asc())
-    else: query = query.order_by(models.Image.capture_date.desc())
-    return query.all()
+    image = db.query(models.Image).filter(models.Image.id == image_id, models.Image.owner_id == current_user.id).first()
+    if not image: raise HTTPException(404, detail="Not Found")
+    if not image.visual:
+        raise HTTPException(409, detail="该图片的视觉特征尚未生成，请稍后再试")
+
+    hits = visual_index.similar(db, current_user.id, image, limit)
+    ids = [hit_id for hit_id, _ in hits]
+    query = db.query(models.Image).options(selectinload(models.Image.renditions), load_only(*_GRID_COLUMNS))
+    images = {i.id: i for i in query.filter(models.Image.id.in_(ids), models.Image.owner_id == current_user.id)} if ids else {}
+    return [
+        schemas.SimilarImageResponse(image=schemas.ImageGridResponse.model_validate(images[hit_id]), score=round(score, 4))
+        for hit_id, score in hits if hit_id in images
+    ]
 
 @app.get("/api/v1/images/{image_id}", response_model=schemas.ImageResponse)
-def get_image_detail(image_id: int, current_user: models.User = Depends(security.get_current_user), db: Session = Depends(get_db)):
-    image = db.query(models.Image).filter(models.Image.id == image_id).first()
+async def get_image_detail(image_id: int, current_user: security.Principal = Depends(security.get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    image = (await db.scalars(
+        select(models.Image).options(*_full_image_options()).where(models.Image.id == image_id)
+    )).first()
+    if not image: raise HTTPException(404, detail="Not Found")
+    view_counter.record(image_id)
+    result = schemas.ImageResponse.model_validate(image)
+    result.view_count = (result.view_count or 0) + view_counter.pending(image_id)
+    return result
+
+@app.get("/api/v1/images/{image_id}/status", response_model=schemas.ImageStatusResponse)
+def get_image_status(image_id: int, current_user: security.Principal = Depends(security.get_current_user), db: Session = Depends(get_db)):
+    image = db.query(models.Image).filter(models.Image.id == image_id, models.Image.owner_id == current_user.id).first()
     if not image: raise HTTPException(404, detail="Not Found")
-    image.view_count += 1
-    db.commit()
-    db.refresh(image)
     return image
 
+def _get_owned_image(db: Session, image_id: int, owner_id: int):
+    return db.query(models.Image).filter(models.Image.id == image_id, models.Image.owner_id == owner_id).first()
+
+@app.get("/api/v1/images/{image_id}/render")
+async def render_image(
+    image_id: int,
+    request: Request,
+    w: Optional[int] = Query(None, ge=1, le=renderer.RENDER_MAX_EDGE),
+    h: Optional[int] = Query(None, ge=1, le=renderer.RENDER_MAX_EDGE),
+    fmt: str = Query("webp"),
+    q: int = Query(80, ge=1, le=100),
+    current_user: security.Principal = Depends(security.get_current_user_or_cookie),
+    db: Session = Depends(get_db)
+):
+    if fmt not in renderer.RENDER_FORMATS:
+        raise HTTPException(400, detail=f"不支持的格式: {fmt}")
+    if not w and not h:
+        raise HTTPException(400, detail="必须指定 w 或 h")
+
+    image = await run_in_threadpool(_get_owned_image, db, image_id, current_user.id)
+    if not image: raise HTTPException(404, detail="Not Found")
+    try:
+        source_path = await run_in_threadpool(storage.local_path, image.file_path)
+    except FileNotFoundError:
+        raise HTTPException(404, detail="服务器磁盘上找不到该文件")
+
+    try:
+        key, path = await renderer.renderer.render(source_path, image.content_hash or image.file_path, w, h, fmt, q)
+    except Exception as e:
+        raise HTTPException(500, detail=f"渲染失败: {str(e)}")
+
+    etag = f'"{key}"'
+    mtime = os.stat(path).st_mtime
+    headers = {
+        "ETag": etag,
+        "Last-Modified": utils.http_date(mtime),
+        "Cache-Control": "private, max-age=31536000, immutable",
+    }
+    if utils.is_not_modified(request.headers, etag, mtime):
+        return Response(status_code=304, headers=headers)
+    if STATIC_SERVE_MODE == "accel":
+        headers["X-Accel-Redirect"] = f"{STATIC_ACCEL_PREFIX}/render_cache/{os.path.relpath(path, renderer.RENDER_CACHE_DIR)}"
+        return Response(headers=headers, media_type=renderer.RENDER_FORMATS[fmt][1])
+    return FileResponse(path, media_type=renderer.RENDER_FORMATS[fmt][1], headers=headers)
+
 @app.put("/api/v1/images/{image_id}", response_model=schemas.ImageResponse)
-def update_image_info(image_id: int, info: schemas.ImageUpdate, current_user: models.User = Depends(security.get_current_user), db: Session = Depends(get_db)):
+def update_image_info(image_id: int, info: schemas.ImageUpdate, current_user: security.Principal = Depends(security.get_current_user), db: Session = Depends(get_db)):
     image = db.query(models.Image).filter(models.Image.id == image_id, models.Image.owner_id == current_user.id).first()
     if not image: raise HTTPException(404, detail="Not Found")
     if info.filename: image.filename = info.filename
@@ -233,45 +802,36 @@ def update_image_info(image_id: int, info: schemas.ImageUpdate, current_user: mo
     if info.capture_date: image.capture_date = info.capture_date
     db.commit()
     db.refresh(image)
+    image_events.changed(db, image)
     return image
 
 @app.delete("/api/v1/images/{image_id}/tags/{tag_id}")
-def delete_tag_from_image(image_id: int, tag_id: int, current_user: models.User = Depends(security.get_current_user), db: Session = Depends(get_db)):
+def delete_tag_from_image(image_id: int, tag_id: int, current_user: security.Principal = Depends(security.get_current_user), db: Session = Depends(get_db)):
     image = db.query(models.Image).filter(models.Image.id == image_id).first()
     tag = db.query(models.Tag).filter(models.Tag.id == tag_id).first()
     if image and tag and tag in image.tags:
         image.tags.remove(tag)
         db.commit()
+        image_events.changed(db, image)
     return {"msg": "Deleted"}
 
 @app.post("/api/v1/images/{image_id}/tags", response_model=schemas.ImageResponse)
-def add_tag_to_image(image_id: int, tag_name: str, current_user: models.User = Depends(security.get_current_user), db: Session = Depends(get_db)):
+def add_tag_to_image(image_id: int, tag_name: str, current_user: security.Principal = Depends(security.get_current_user), db: Session = Depends(get_db)):
     image = db.query(models.Image).filter(models.Image.id == image_id).first()
-    clean_name = tag_name.strip().lower()
-    tag = db.query(models.Tag).filter(models.Tag.name == clean_name).first()
-    if not tag:
-        try:
-            tag = models.Tag(name=clean_name)
-            db.add(tag)
-            db.commit()
-        except Exception:
-            db.rollback()
-            tag = db.query(models.Tag).filter(models.Tag.name == clean_name).first()
-            
-    if tag and tag not in image.tags:
-        image.tags.append(tag)
+    if not image: raise HTTPException(404, detail="Not Found")
+    if tag_service.add_tags(db, image.id, [tag_name]):
         db.commit()
-        db.refresh(image)
+        image_events.changed(db, image)
     return image
 
 @app.delete("/api/v1/images/{image_id}", status_code=204)
-def delete_image(image_id: int, current_user: models.User = Depends(security.get_current_user), db: Session = Depends(get_db)):
+def delete_image(image_id: int, current_user: security.Principal = Depends(security.get_current_user), db: Session = Depends(get_db)):
     image = db.query(models.Image).filter(models.Image.id == image_id, models.Image.owner_id == current_user.id).first()
     if image:
-        try:
-            if os.path.exists(image.file_path): os.remove(image.file_path)
-            if image.thumbnail_path: os.remove(image.thumbnail_path)
-        except: pass
+        owner_id = image.owner_id
+        orphans = storage.release(db, image)
         db.delete(image)
         db.commit()
+        image_events.removed(db, owner_id, image_id)
+        storage.collect(orphans)
     return None
@@ -0,0 +1,177 @@
+import os
+import hmac
+import time
+import heapq
+import ipaddress
+import contextvars
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from sqlalchemy import event
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+SLOW_REQUEST_TOP_QUERIES = int(os.getenv("SLOW_REQUEST_TOP_QUERIES", "5"))
+# /metrics 只对白名单网段开放，或携带 Authorization: Bearer <METRICS_TOKEN>；后端端口直接对外发布时不能裸奔
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(n.strip(), strict=False)
+    for n in os.getenv("METRICS_ALLOWED_NETWORKS", "127.0.0.1/32,::1/128").split(",") if n.strip()
+]
+_SQL_PREVIEW = 300
+
+_FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_SLOW_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+
+HTTP_SECONDS = Histogram("sims_http_request_duration_seconds", "HTTP 请求耗时", ["method", "route", "status"])
+HTTP_DB_QUERIES = Histogram("sims_http_request_db_queries", "单个请求执行的 SQL 条数", ["route"],
+                            buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144))
+HTTP_DB_SECONDS = Histogram("sims_http_request_db_seconds", "单个请求的 SQL 总耗时", ["route"], buckets=_FAST_BUCKETS)
+DB_QUERY_SECONDS = Histogram("sims_db_query_duration_seconds", "单条 SQL 耗时", ["engine"], buckets=_FAST_BUCKETS)
+STAGE_SECONDS = Histogram("sims_image_stage_duration_seconds", "图片处理各阶段耗时", ["stage"], buckets=_FAST_BUCKETS)
+AI_SECONDS = Histogram("sims_ai_request_duration_seconds", "单次模型 HTTP 调用耗时（含失败的尝试）", ["endpoint", "outcome"],
+                       buckets=_SLOW_BUCKETS)
+AI_CALL_SECONDS = Histogram("sims_ai_call_duration_seconds", "业务层模型调用耗时（含排队、限流与重试）", ["operation"],
+                            buckets=_SLOW_BUCKETS)
+AI_TOKENS = Counter("sims_ai_tokens_total", "模型返回的 token 用量", ["type"])
+JOB_SECONDS = Histogram("sims_job_duration_seconds", "后台任务耗时", ["kind", "outcome"], buckets=_SLOW_BUCKETS)
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "slowest")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest: List[Tuple[float, str]] = []
+
+    def add_query(self, statement: str, seconds: float):
+        self.queries += 1
+        self.db_seconds += seconds
+        item = (seconds, statement)
+        if len(self.slowest) < SLOW_REQUEST_TOP_QUERIES:
+            heapq.heappush(self.slowest, item)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+
+# 线程池里的同步依赖与端点会复制请求上下文，所以同一个 RequestStats 能收集到整个请求的 SQL
+_current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextmanager
+def timed_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def collector(fn):
+    """注册一个在抓取时调用的函数，返回 prometheus_client 的 MetricFamily 列表。"""
+    class _Collector:
+        def describe(self):
+            # 返回空列表，避免注册时就调用 collect（队列深度等需要查库）
+            return []
+
+        def collect(self):
+            try:
+                yield from fn()
+            except Exception as e:
+                print(f"[Metrics] 采集 {fn.__module__}.{fn.__name__} 失败: {e}")
+
+    REGISTRY.register(_Collector())
+    return fn
+
+
+def instrument_engine(engine, name: str):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("metrics_query_start")
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        DB_QUERY_SECONDS.labels(name).observe(seconds)
+        stats = _current.get()
+        if stats is not None:
+            stats.add_query(statement, seconds)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        starts = context.connection.info.get("metrics_query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+def _route_label(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def _log_slow(method: str, path: str, status: int, seconds: float, stats: RequestStats):
+    print(f"[Perf] 慢请求 {method} {path} -> {status} 耗时 {seconds * 1000:.0f}ms，"
+          f"SQL {stats.queries} 条共 {stats.db_seconds * 1000:.0f}ms")
+    for query_seconds, statement in sorted(stats.slowest, reverse=True):
+        sql = " ".join(statement.split())
+        print(f"[Perf]   {query_seconds * 1000:.1f}ms  {sql[:_SQL_PREVIEW]}")
+
+
+class MetricsMiddleware:
+    """记录每个路由的耗时与 SQL 次数 / 耗时，超过 SLOW_REQUEST_MS 的请求连同最慢的几条 SQL 一起打印。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        status = 500
+        streaming = False
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                streaming = any(k == b"content-type" and v.startswith(b"text/event-stream") for k, v in message.get("headers", []))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            seconds = time.perf_counter() - start
+            route = _route_label(scope)
+            HTTP_SECONDS.labels(scope["method"], route, str(status)).observe(seconds)
+            HTTP_DB_QUERIES.labels(route).observe(stats.queries)
+            HTTP_DB_SECONDS.labels(route).observe(stats.db_seconds)
+            # SSE 长连接的耗时取决于生成长度，不算慢请求
+            if seconds * 1000 >= SLOW_REQUEST_MS and not streaming:
+                _log_slow(scope["method"], scope["path"], status, seconds, stats)
+
+
+def allowed(client_host: Optional[str], authorization: Optional[str]) -> bool:
+    if METRICS_TOKEN and authorization and hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}"):
+        return True
+    try:
+        address = ipaddress.ip_address(client_host or "")
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOWED_NETWORKS)
+
+
+def render() -> Tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
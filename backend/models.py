@@ -1,8 +1,11 @@
-from sqlalchemy import Boolean, Column, Integer, String, BigInteger, TIMESTAMP, ForeignKey, Table, Text
+from sqlalchemy import Boolean, Column, Integer, String, BigInteger, TIMESTAMP, ForeignKey, Table, Text, Index, Float, LargeBinary
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
 
+# SQLite 只有 INTEGER PRIMARY KEY 才会自增，本地压测 / 开发库用 Integer，MySQL 仍是 BIGINT
+BigId = BigInteger().with_variant(Integer, "sqlite")
+
 image_tags = Table(
     'image_tags',
     Base.metadata,
@@ -13,7 +16,7 @@ image_tags = Table(
 class User(Base):
     __tablename__ = "users"
 
-    id = Column(BigInteger, primary_key=True, index=True, autoincrement=True)
+    id = Column(BigId, primary_key=True, index=True, autoincrement=True)
     username = Column(String(50), unique=True, nullable=False, index=True)
     email = Column(String(100), unique=True, nullable=False, index=True)
     password_hash = Column(String(255), nullable=False)
@@ -34,8 +37,8 @@ class Image(Base):
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     filename = Column(String(255), nullable=False)
-    file_path = Column(String(255), nullable=False)
-    thumbnail_path = Column(String(255), nullable=True)
+    file_path = Column(String(255), nullable=False, index=True)
+    thumbnail_path = Column(String(255), nullable=True, index=True)
     file_size = Column(Integer, nullable=False)
     width = Column(Integer, nullable=True)
     height = Column(Integer, nullable=True)
@@ -43,8 +46,74 @@ class Image(Base):
     location = Column(String(255), nullable=True)
     category = Column(String(50), default="其他")
     view_count = Column(Integer, default=0)
-    owner_id = Column(BigInteger, ForeignKey("users.id"))
+    owner_id = Column(BigId, ForeignKey("users.id"))
     created_at = Column(TIMESTAMP, server_default=func.now())
+    tag_status = Column(String(20), default="pending")
+    content_hash = Column(String(64), nullable=True, index=True)
+    phash = Column(String(16), nullable=True, index=True)
+    visual = Column(LargeBinary, nullable=True)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
 
     owner = relationship("User", back_populates="images")
     tags = relationship("Tag", secondary=image_tags, back_populates="images")
+    renditions = relationship("ImageDerivative", back_populates="image", cascade="all, delete-orphan", order_by="ImageDerivative.width")
+
+    __table_args__ = (
+        Index("ix_images_owner_capture", "owner_id", "capture_date", "id"),
+        Index("ix_images_owner_views", "owner_id", "view_count", "id"),
+        Index("ix_images_owner_filename", "owner_id", "filename", "id"),
+        Index("ix_images_owner_phash", "owner_id", "phash"),
+    )
+
+class ImageDerivative(Base):
+    __tablename__ = "image_derivatives"
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    image_id = Column(Integer, ForeignKey("images.id"), nullable=False, index=True)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    format = Column(String(10), nullable=False)
+    path = Column(String(255), nullable=False, index=True)
+    file_size = Column(Integer, nullable=False)
+
+    image = relationship("Image", back_populates="renditions")
+
+class Blob(Base):
+    __tablename__ = "blobs"
+
+    content_hash = Column(String(64), primary_key=True)
+    path = Column(String(255), nullable=False)
+    file_size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+
+class AIResult(Base):
+    __tablename__ = "ai_results"
+
+    cache_key = Column(String(64), primary_key=True)
+    kind = Column(String(20), nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+
+class GeocodeCache(Base):
+    __tablename__ = "geocode_cache"
+
+    grid_key = Column(String(64), primary_key=True)
+    name = Column(String(255), nullable=True)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    kind = Column(String(20), nullable=False)
+    image_id = Column(Integer, nullable=True, index=True)
+    status = Column(String(20), nullable=False, default="queued")
+    attempts = Column(Integer, nullable=False, default=0)
+    run_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    locked_until = Column(TIMESTAMP, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+
+    __table_args__ = (Index("ix_jobs_status_run_at", "status", "run_at"),)
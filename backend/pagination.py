@@ -0,0 +1,82 @@
+import json
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+import models
+
+SORT_KEYS = {
+    "date_desc": (models.Image.capture_date, True),
+    "date_asc": (models.Image.capture_date, False),
+    "view_desc": (models.Image.view_count, True),
+    "name_asc": (models.Image.filename, False),
+}
+RELEVANCE = "relevance"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def sort_spec(sort_by):
+    return sort_by if sort_by in SORT_KEYS or sort_by == RELEVANCE else "date_desc"
+
+
+def encode_cursor(sort_by, image, score=None):
+    value = score if sort_by == RELEVANCE else getattr(image, SORT_KEYS[sort_by][0].key)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort_by, value, image.id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(sort_by, cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, last_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor("无效的分页游标")
+    if cursor_sort != sort_by or not isinstance(last_id, int):
+        raise InvalidCursor("分页游标与排序方式不匹配")
+    if sort_by == RELEVANCE:
+        if not isinstance(value, (int, float)):
+            raise InvalidCursor("无效的分页游标")
+        return value, last_id
+    if value is not None and SORT_KEYS[sort_by][0] is models.Image.capture_date:
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise InvalidCursor("无效的分页游标")
+    return value, last_id
+
+
+def order_by(query, sort_by):
+    column, descending = SORT_KEYS[sort_by]
+    if descending:
+        return query.order_by(column.desc(), models.Image.id.desc())
+    return query.order_by(column.asc(), models.Image.id.asc())
+
+
+def after(query, sort_by, cursor):
+    # NULL 在 MySQL / SQLite 中都按最小值排序：升序排在最前，降序排在最后
+    column, descending = SORT_KEYS[sort_by]
+    value, last_id = decode_cursor(sort_by, cursor)
+    image_id = models.Image.id
+    if descending:
+        if value is None:
+            return query.filter(column.is_(None), image_id < last_id)
+        return query.filter(or_(
+            column < value,
+            and_(column == value, image_id < last_id),
+            column.is_(None),
+        ))
+    if value is None:
+        return query.filter(or_(and_(column.is_(None), image_id > last_id), column.isnot(None)))
+    return query.filter(or_(column > value, and_(column == value, image_id > last_id)))
+
+
+def after_ranked(query, score, cursor):
+    # 按 (score desc, id desc) 排序
+    value, last_id = decode_cursor(RELEVANCE, cursor)
+    return query.filter(or_(score < value, and_(score == value, models.Image.id < last_id)))
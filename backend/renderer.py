@@ -0,0 +1,125 @@
+import os
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import utils
+
+RENDER_CACHE_DIR = os.path.join(utils.DATA_DIR, "render_cache")
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+RENDER_MAX_EDGE = int(os.getenv("RENDER_MAX_EDGE", "4096"))
+RENDER_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "png": ("PNG", "image/png", "png"),
+    "avif": ("AVIF", "image/avif", "avif"),
+}
+
+
+class DiskLRU:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                found.append((stat.st_atime, os.path.relpath(path, self.directory), stat.st_size))
+        for _, rel, size in sorted(found):
+            self._entries[rel] = size
+            self.total_bytes += size
+
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.directory, name[:2], name)
+
+    def get(self, name: str) -> Optional[str]:
+        rel = os.path.join(name[:2], name)
+        with self._lock:
+            if rel not in self._entries:
+                return None
+            self._entries.move_to_end(rel)
+        path = self.path_for(name)
+        if not os.path.exists(path):
+            with self._lock:
+                self.total_bytes -= self._entries.pop(rel, 0)
+            return None
+        return path
+
+    def add(self, name: str, size: int):
+        rel = os.path.join(name[:2], name)
+        evicted = []
+        with self._lock:
+            self.total_bytes += size - self._entries.get(rel, 0)
+            self._entries[rel] = size
+            self._entries.move_to_end(rel)
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_rel, old_size = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_rel)
+        for old_rel in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old_rel))
+            except FileNotFoundError:
+                pass
+
+
+class Renderer:
+    def __init__(self, cache: DiskLRU):
+        self.cache = cache
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def variant_key(source_id: str, width: Optional[int], height: Optional[int], fmt: str, quality: int) -> str:
+        raw = f"{source_id}|{width or 0}|{height or 0}|{fmt}|{quality}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    async def render(self, source_path: str, source_id: str, width: Optional[int], height: Optional[int], fmt: str, quality: int):
+        pil_format, _, ext = RENDER_FORMATS[fmt]
+        key = self.variant_key(source_id, width, height, fmt, quality)
+        name = f"{key}.{ext}"
+
+        while True:
+            path = self.cache.get(name)
+            if path:
+                return key, path
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            # wait 不会取消 pending；渲染方被取消时 pending 随之取消，由本请求接手重新渲染
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                return key, pending.result()
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            path = self.cache.path_for(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            size = await utils.run_cpu(utils.render_variant, source_path, path, width, height, pil_format, quality)
+            self.cache.add(name, size)
+            future.set_result(path)
+            return key, path
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+            # CancelledError 不是 Exception，不取消的话等待者会一直挂着
+            if not future.done():
+                future.cancel()
+
+
+renderer = Renderer(DiskLRU(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES))
@@ -39,6 +39,14 @@ class ImageUpdate(BaseModel):
     location: Optional[str] = None
     category: Optional[str] = None
 
+class RenditionResponse(BaseModel):
+    width: int
+    height: int
+    format: str
+    path: str
+    class Config:
+        from_attributes = True
+
 class ImageResponse(BaseModel):
     id: int
     filename: str
@@ -54,8 +62,68 @@ class ImageResponse(BaseModel):
     location: Optional[str] = None
     category: Optional[str] = None
     view_count: int = 0
+    tag_status: Optional[str] = None
     
     tags: List[TagResponse] = [] 
+    renditions: List[RenditionResponse] = []
+
+    class Config:
+        from_attributes = True
+
+class ImageGridResponse(BaseModel):
+    id: int
+    filename: str
+    file_path: str
+    thumbnail_path: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    capture_date: Optional[datetime] = None
+    view_count: int = 0
+    renditions: List[RenditionResponse] = []
 
     class Config:
         from_attributes = True
+
+class ImageStatusResponse(BaseModel):
+    id: int
+    tag_status: Optional[str] = None
+    tags: List[TagResponse] = []
+
+    class Config:
+        from_attributes = True
+
+class BatchUploadItem(BaseModel):
+    filename: str
+    ok: bool
+    image: Optional[ImageResponse] = None
+    error: Optional[str] = None
+    duplicate_of: Optional[int] = None
+
+class BatchUploadResponse(BaseModel):
+    total: int
+    succeeded: int
+    failed: int
+    results: List[BatchUploadItem]
+
+class DuplicateCluster(BaseModel):
+    images: List[ImageGridResponse]
+
+class SimilarImageResponse(BaseModel):
+    image: ImageGridResponse
+    score: float
+
+class FacetCount(BaseModel):
+    value: str
+    count: int
+
+class DateFacet(BaseModel):
+    year: int
+    month: int
+    count: int
+
+class FacetsResponse(BaseModel):
+    total: int
+    tags: List[FacetCount]
+    locations: List[FacetCount]
+    categories: List[FacetCount]
+    dates: List[DateFacet]
@@ -0,0 +1,339 @@
+import os
+import re
+import json
+import uuid
+import zlib
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session, selectinload
+
+import models, image_events, metrics
+from utils import DATA_DIR, PerOwnerRegistry, Singleton
+
+try:
+    import fcntl
+except ImportError:  # Windows 上只跑单进程，不需要跨进程锁
+    fcntl = None
+
+INDEX_DIR = os.path.join(DATA_DIR, "index")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "local")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "1024"))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+SEARCH_BLOCK_ROWS = 16384
+
+_TOKEN_RE = re.compile(r"[\w\+#]+", re.UNICODE)
+_CJK_RE = re.compile(r"[㐀-鿿豈-﫿]")
+DEFAULT_CATEGORY = "其他"
+
+
+def image_text(image) -> str:
+    stem = os.path.splitext(image.filename or "")[0]
+    category = image.category if image.category != DEFAULT_CATEGORY else None
+    parts = [t.name for t in image.tags] + [category, image.location, stem]
+    return " ".join(p for p in parts if p)
+
+
+class HashingEmbedder:
+    """离线可用的本地 embedder：词 + 字符 n-gram 特征哈希到定长向量。"""
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"hashing-v1-{dim}"
+
+    def _features(self, text: str):
+        for word in _TOKEN_RE.findall(text.lower()):
+            yield "w:" + word, 2.0
+            if _CJK_RE.search(word):
+                for ch in word:
+                    yield "u:" + ch, 0.5
+                for i in range(len(word) - 1):
+                    yield "b:" + word[i:i + 2], 1.0
+            else:
+                padded = f"#{word}#"
+                for i in range(len(padded) - 2):
+                    yield "t:" + padded[i:i + 3], 1.0
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if (h // self.dim) & 1 else -1.0
+                out[row, h % self.dim] += sign * weight
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+class OpenAIEmbedder:
+    def __init__(self, model: str = EMBEDDING_MODEL, dim: int = EMBEDDING_DIM):
+        self.model = model
+        self.dim = dim
+        self.name = f"openai-{model}-{dim}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        import ai_service
+
+        with metrics.AI_CALL_SECONDS.labels("embeddings").time():
+            response = ai_service.client.embeddings(
+                model=self.model, input=[t or " " for t in texts], dimensions=self.dim
+            )
+        out = np.array([item.embedding for item in response.data], dtype=np.float32)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+def default_embedder():
+    if EMBEDDING_BACKEND == "openai":
+        return OpenAIEmbedder()
+    return HashingEmbedder()
+
+
+class VectorIndex:
+    """单个 owner 的向量表：ids / vectors 两个 memmap 文件 + meta.json，行数按倍增扩容。
+
+    API 进程与独立部署的任务 worker 进程会读写同一组文件：每次操作都持有目录下的文件锁
+    （写独占、读共享），并在 meta 的 version 与本进程所见不同时重新加载。
+    """
+
+    def __init__(self, directory: str, dim: int, model: str, dtype=np.float32):
+        self.directory = directory
+        self.dim = dim
+        self.model = model
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.capacity = 0
+        self.version = None
+        self._ids = None
+        self._vecs = None
+        self._pos: Dict[int, int] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.directory, "meta.json")
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, "lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_meta(self) -> Optional[dict]:
+        try:
+            with open(self._meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _sync(self):
+        # 其它进程写过（包括重建时删掉重建了文件），按新的 meta 重新映射
+        meta = self._read_meta()
+        if meta is not None and meta.get("version") != self.version:
+            self._apply_meta(meta)
+
+    def _open(self, capacity: int):
+        ids_path = os.path.join(self.directory, "ids.dat")
+        vecs_path = os.path.join(self.directory, "vectors.dat")
+        for path, size in ((ids_path, capacity * 8), (vecs_path, capacity * self.dim * self.dtype.itemsize)):
+            with open(path, "ab") as f:
+                if f.tell() < size:
+                    f.truncate(size)
+        self._ids = np.memmap(ids_path, dtype=np.int64, mode="r+", shape=(capacity,))
+        self._vecs = np.memmap(vecs_path, dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    def _apply_meta(self, meta: dict) -> bool:
+        if meta.get("dim") != self.dim or meta.get("model") != self.model or meta.get("dtype") != self.dtype.name:
+            return False
+        self._ids = self._vecs = None
+        self._open(max(meta["capacity"], 1))
+        self.count = meta["count"]
+        self.version = meta.get("version")
+        self._pos = {int(i): row for row, i in enumerate(self._ids[:self.count])}
+        return True
+
+    def load(self) -> bool:
+        with self._locked(exclusive=False):
+            meta = self._read_meta()
+            return meta is not None and self._apply_meta(meta)
+
+    def reset(self, capacity: int = 64):
+        with self._locked(exclusive=True):
+            self.count = 0
+            self._pos = {}
+            self._ids = self._vecs = None
+            for name in ("ids.dat", "vectors.dat"):
+                path = os.path.join(self.directory, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            self._open(capacity)
+            self._save_meta()
+
+    def _save_meta(self):
+        self._ids.flush()
+        self._vecs.flush()
+        self.version = uuid.uuid4().hex
+        tmp = self._meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"dim": self.dim, "model": self.model, "dtype": self.dtype.name,
+                       "count": self.count, "capacity": self.capacity, "version": self.version}, f)
+        os.replace(tmp, self._meta_path)
+
+    def _grow(self, needed: int):
+        if needed <= self.capacity:
+            return
+        new_capacity = max(needed, self.capacity * 2, 64)
+        self._ids.flush()
+        self._vecs.flush()
+        self._ids = self._vecs = None
+        self._open(new_capacity)
+
+    def upsert_many(self, ids: List[int], vectors: np.ndarray):
+        with self._locked(exclusive=True):
+            self._sync()
+            self._upsert(ids, vectors)
+
+    def _upsert(self, ids: List[int], vectors: np.ndarray):
+        self._grow(self.count + len(ids))
+        for image_id, vec in zip(ids, vectors):
+            row = self._pos.get(image_id)
+            if row is None:
+                row = self.count
+                self.count += 1
+                self._pos[image_id] = row
+                self._ids[row] = image_id
+            self._vecs[row] = vec
+        self._save_meta()
+
+    def remove(self, image_id: int):
+        with self._locked(exclusive=True):
+            self._sync()
+            self._remove(image_id)
+
+    def _remove(self, image_id: int):
+        row = self._pos.pop(image_id, None)
+        if row is None:
+            return
+        last = self.count - 1
+        if row != last:
+            moved = int(self._ids[last])
+            self._ids[row] = moved
+            self._vecs[row] = self._vecs[last]
+            self._pos[moved] = row
+        self.count = last
+        self._save_meta()
+
+    def search(self, query: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        with self._locked(exclusive=False):
+            self._sync()
+            return self._search(query, top_k)
+
+    def _search(self, query: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        if self.count == 0:
+            return []
+        query = query.astype(np.float32)
+        if self.dtype == np.float32:
+            scores = np.asarray(self._vecs[:self.count]) @ query
+        else:
+            # 量化向量分块转 float32 再走 BLAS，避免整表展开成 4 倍大小的临时数组；
+            # 每行的量化比例不同，除以行长度才是余弦
+            scores = np.empty(self.count, dtype=np.float32)
+            for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+                block = self._vecs[start:min(start + SEARCH_BLOCK_ROWS, self.count)].astype(np.float32)
+                norms = np.sqrt(np.einsum("ij,ij->i", block, block))
+                norms[norms == 0] = 1.0
+                scores[start:start + len(block)] = (block @ query) / norms
+        k = min(top_k, self.count)
+        if k < self.count:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(self.count)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(self._ids[i]), float(scores[i])) for i in top]
+
+
+class SearchIndex:
+    def __init__(self, root: str = INDEX_DIR, embedder=None):
+        self.root = root
+        self.embedder = embedder or default_embedder()
+        self._indexes = PerOwnerRegistry(self._load)
+
+    def _load(self, db: Session, owner_id: int) -> VectorIndex:
+        index = VectorIndex(os.path.join(self.root, str(owner_id)), self.embedder.dim, self.embedder.name)
+        total = db.query(models.Image).filter(models.Image.owner_id == owner_id).count()
+        if not index.load() or index.count != total:
+            self._rebuild(db, owner_id, index)
+        return index
+
+    def _rebuild(self, db: Session, owner_id: int, index: VectorIndex, batch_size: int = 256):
+        index.reset()
+        query = (
+            db.query(models.Image)
+            .options(selectinload(models.Image.tags))
+            .filter(models.Image.owner_id == owner_id)
+            .order_by(models.Image.id)
+        )
+        batch = []
+        for image in query.yield_per(batch_size):
+            batch.append(image)
+            if len(batch) >= batch_size:
+                index.upsert_many([i.id for i in batch], self.embedder.embed([image_text(i) for i in batch]))
+                batch = []
+        if batch:
+            index.upsert_many([i.id for i in batch], self.embedder.embed([image_text(i) for i in batch]))
+        print(f"[Index] 重建 owner {owner_id} 的向量索引，共 {index.count} 张")
+
+    def index_image(self, db: Session, image):
+        with self._indexes.lock(image.owner_id):
+            index = self._indexes.get(db, image.owner_id)
+            index.upsert_many([image.id], self.embedder.embed([image_text(image)]))
+
+    def remove_image(self, db: Session, owner_id: int, image_id: int):
+        with self._indexes.lock(owner_id):
+            self._indexes.get(db, owner_id).remove(image_id)
+
+    def search(self, db: Session, owner_id: int, query: str, top_k: int) -> List[Tuple[int, float]]:
+        query_vec = self.embedder.embed([query])[0]
+        with self._indexes.lock(owner_id):
+            return self._indexes.get(db, owner_id).search(query_vec, top_k)
+
+
+_default = Singleton(SearchIndex)
+
+
+def get_index() -> SearchIndex:
+    return _default.get()
+
+
+def set_embedder(embedder):
+    _default.set(SearchIndex(embedder=embedder))
+
+
+@image_events.on_changed
+def index_image(db: Session, image):
+    try:
+        get_index().index_image(db, image)
+    except Exception as e:
+        print(f"[Index] 更新索引失败 (image {image.id}): {e}")
+
+
+@image_events.on_removed
+def remove_image(db: Session, owner_id: int, image_id: int):
+    try:
+        get_index().remove_image(db, owner_id, image_id)
+    except Exception as e:
+        print(f"[Index] 删除索引失败 (image {image_id}): {e}")
+
+
+def search(db: Session, owner_id: int, query: str, top_k: int) -> List[Tuple[int, float]]:
+    return get_index().search(db, owner_id, query, top_k)
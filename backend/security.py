@@ -1,17 +1,38 @@
+import os
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import jwt, JWTError
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
 import database, models
+from utils import LRUCache
 
 SECRET_KEY = "test_for_smart_image_system"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/login", auto_error=False)
+ACCESS_TOKEN_COOKIE = "access_token"
+
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+
+@dataclass(frozen=True)
+class Principal:
+    """已认证用户的只读快照，可跨请求缓存，不绑定任何 Session。"""
+    id: int
+    username: str
+    email: str
+    is_active: bool
+
+_principals = LRUCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+_STALE = "security.stale_principals"
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -31,21 +52,82 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
-    credentials_exception = HTTPException(
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _decode_token(token: Optional[str]) -> dict:
+    credentials_exception = _credentials_exception()
+    if not token:
+        raise credentials_exception
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+        if payload.get("sub") is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-        
-    user = db.query(models.User).filter(models.User.username == username).first()
+    return payload
+
+def _cache_key(payload: dict):
+    # 新 token 带 uid，按 id 缓存；旧 token 只有 sub，按用户名缓存
+    uid = payload.get("uid")
+    return ("id", uid) if isinstance(uid, int) else ("name", payload["sub"])
+
+def _user_query(payload: dict):
+    uid = payload.get("uid")
+    if isinstance(uid, int):
+        return select(models.User).where(models.User.id == uid)
+    return select(models.User).where(models.User.username == payload["sub"])
+
+def _remember(key, user: Optional[models.User]) -> Principal:
     if user is None:
-        raise credentials_exception
-    return user
+        raise _credentials_exception()
+    principal = Principal(id=user.id, username=user.username, email=user.email, is_active=user.is_active)
+    _principals.set(key, principal)
+    return principal
+
+def _principal_from_token(token: Optional[str], db: Session) -> Principal:
+    payload = _decode_token(token)
+    key = _cache_key(payload)
+    principal = _principals.get(key)
+    if principal is None:
+        principal = _remember(key, db.execute(_user_query(payload)).scalar_one_or_none())
+    return principal
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+    return _principal_from_token(token, db)
+
+def get_current_user_or_cookie(request: Request, token: Optional[str] = Depends(optional_oauth2_scheme), db: Session = Depends(database.get_db)):
+    return _principal_from_token(token or request.cookies.get(ACCESS_TOKEN_COOKIE), db)
+
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_async_db)):
+    payload = _decode_token(token)
+    key = _cache_key(payload)
+    principal = _principals.get(key)
+    if principal is None:
+        principal = _remember(key, (await db.execute(_user_query(payload))).scalar_one_or_none())
+    return principal
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _mark_stale(mapper, connection, target):
+    keys = [("id", target.id), ("name", target.username)]
+    keys += [("name", name) for name in inspect(target).attrs.username.history.deleted]
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(_STALE, []).extend(keys)
+    for key in keys:
+        _principals.delete(key)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate(session: Session):
+    # flush 时先删一次；提交后再删一次，防止并发请求在提交前读到旧数据又写回缓存
+    for key in session.info.pop(_STALE, []):
+        _principals.delete(key)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard(session: Session, previous_transaction):
+    session.info.pop(_STALE, None)
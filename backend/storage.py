@@ -0,0 +1,275 @@
+import os
+import time
+import shutil
+import hashlib
+import mimetypes
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+import models, database, utils
+from renderer import DiskLRU
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+S3_BUCKET = os.getenv("S3_BUCKET", "sims")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_REGION = os.getenv("S3_REGION") or None
+S3_URL_TTL = int(os.getenv("S3_URL_TTL", "3600"))
+BLOB_CACHE_DIR = os.path.join(utils.DATA_DIR, "blob_cache")
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+STAGING_MAX_AGE = float(os.getenv("STAGING_MAX_AGE", "3600"))
+
+
+class LocalBlobStore:
+    """本地磁盘存储，对象键即相对于工作目录的路径。"""
+
+    def local_path(self, key: str) -> str:
+        if not os.path.isfile(key):
+            raise FileNotFoundError(key)
+        return key
+
+    def url(self, key: str) -> Optional[str]:
+        return None
+
+    def put(self, src: str, key: str):
+        os.makedirs(os.path.dirname(key), exist_ok=True)
+        os.replace(src, key)
+
+    def delete_dir(self, prefix: str):
+        try:
+            shutil.rmtree(prefix)
+        except FileNotFoundError:
+            pass
+
+
+class S3BlobStore:
+    """S3 兼容对象存储（AWS S3 / MinIO），多个后端副本共享；本地只保留一份按 LRU 淘汰的读缓存。"""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None, region: Optional[str] = None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 需要安装 boto3")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self._client_error = ClientError
+        self.cache = DiskLRU(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES)
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    @staticmethod
+    def _cache_name(key: str) -> str:
+        return hashlib.sha1(key.encode("utf-8")).hexdigest() + os.path.splitext(key)[1]
+
+    def local_path(self, key: str) -> str:
+        name = self._cache_name(key)
+        path = self.cache.get(name)
+        if path:
+            return path
+        path = self.cache.path_for(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+        try:
+            self.client.download_file(self.bucket, self._object_key(key), tmp_path)
+        except self._client_error as e:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                raise FileNotFoundError(key)
+            raise
+        os.replace(tmp_path, path)
+        self.cache.add(name, os.path.getsize(path))
+        return path
+
+    def url(self, key: str) -> Optional[str]:
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self._object_key(key)}, ExpiresIn=S3_URL_TTL
+        )
+
+    def put(self, src: str, key: str):
+        content_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        self.client.upload_file(src, self.bucket, self._object_key(key), ExtraArgs={"ContentType": content_type})
+        # 刚上传的文件紧接着要打标签、生成预览，直接转入本地缓存
+        name = self._cache_name(key)
+        path = self.cache.path_for(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src, path)
+        self.cache.add(name, os.path.getsize(path))
+
+    def delete_dir(self, prefix: str):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._object_key(prefix) + "/"):
+            objects = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+            if objects:
+                result = self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True})
+                if result.get("Errors"):
+                    raise OSError(f"删除对象失败: {result['Errors'][0]}")
+
+
+def _create_store():
+    if STORAGE_BACKEND == "s3":
+        return S3BlobStore(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION)
+    return LocalBlobStore()
+
+
+store = _create_store()
+
+
+def local_path(key: str) -> str:
+    # 旧版平铺目录下的文件只存在于本地磁盘
+    if not utils.is_blob_path(key):
+        return LocalBlobStore().local_path(key)
+    return store.local_path(key)
+
+
+def url(key: str) -> Optional[str]:
+    return store.url(key) if utils.is_blob_path(key) else None
+
+
+def discard(info: dict):
+    utils.discard_staged(info)
+
+
+def commit(info: dict):
+    # 暂存目录中的原图、缩略图与派生图整体转入 blob 目录；内容相同则覆盖为同样的字节
+    staging_dir = info["staging_dir"]
+    target_dir = utils.blob_dir(info["content_hash"])
+    for name in sorted(os.listdir(staging_dir)):
+        store.put(os.path.join(staging_dir, name), f"{target_dir}/{name}")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def acquire(db: Session, content_hash: str, path: str, file_size: int, n: int = 1):
+    blobs = models.Blob.__table__
+    database.insert_ignore(db, blobs, [{"content_hash": content_hash, "path": path, "file_size": file_size, "ref_count": 0}], ["content_hash"])
+    db.execute(update(blobs).where(blobs.c.content_hash == content_hash).values(ref_count=blobs.c.ref_count + n))
+
+
+def acquire_many(db: Session, infos: List[dict]):
+    counts = {}
+    for info in infos:
+        counts.setdefault(info["content_hash"], [info, 0])[1] += 1
+    for content_hash, (info, n) in sorted(counts.items()):
+        acquire(db, content_hash, info["file_path"], info["file_size"], n)
+
+
+@dataclass
+class Orphans:
+    blobs: List[str] = field(default_factory=list)
+    files: List[str] = field(default_factory=list)
+
+
+def release(db: Session, image: models.Image) -> Orphans:
+    orphans = Orphans()
+    if utils.is_blob_path(image.file_path) and image.content_hash:
+        blobs = models.Blob.__table__
+        db.execute(update(blobs).where(blobs.c.content_hash == image.content_hash).values(ref_count=blobs.c.ref_count - 1))
+        remaining = db.execute(select(blobs.c.ref_count).where(blobs.c.content_hash == image.content_hash)).scalar_one_or_none()
+        if remaining is not None and remaining <= 0:
+            orphans.blobs.append(image.content_hash)
+        return orphans
+
+    shared = db.query(models.Image.id).filter(
+        models.Image.file_path == image.file_path, models.Image.id != image.id
+    ).first()
+    if not shared:
+        orphans.files = [image.file_path, image.thumbnail_path] + [r.path for r in image.renditions]
+    return orphans
+
+
+def purge(db: Session, content_hash: str) -> bool:
+    # 加行锁后再确认引用数：并发上传同一内容时 acquire 会等待本事务结束，之后重新写入文件
+    blob = db.execute(
+        select(models.Blob).where(models.Blob.content_hash == content_hash).with_for_update()
+    ).scalar_one_or_none()
+    if blob is None or blob.ref_count > 0:
+        db.rollback()
+        return False
+    store.delete_dir(utils.blob_dir(content_hash))
+    db.delete(blob)
+    db.commit()
+    return True
+
+
+def collect(orphans: Orphans):
+    if orphans.blobs:
+        with database.SessionLocal() as db:
+            for content_hash in orphans.blobs:
+                try:
+                    purge(db, content_hash)
+                except Exception as e:
+                    db.rollback()
+                    print(f"[Storage] 回收 blob {content_hash} 失败，下次启动时重试: {e}")
+    for path in orphans.files:
+        try:
+            if path and os.path.exists(path): os.remove(path)
+        except OSError as e:
+            print(f"[Storage] 删除文件失败 {path}: {e}")
+
+
+def abandon(infos: List[dict]):
+    # 文件已转入 blob 目录但事务失败、没留下引用：补一行 ref_count=0 的记录交给 purge 回收。
+    # purge 持行锁再确认引用数，并发上传同一内容并已提交引用时保留文件；回收失败则留给启动时的 sweep
+    if not infos:
+        return
+    blobs = models.Blob.__table__
+    unique = {info["content_hash"]: info for info in infos}
+    with database.SessionLocal() as db:
+        for content_hash, info in sorted(unique.items()):
+            try:
+                database.insert_ignore(db, blobs, [{"content_hash": content_hash, "path": info["file_path"],
+                                                    "file_size": info["file_size"], "ref_count": 0}], ["content_hash"])
+                purge(db, content_hash)
+            except Exception as e:
+                db.rollback()
+                print(f"[Storage] 回收 blob {content_hash} 失败，下次启动时重试: {e}")
+
+
+def _subdirs(path: str):
+    try:
+        return [entry for entry in os.scandir(path) if entry.is_dir() and not entry.name.startswith(".")]
+    except FileNotFoundError:
+        return []
+
+
+def _stray_blob_dirs(cutoff: float) -> List[str]:
+    # 本地 blob 目录存在却没有记录：提交数据库前进程退出、回收时数据库不可用等情况留下的
+    hashes = [
+        entry.name
+        for first in _subdirs(utils.BLOB_DIR)
+        for second in _subdirs(first.path)
+        for entry in _subdirs(second.path)
+        if entry.stat().st_mtime < cutoff
+    ]
+    known = set()
+    with database.SessionLocal() as db:
+        for i in range(0, len(hashes), 1000):
+            known.update(db.execute(
+                select(models.Blob.content_hash).where(models.Blob.content_hash.in_(hashes[i:i + 1000]))
+            ).scalars())
+    return [h for h in hashes if h not in known]
+
+
+def sweep():
+    # 启动时补做上次未完成的回收，并清理进程异常退出后残留的暂存目录
+    with database.SessionLocal() as db:
+        hashes = db.execute(select(models.Blob.content_hash).where(models.Blob.ref_count <= 0)).scalars().all()
+    if hashes:
+        print(f"[Storage] 发现 {len(hashes)} 个无引用的 blob，开始回收")
+        collect(Orphans(blobs=list(hashes)))
+
+    cutoff = time.time() - STAGING_MAX_AGE
+    if isinstance(store, LocalBlobStore):
+        stray = _stray_blob_dirs(cutoff)
+        if stray:
+            print(f"[Storage] 发现 {len(stray)} 个没有记录的 blob 目录，开始回收")
+            abandon([{"content_hash": h, "file_path": utils.blob_dir(h), "file_size": 0} for h in stray])
+
+    for entry in os.scandir(utils.STAGING_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
@@ -0,0 +1,78 @@
+import os
+from typing import Dict, Iterable, List
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+import models, database
+from utils import LRUCache
+
+TAG_CACHE_SIZE = int(os.getenv("TAG_CACHE_SIZE", "50000"))
+TAG_CACHE_TTL = float(os.getenv("TAG_CACHE_TTL", "86400"))
+TAG_NAME_MAX = models.Tag.name.type.length
+
+_cache = LRUCache(TAG_CACHE_SIZE, TAG_CACHE_TTL)
+_PENDING = "tag_service.pending"
+
+
+def normalize(names: Iterable[str]) -> List[str]:
+    cleaned = ((name or "").strip().lower()[:TAG_NAME_MAX].strip() for name in names)
+    return list(dict.fromkeys(name for name in cleaned if name))
+
+
+def resolve(db: Session, names: Iterable[str]) -> Dict[str, int]:
+    names = normalize(names)
+    pending = db.info.get(_PENDING, {})
+    ids, missing = {}, []
+    for name in names:
+        tag_id = pending.get(name) or _cache.get(name)
+        if tag_id is None:
+            missing.append(name)
+        else:
+            ids[name] = tag_id
+    if not missing:
+        return ids
+
+    tags = models.Tag.__table__
+    found = dict(db.execute(select(tags.c.name, tags.c.id).where(tags.c.name.in_(missing))).all())
+    absent = [name for name in missing if name not in found]
+    if absent:
+        database.insert_ignore(db, tags, [{"name": name} for name in absent], ["name"])
+        # 加锁读，确保能看到并发事务刚提交的同名标签（InnoDB 可重复读快照看不到）
+        found.update(db.execute(
+            select(tags.c.name, tags.c.id).where(tags.c.name.in_(absent)).with_for_update(read=True)
+        ).all())
+
+    # 新插入的 id 只有在事务提交后才写入进程缓存，回滚时丢弃
+    db.info.setdefault(_PENDING, {}).update({name: found[name] for name in absent if name in found})
+    for name in missing:
+        if name in found:
+            ids[name] = found[name]
+            if name not in absent:
+                _cache.set(name, found[name])
+    return ids
+
+
+def attach(db: Session, image_tags: Dict[int, Iterable[str]]) -> Dict[int, List[int]]:
+    image_tags = {image_id: normalize(names) for image_id, names in image_tags.items()}
+    ids = resolve(db, [name for names in image_tags.values() for name in names])
+    linked = {image_id: [ids[name] for name in names if name in ids] for image_id, names in image_tags.items()}
+    rows = [{"image_id": image_id, "tag_id": tag_id} for image_id, tag_ids in linked.items() for tag_id in tag_ids]
+    if rows:
+        database.insert_ignore(db, models.image_tags, rows, ["image_id", "tag_id"])
+    return linked
+
+
+def add_tags(db: Session, image_id: int, names: Iterable[str]) -> List[int]:
+    return attach(db, {image_id: names})[image_id]
+
+
+@event.listens_for(Session, "after_commit")
+def _publish(session: Session):
+    for name, tag_id in session.info.pop(_PENDING, {}).items():
+        _cache.set(name, tag_id)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard(session: Session, previous_transaction):
+    session.info.pop(_PENDING, None)
@@ -0,0 +1,397 @@
+import os
+import time
+import random
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import and_, func, insert, or_
+from sqlalchemy.orm import Session
+
+import models, database, ai_client, ai_service, geocoding, image_events, tag_service, utils, storage, metrics
+import search_index, text_index, dedupe, visual_index  # noqa: F401  注册 image_events 监听器
+
+TAGGING_WORKERS = int(os.getenv("TAGGING_WORKERS", "16"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_BACKOFF_BASE = float(os.getenv("JOB_BACKOFF_BASE", "2"))
+JOB_BACKOFF_MAX = float(os.getenv("JOB_BACKOFF_MAX", "300"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+JOB_DEFER_MIN = float(os.getenv("JOB_DEFER_MIN", "5"))
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", "7"))
+JOB_PURGE_INTERVAL = float(os.getenv("JOB_PURGE_INTERVAL", "3600"))
+JOB_PURGE_BATCH = 5000
+
+_handlers: Dict[str, Callable[[Session, models.Job], None]] = {}
+_failure_handlers: Dict[str, Callable[[Session, models.Job], None]] = {}
+_pauses: Dict[str, Callable[[], bool]] = {}
+
+
+class Deferred(Exception):
+    """依赖暂时不可用（如模型熔断），任务推迟 delay 秒再执行，不计入失败次数。"""
+
+    def __init__(self, delay: float, reason: str = ""):
+        super().__init__(reason)
+        self.delay = delay
+
+
+def register_handler(kind: str):
+    def decorator(fn):
+        _handlers[kind] = fn
+        return fn
+    return decorator
+
+
+def register_failure_handler(kind: str):
+    def decorator(fn):
+        _failure_handlers[kind] = fn
+        return fn
+    return decorator
+
+
+def register_pause(kind: str):
+    """注册一个判断函数，返回 True 时 worker 暂不领取该类型的任务。"""
+    def decorator(fn):
+        _pauses[kind] = fn
+        return fn
+    return decorator
+
+
+def _paused_kinds() -> List[str]:
+    return [kind for kind, paused in _pauses.items() if paused()]
+
+
+def enqueue(db: Session, kind: str, image_id: Optional[int] = None, delay: float = 0) -> models.Job:
+    job = models.Job(
+        kind=kind,
+        image_id=image_id,
+        status="queued",
+        attempts=0,
+        run_at=datetime.now() + timedelta(seconds=delay),
+    )
+    db.add(job)
+    return job
+
+
+def enqueue_many(db: Session, kind: str, image_ids: List[int], delay: float = 0):
+    if not image_ids:
+        return
+    run_at = datetime.now() + timedelta(seconds=delay)
+    db.execute(insert(models.Job), [
+        {"kind": kind, "image_id": image_id, "status": "queued", "attempts": 0, "run_at": run_at}
+        for image_id in image_ids
+    ])
+
+
+def _claimable(now: datetime):
+    return or_(
+        and_(models.Job.status == "queued", models.Job.run_at <= now),
+        and_(models.Job.status == "running", models.Job.locked_until < now),
+    )
+
+
+def claim_next(db: Session, kinds: Optional[List[str]] = None, exclude: Optional[List[str]] = None) -> Optional[models.Job]:
+    now = datetime.now()
+    query = db.query(models.Job.id).filter(_claimable(now))
+    if kinds:
+        query = query.filter(models.Job.kind.in_(kinds))
+    if exclude:
+        query = query.filter(models.Job.kind.notin_(exclude))
+    candidate_ids = [row.id for row in query.order_by(models.Job.run_at, models.Job.id).limit(16)]
+    db.commit()
+
+    for job_id in candidate_ids:
+        claimed = (
+            db.query(models.Job)
+            .filter(models.Job.id == job_id, _claimable(now))
+            .update(
+                {
+                    models.Job.status: "running",
+                    models.Job.locked_until: now + timedelta(seconds=JOB_LEASE_SECONDS),
+                    models.Job.attempts: models.Job.attempts + 1,
+                },
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        if claimed:
+            return db.get(models.Job, job_id)
+    return None
+
+
+def _backoff(attempts: int) -> float:
+    delay = min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * (2 ** max(attempts - 1, 0)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def run_job(db: Session, job: models.Job):
+    handler = _handlers.get(job.kind)
+    kind = job.kind
+    started = time.perf_counter()
+    try:
+        if handler is None:
+            raise RuntimeError(f"未知任务类型: {job.kind}")
+        handler(db, job)
+        job.status = "done"
+        job.locked_until = None
+        job.last_error = None
+        db.commit()
+        metrics.JOB_SECONDS.labels(kind, "done").observe(time.perf_counter() - started)
+    except Deferred as e:
+        metrics.JOB_SECONDS.labels(kind, "deferred").observe(time.perf_counter() - started)
+        db.rollback()
+        job = db.get(models.Job, job.id)
+        if job is None:
+            return
+        # 领取时已计过一次尝试，推迟不算失败，退回去
+        job.status = "queued"
+        job.attempts = max(job.attempts - 1, 0)
+        job.locked_until = None
+        job.run_at = datetime.now() + timedelta(seconds=e.delay)
+        db.commit()
+        print(f"[Queue] 任务 {job.id} ({job.kind}) 推迟 {e.delay:.0f}s: {e}")
+    except Exception as e:
+        metrics.JOB_SECONDS.labels(kind, "error").observe(time.perf_counter() - started)
+        db.rollback()
+        job = db.get(models.Job, job.id)
+        if job is None:
+            return
+        job.last_error = str(e)[:2000]
+        job.locked_until = None
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            job.status = "failed"
+            failed = _failure_handlers.get(job.kind)
+            if failed:
+                failed(db, job)
+            print(f"[Queue] 任务 {job.id} ({job.kind}) 失败 {job.attempts} 次，放弃: {e}")
+        else:
+            job.status = "queued"
+            job.run_at = datetime.now() + timedelta(seconds=_backoff(job.attempts))
+            print(f"[Queue] 任务 {job.id} ({job.kind}) 第 {job.attempts} 次失败，稍后重试: {e}")
+        db.commit()
+
+
+@register_handler("tag")
+def handle_tag(db: Session, job: models.Job):
+    image = db.get(models.Image, job.image_id)
+    if not image:
+        return
+    image.tag_status = "processing"
+    db.commit()
+
+    print(f"[AI] 开始分析图片 ID: {image.id} ...")
+    try:
+        tags = ai_service.generate_image_tags(storage.local_path(image.file_path), image.content_hash, image.id)
+    except ai_client.CircuitOpenError as e:
+        image.tag_status = "pending"
+        db.commit()
+        raise Deferred(max(ai_service.client.breaker.retry_in(), JOB_DEFER_MIN), str(e))
+    if tags:
+        print(f"[AI] 识别成功，标签: {tags}")
+        tag_service.add_tags(db, image.id, tags)
+    else:
+        print("[AI] 未生成标签")
+    image.tag_status = "done"
+    db.commit()
+    image_events.changed(db, image)
+
+
+@register_pause("tag")
+def tag_paused():
+    # 熔断期间领取的打标签任务只会立即失败，干脆不领，留给其它类型的任务
+    return not ai_service.client.breaker.accepting()
+
+
+@register_failure_handler("tag")
+def handle_tag_failed(db: Session, job: models.Job):
+    image = db.get(models.Image, job.image_id)
+    if image:
+        image.tag_status = "failed"
+
+
+@register_handler("geocode")
+def handle_geocode(db: Session, job: models.Job):
+    image = db.get(models.Image, job.image_id)
+    if not image or image.location or image.latitude is None or image.longitude is None:
+        return
+    try:
+        name = geocoding.resolve(image.latitude, image.longitude)
+    except geocoding.Throttled as e:
+        raise Deferred(e.retry_in, str(e))
+    if name:
+        image.location = name
+        db.commit()
+        image_events.changed(db, image)
+
+
+@register_pause("geocode")
+def geocode_paused():
+    # 在线接口限速窗口内领到的任务大多只能改期，等窗口过去再领
+    return geocoding.online_wait() > 0
+
+
+@register_handler("analyze")
+def handle_analyze(db: Session, job: models.Job):
+    image = db.get(models.Image, job.image_id)
+    if not image or image.thumbnail_path:
+        return
+    info = utils.analyze_stored(storage.local_path(image.file_path), image.content_hash)
+    try:
+        storage.commit(info)
+    except Exception:
+        storage.discard(info)
+        raise
+
+    image.thumbnail_path = info["thumbnail_path"]
+    image.width, image.height = info["width"], info["height"]
+    if info["capture_date"]:
+        image.capture_date = info["capture_date"]
+    image.phash, image.visual = info["phash"], info["visual"]
+    image.renditions = [models.ImageDerivative(**r) for r in info["renditions"]]
+    if info["lat_lon"]:
+        image.latitude, image.longitude = info["lat_lon"]
+        found, image.location = geocoding.lookup_cached(*info["lat_lon"])
+        if not found:
+            enqueue(db, "geocode", image.id)
+    db.commit()
+    image_events.changed(db, image)
+    notify()
+
+
+@register_handler("phash")
+def handle_phash(db: Session, job: models.Job):
+    image = db.get(models.Image, job.image_id)
+    if not image or image.phash:
+        return
+    try:
+        source_path = storage.local_path(image.thumbnail_path or image.file_path)
+    except FileNotFoundError:
+        source_path = storage.local_path(image.file_path)
+    image.phash = utils.image_phash(source_path)
+    db.commit()
+    image_events.changed(db, image)
+
+
+@register_handler("visual")
+def handle_visual(db: Session, job: models.Job):
+    image = db.get(models.Image, job.image_id)
+    if not image or image.visual:
+        return
+    try:
+        source_path = storage.local_path(image.thumbnail_path or image.file_path)
+    except FileNotFoundError:
+        source_path = storage.local_path(image.file_path)
+    image.visual = utils.image_visual(source_path)
+    db.commit()
+    image_events.changed(db, image)
+
+
+def purge_finished(db: Session, days: float = JOB_RETENTION_DAYS) -> int:
+    # 已完成 / 已放弃的任务只留作排查，run_at 即最后一次调度时间；分批删除避免长时间锁表
+    cutoff = datetime.now() - timedelta(days=days)
+    total = 0
+    while True:
+        ids = [row.id for row in db.query(models.Job.id).filter(
+            models.Job.status.in_(["done", "failed"]), models.Job.run_at < cutoff
+        ).limit(JOB_PURGE_BATCH)]
+        if not ids:
+            break
+        db.query(models.Job).filter(models.Job.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        total += len(ids)
+    if total:
+        print(f"[Queue] 清理 {total} 条 {days:g} 天前结束的任务记录")
+    return total
+
+
+class WorkerPool:
+    def __init__(self, size: int = TAGGING_WORKERS, session_factory=None):
+        self.size = size
+        self.session_factory = session_factory or database.SessionLocal
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._next_purge = 0.0
+        self._purge_lock = threading.Lock()
+
+    def start(self):
+        if self._threads or self.size <= 0:
+            return
+        self._stop.clear()
+        for i in range(self.size):
+            thread = threading.Thread(target=self._run, name=f"tag-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"[Queue] 启动 {self.size} 个后台任务 worker")
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        self._wake.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self._threads = []
+
+    def notify(self):
+        self._wake.set()
+
+    def _purge_due(self) -> bool:
+        with self._purge_lock:
+            now = time.monotonic()
+            if JOB_RETENTION_DAYS <= 0 or now < self._next_purge:
+                return False
+            self._next_purge = now + JOB_PURGE_INTERVAL
+            return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            db = self.session_factory()
+            try:
+                job = claim_next(db, exclude=_paused_kinds())
+                if job is not None:
+                    run_job(db, job)
+                    continue
+                if self._purge_due():
+                    purge_finished(db)
+            except Exception as e:
+                db.rollback()
+                print(f"[Queue] worker 异常: {e}")
+            finally:
+                db.close()
+            self._wake.wait(JOB_POLL_INTERVAL)
+            self._wake.clear()
+
+
+pool = WorkerPool()
+
+
+@metrics.collector
+def queue_depth():
+    depth = GaugeMetricFamily("sims_queue_jobs", "任务队列中排队 / 执行中的任务数", labels=["kind", "status"])
+    lag = GaugeMetricFamily("sims_queue_oldest_ready_seconds", "已到执行时间但仍在排队的最早任务等待时长", labels=["kind"])
+    now = datetime.now()
+    with database.SessionLocal() as db:
+        rows = db.query(models.Job.kind, models.Job.status, func.count(), func.min(models.Job.run_at)).filter(
+            models.Job.status.in_(["queued", "running"])
+        ).group_by(models.Job.kind, models.Job.status).all()
+    for kind, status, count, oldest in rows:
+        depth.add_metric([kind, status], count)
+        if status == "queued" and oldest is not None:
+            lag.add_metric([kind], max(0.0, (now - oldest).total_seconds()))
+    return [depth, lag]
+
+
+def notify():
+    pool.notify()
+
+
+if __name__ == "__main__":
+    models.Base.metadata.create_all(bind=database.engine)
+    database.ensure_schema(database.engine, models.Base.metadata)
+    pool.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pool.stop()
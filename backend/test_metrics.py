@@ -0,0 +1,45 @@
+import ipaddress
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import metrics
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "")
+    monkeypatch.setattr(metrics, "METRICS_ALLOWED_NETWORKS", [ipaddress.ip_network("10.0.0.0/8")])
+    # 不进入 lifespan：只测访问控制，不启动任务 worker
+    return TestClient(main.app, client=("203.0.113.5", 1234))
+
+
+def test_metrics_rejects_unlisted_address(client):
+    response = client.get("/metrics")
+    assert response.status_code == 403
+
+
+def test_metrics_asks_for_token_when_configured(client, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "s3cret")
+
+    response = client.get("/metrics")
+    assert response.status_code == 401
+    assert response.headers["www-authenticate"] == "Bearer"
+
+    response = client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+    assert response.status_code == 401
+
+
+def test_metrics_accepts_token(client, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "s3cret")
+
+    response = client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+    assert b"sims_" in response.content
+
+
+def test_metrics_accepts_allowlisted_address(client, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ALLOWED_NETWORKS", [ipaddress.ip_network("203.0.113.0/24")])
+
+    assert client.get("/metrics").status_code == 200
@@ -0,0 +1,43 @@
+import os
+from io import BytesIO
+
+from PIL import Image
+
+import models
+import storage
+import utils
+
+
+def _save(color="red"):
+    buf = BytesIO()
+    Image.new("RGB", (32, 32), color).save(buf, "JPEG")
+    buf.seek(0)
+    info = utils.save_stream(buf, "a.jpg")
+    storage.commit(info)
+    return info
+
+
+def test_abandon_reclaims_blob_left_by_failed_transaction(workdir, db):
+    info = _save()
+    target = utils.blob_dir(info["content_hash"])
+    assert os.path.isfile(info["file_path"])
+    assert not os.path.exists(info["staging_dir"])
+
+    # 文件已转入 blob 目录，但写记录的事务回滚了
+    storage.abandon([info, info])
+
+    assert not os.path.exists(target)
+    assert db.get(models.Blob, info["content_hash"]) is None
+
+
+def test_abandon_keeps_blob_referenced_by_committed_upload(workdir, db):
+    info = _save()
+    storage.acquire(db, info["content_hash"], info["file_path"], info["file_size"])
+    db.commit()
+
+    # 并发上传了相同内容，另一个请求的事务失败
+    storage.abandon([_save()])
+
+    assert os.path.isfile(info["file_path"])
+    db.expire_all()
+    assert db.get(models.Blob, info["content_hash"]).ref_count == 1
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+import geocoding
+import models
+import task_queue
+
+
+def _image(db, **values):
+    user = models.User(username="queue_user", email="queue@example.com", password_hash="x")
+    db.add(user)
+    db.flush()
+    image = models.Image(filename="a.jpg", file_path="static/uploads/a.jpg", file_size=1, owner_id=user.id, **values)
+    db.add(image)
+    db.commit()
+    return image
+
+
+def test_throttled_geocode_is_rescheduled_without_counting_an_attempt(db, monkeypatch):
+    image = _image(db, latitude=30.27, longitude=120.15)
+    task_queue.enqueue(db, "geocode", image.id)
+    db.commit()
+
+    def throttled(lat, lon):
+        raise geocoding.Throttled(30)
+
+    monkeypatch.setattr(geocoding, "resolve", throttled)
+    job = task_queue.claim_next(db)
+    assert job.attempts == 1
+    started = datetime.now()
+    task_queue.run_job(db, job)
+
+    db.expire_all()
+    job = db.get(models.Job, job.id)
+    assert job.status == "queued"
+    assert job.attempts == 0
+    assert job.locked_until is None
+    assert started + timedelta(seconds=29) <= job.run_at <= datetime.now() + timedelta(seconds=31)
+    assert task_queue.claim_next(db) is None
+
+
+def test_geocode_runs_after_deferral(db, monkeypatch):
+    image = _image(db, latitude=30.27, longitude=120.15)
+    task_queue.enqueue(db, "geocode", image.id)
+    db.commit()
+
+    monkeypatch.setattr(geocoding, "resolve", lambda lat, lon: "浙江省 杭州市")
+    task_queue.run_job(db, task_queue.claim_next(db))
+
+    db.expire_all()
+    assert db.get(models.Image, image.id).location == "浙江省 杭州市"
+
+
+def test_purge_finished_removes_only_old_finished_jobs(db):
+    old = datetime.now() - timedelta(days=10)
+    recent = datetime.now() - timedelta(days=1)
+    for status, run_at in [("done", old), ("failed", old), ("done", recent), ("queued", old), ("running", old)]:
+        db.add(models.Job(kind="tag", status=status, attempts=0, run_at=run_at))
+    db.commit()
+
+    assert task_queue.purge_finished(db, days=7) == 2
+
+    left = sorted((job.status, job.run_at == old) for job in db.query(models.Job))
+    assert left == [("done", False), ("queued", True), ("running", True)]
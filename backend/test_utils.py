@@ -0,0 +1,69 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils
+
+
+def _cosine(a, b):
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def test_quantize_scales_each_vector_to_full_range():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(3, utils.VISUAL_DIM)).astype(np.float32)
+    vectors[1] *= 1000
+    vectors[2] *= 1e-3
+
+    quantized = utils.quantize(vectors)
+
+    assert quantized.dtype == np.int8
+    assert np.abs(quantized.astype(np.int16)).max(axis=1).tolist() == [127, 127, 127]
+    for original, restored in zip(vectors, quantized.astype(np.float32)):
+        assert _cosine(original, restored) > 0.999
+
+
+def test_quantize_keeps_concentrated_vectors_unclipped():
+    # 能量集中在少数维度（纯色图）的向量，按固定比例缩放时会被截断成同一个值
+    vector = np.zeros(utils.VISUAL_DIM, dtype=np.float32)
+    vector[:3] = [0.9, 0.4, 0.1]
+
+    restored = utils.quantize(vector).astype(np.float32)
+
+    assert restored[:3].tolist() == [127, 56, 14]
+    assert _cosine(vector, restored) > 0.999
+
+
+def test_quantize_zero_vector():
+    assert not utils.quantize(np.zeros((2, utils.VISUAL_DIM), dtype=np.float32)).any()
+
+
+def _jpeg(path, orientation=None):
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[utils._ORIENTATION] = orientation
+    Image.new("RGB", (400, 200), "blue").save(path, "JPEG", exif=exif)
+    return path
+
+
+@pytest.mark.parametrize("orientation", [None, 1])
+def test_prepare_ai_image_passes_upright_jpeg_through(tmp_path, orientation):
+    path = _jpeg(tmp_path / "a.jpg", orientation)
+
+    data, mime_type = utils.prepare_ai_image(str(path), max_edge=1024, fmt="jpeg")
+
+    assert mime_type == "image/jpeg"
+    assert data == path.read_bytes()
+
+
+def test_prepare_ai_image_rotates_jpeg_with_exif_orientation(tmp_path):
+    path = _jpeg(tmp_path / "a.jpg", 6)
+
+    data, mime_type = utils.prepare_ai_image(str(path), max_edge=1024, fmt="jpeg")
+
+    assert mime_type == "image/jpeg"
+    assert data != path.read_bytes()
+    with Image.open(BytesIO(data)) as img:
+        assert img.size == (200, 400)
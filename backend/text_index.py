@@ -0,0 +1,233 @@
+import os
+import re
+import heapq
+import bisect
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import models, image_events
+from utils import PerOwnerRegistry, Singleton
+
+# 独立部署的任务 worker 进程写入标签时不会通知本进程，靠 TTL 定期重建兜底；设为 0 表示永不过期
+TEXT_INDEX_TTL = float(os.getenv("TEXT_INDEX_TTL", "60"))
+TEXT_PREFIX_WEIGHT = 0.5
+FIELD_WEIGHTS = {"tag": 3.0, "category": 2.0, "location": 2.0, "filename": 1.0}
+SUGGEST_FIELDS = ("tag", "category", "location")
+
+_CJK = "㐀-鿿豈-﫿"
+_RUN_RE = re.compile(f"[{_CJK}]+|[^\\W_{_CJK}]+")
+_CJK_RE = re.compile(f"[{_CJK}]")
+
+
+def _runs(text: str):
+    for run in _RUN_RE.findall((text or "").lower()):
+        yield run, bool(_CJK_RE.match(run))
+
+
+@lru_cache(maxsize=65536)
+def index_tokens(text: str) -> frozenset:
+    # 中文按字 + 二元组切分（等价于 ngram 分词），其余按词
+    tokens = set()
+    for run, cjk in _runs(text):
+        if cjk:
+            tokens.update(run)
+            tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.add(run)
+    return frozenset(tokens)
+
+
+def query_units(text: str) -> List[Tuple[str, bool]]:
+    units = []
+    for run, cjk in _runs(text):
+        if not cjk:
+            units.append((run, True))
+        elif len(run) == 1:
+            units.append((run, False))
+        else:
+            units.extend((run[i:i + 2], False) for i in range(len(run) - 1))
+    return list(dict.fromkeys(units))
+
+
+def _fields(tag_names, category, location, filename) -> List[Tuple[str, str]]:
+    fields = [("tag", name) for name in tag_names]
+    fields += [("category", category), ("location", location), ("filename", filename)]
+    return [(field, value) for field, value in fields if value]
+
+
+def image_fields(image) -> List[Tuple[str, str]]:
+    return _fields([t.name for t in image.tags], image.category, image.location, image.filename)
+
+
+class OwnerTextIndex:
+    """单个 owner 的倒排索引：token -> {image_id: 权重}，另存一份有序词表用于前缀匹配和联想。"""
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[int, float]] = {}
+        self._vocab: List[str] = []
+        self._docs: Dict[int, Tuple[Dict[str, float], List[str]]] = {}
+        self._terms: Dict[str, int] = {}
+        self._term_names: Dict[str, str] = {}
+        self._term_list: List[str] = []
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, image_id: int, fields: List[Tuple[str, str]], bulk: bool = False):
+        if not bulk:
+            self.remove(image_id)
+        weights: Dict[str, float] = {}
+        for field, value in fields:
+            for token in index_tokens(value):
+                weights[token] = weights.get(token, 0.0) + FIELD_WEIGHTS[field]
+        terms = list(dict.fromkeys(value.strip() for field, value in fields if field in SUGGEST_FIELDS and value.strip()))
+
+        for token, weight in weights.items():
+            posting = self._postings.get(token)
+            if posting is None:
+                posting = self._postings[token] = {}
+                if not bulk:
+                    bisect.insort(self._vocab, token)
+            posting[image_id] = weight
+        for term in terms:
+            key = term.lower()
+            if key not in self._terms:
+                self._terms[key] = 0
+                if not bulk:
+                    bisect.insort(self._term_list, key)
+            self._terms[key] += 1
+            self._term_names.setdefault(key, term)
+        self._docs[image_id] = (weights, terms)
+
+    def finish_bulk(self):
+        self._vocab = sorted(self._postings)
+        self._term_list = sorted(self._terms)
+
+    def remove(self, image_id: int):
+        doc = self._docs.pop(image_id, None)
+        if doc is None:
+            return
+        weights, terms = doc
+        for token in weights:
+            posting = self._postings[token]
+            posting.pop(image_id, None)
+            if not posting:
+                del self._postings[token]
+                del self._vocab[bisect.bisect_left(self._vocab, token)]
+        for term in terms:
+            key = term.lower()
+            self._terms[key] -= 1
+            if self._terms[key] <= 0:
+                del self._terms[key]
+                self._term_names.pop(key, None)
+                del self._term_list[bisect.bisect_left(self._term_list, key)]
+
+    @staticmethod
+    def _prefix_range(sorted_list: List[str], prefix: str):
+        start = bisect.bisect_left(sorted_list, prefix)
+        end = bisect.bisect_left(sorted_list, prefix + "\U0010ffff")
+        return sorted_list[start:end]
+
+    def _match(self, unit: str, prefix: bool) -> Dict[int, float]:
+        exact = self._postings.get(unit, {})
+        if not prefix:
+            return exact
+        scores = dict(exact)
+        for token in self._prefix_range(self._vocab, unit):
+            if token == unit:
+                continue
+            for image_id, weight in self._postings[token].items():
+                weight *= TEXT_PREFIX_WEIGHT
+                if weight > scores.get(image_id, 0.0):
+                    scores[image_id] = weight
+        return scores
+
+    def search(self, query: str) -> List[Tuple[int, float]]:
+        units = query_units(query)
+        if not units:
+            return []
+        matches = sorted((self._match(unit, prefix) for unit, prefix in units), key=len)
+        scores = dict(matches[0])
+        for match in matches[1:]:
+            scores = {image_id: score + match[image_id] for image_id, score in scores.items() if image_id in match}
+            if not scores:
+                break
+        return sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+
+    def suggest(self, prefix: str, limit: int) -> List[str]:
+        keys = self._prefix_range(self._term_list, prefix.strip().lower())
+        top = heapq.nsmallest(limit, keys, key=lambda k: (-self._terms[k], k))
+        return [self._term_names[k] for k in top]
+
+
+class TextIndex:
+    def __init__(self, ttl: float = TEXT_INDEX_TTL):
+        self._indexes = PerOwnerRegistry(self._build, ttl)
+
+    def _build(self, db: Session, owner_id: int) -> OwnerTextIndex:
+        # 直接走 Core 查询，避免为 10 万级图片构造 ORM 对象
+        index = OwnerTextIndex()
+        tags: Dict[int, List[str]] = {}
+        for image_id, name in db.execute(
+            select(models.image_tags.c.image_id, models.Tag.name)
+            .join(models.Tag, models.Tag.id == models.image_tags.c.tag_id)
+            .join(models.Image, models.Image.id == models.image_tags.c.image_id)
+            .where(models.Image.owner_id == owner_id)
+        ):
+            tags.setdefault(image_id, []).append(name)
+        for image_id, filename, location, category in db.execute(
+            select(models.Image.id, models.Image.filename, models.Image.location, models.Image.category)
+            .where(models.Image.owner_id == owner_id)
+        ):
+            index.add(image_id, _fields(tags.get(image_id, ()), category, location, filename), bulk=True)
+        index.finish_bulk()
+        print(f"[TextIndex] 构建 owner {owner_id} 的倒排索引，共 {len(index)} 张")
+        return index
+
+    def index_image(self, db: Session, image):
+        with self._indexes.lock(image.owner_id):
+            index = self._indexes.peek(image.owner_id)
+            if index is not None:
+                index.add(image.id, image_fields(image))
+
+    def remove_image(self, owner_id: int, image_id: int):
+        with self._indexes.lock(owner_id):
+            index = self._indexes.peek(owner_id)
+            if index is not None:
+                index.remove(image_id)
+
+    def search(self, db: Session, owner_id: int, query: str) -> List[Tuple[int, float]]:
+        with self._indexes.lock(owner_id):
+            return self._indexes.get(db, owner_id).search(query)
+
+    def suggest(self, db: Session, owner_id: int, prefix: str, limit: int = 10) -> List[str]:
+        with self._indexes.lock(owner_id):
+            return self._indexes.get(db, owner_id).suggest(prefix, limit)
+
+
+_default = Singleton(TextIndex)
+
+
+def get_index() -> TextIndex:
+    return _default.get()
+
+
+@image_events.on_changed
+def index_image(db: Session, image):
+    get_index().index_image(db, image)
+
+
+@image_events.on_removed
+def remove_image(db: Session, owner_id: int, image_id: int):
+    get_index().remove_image(owner_id, image_id)
+
+
+def search(db: Session, owner_id: int, query: str) -> List[Tuple[int, float]]:
+    return get_index().search(db, owner_id, query)
+
+
+def suggest(db: Session, owner_id: int, prefix: str, limit: int = 10) -> List[str]:
+    return get_index().suggest(db, owner_id, prefix, limit)
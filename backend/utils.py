@@ -1,18 +1,205 @@
 import os
-import shutil
+import time
 import uuid
+import shutil
+import asyncio
+import hashlib
+import mimetypes
+import multiprocessing
+import tarfile
+import zipfile
+import threading
+from io import BytesIO
+from collections import OrderedDict
 from datetime import datetime
-from PIL import Image, ExifTags, ImageOps
+from typing import Optional
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ExifTags, ImageOps, features
 from fastapi import UploadFile
-from geopy.geocoders import Nominatim
+from starlette.concurrency import run_in_threadpool
+
+import metrics
 
+DATA_DIR = os.getenv("DATA_DIR", "data")
 UPLOAD_DIR = "static/uploads"
 THUMBNAIL_DIR = "static/thumbnails"
+RENDITION_DIR = "static/renditions"
+BLOB_DIR = "static/blobs"
+STAGING_DIR = os.getenv("STAGING_DIR", os.path.join(BLOB_DIR, ".staging"))
+
+AI_IMAGE_MAX_EDGE = int(os.getenv("AI_IMAGE_MAX_EDGE", "1024"))
+AI_IMAGE_QUALITY = int(os.getenv("AI_IMAGE_QUALITY", "85"))
+AI_IMAGE_FORMAT = os.getenv("AI_IMAGE_FORMAT", "jpeg").lower()
+_AI_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "400"))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+RENDITION_SIZES = sorted({int(s) for s in os.getenv("RENDITION_SIZES", "200,400,1200").split(",") if s.strip()}, reverse=True)
+RENDITION_FORMATS = [f.strip().lower() for f in os.getenv("RENDITION_FORMATS", "webp").split(",") if f.strip()]
+RENDITION_QUALITY = int(os.getenv("RENDITION_QUALITY", "80"))
+_RENDITION_ENCODERS = {"avif": ("AVIF", "avif"), "webp": ("WEBP", "webp"), "jpeg": ("JPEG", "jpg")}
+_FORMAT_EXTENSIONS = {"JPEG": "jpg", "MPO": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif", "BMP": "bmp", "TIFF": "tif"}
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "gif", "bmp", "tif", "tiff"}
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ARCHIVE_MAX_MEMBER_BYTES = int(os.getenv("ARCHIVE_MAX_MEMBER_BYTES", str(200 * 1024 * 1024)))
+VISUAL_GRID = 64
+VISUAL_DIM = 8 * 4 * 4 + 8 * 4 + 4 * 4 * 3
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+_EXIF_IFD = 0x8769
+_GPS_IFD = 0x8825
+_ORIENTATION = 0x0112
+_DATETIME = 0x0132
+_DATETIME_ORIGINAL = 0x9003
+_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+os.makedirs(RENDITION_DIR, exist_ok=True)
+os.makedirs(STAGING_DIR, exist_ok=True)
+
+class LRUCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class Singleton:
+    """进程内懒加载的单例，set() 用于整体替换（如切换 embedder）。"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._guard = threading.Lock()
+
+    def get(self):
+        with self._guard:
+            if self._value is None:
+                self._value = self.factory()
+            return self._value
+
+    def set(self, value):
+        with self._guard:
+            self._value = value
+
+class PerOwnerRegistry:
+    """按 owner 懒加载的内存索引，每个 owner 一把锁，get/peek/touch 需在 lock(owner_id) 内调用。
+
+    build(db, owner_id) 构建条目；条目超过 ttl 秒（0 表示不过期），或 version(db, owner_id)
+    与构建时读到的不一致（其他进程写库），下次 get() 时重建。
+    """
+
+    def __init__(self, build, ttl: float = 0, version=None):
+        self.build = build
+        self.ttl = ttl
+        self.version = version
+        self._entries = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def lock(self, owner_id: int) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(owner_id, threading.Lock())
+
+    def peek(self, owner_id: int):
+        entry = self._entries.get(owner_id)
+        return entry[0] if entry is not None else None
+
+    def get(self, db, owner_id: int):
+        # 版本号在构建前读取：构建期间的写入只会导致下次多重建一次，不会被漏掉
+        token = self.version(db, owner_id) if self.version else None
+        entry = self._entries.get(owner_id)
+        if entry is not None:
+            value, built_at, built_token = entry
+            if built_token == token and (not self.ttl or time.monotonic() - built_at < self.ttl):
+                return value
+        value = self.build(db, owner_id)
+        self._entries[owner_id] = (value, time.monotonic(), token)
+        return value
 
-geolocator = Nominatim(user_agent="zju_image_system_student_demo")
+    def touch(self, db, owner_id: int):
+        # 本进程已增量更新条目，记下新的版本号，避免自己的写入触发整表重建
+        entry = self._entries.get(owner_id)
+        if entry is not None and self.version:
+            self._entries[owner_id] = (entry[0], entry[1], self.version(db, owner_id))
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _to_rgb(img):
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+def prepare_ai_image(path, max_edge=AI_IMAGE_MAX_EDGE, quality=AI_IMAGE_QUALITY, fmt=AI_IMAGE_FORMAT):
+    pil_format, mime_type = _AI_FORMATS.get(fmt, _AI_FORMATS["jpeg"])
+    try:
+        with Image.open(path) as img:
+            # 原图直传只适用于无需旋转的图片；带 EXIF 方向的手机照片必须经 exif_transpose 转正
+            orientation, _, _ = read_exif(img)
+            if (img.format == pil_format and orientation == 1 and max(img.size) <= max_edge
+                    and os.path.getsize(path) <= max_edge * max_edge // 4):
+                with open(path, "rb") as f:
+                    return f.read(), mime_type
+            if img.format == "JPEG":
+                img.draft("RGB", (max_edge, max_edge))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((max_edge, max_edge))
+            img = _to_rgb(img)
+            buffer = BytesIO()
+            img.save(buffer, pil_format, quality=quality)
+            return buffer.getvalue(), mime_type
+    except OSError:
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        with open(path, "rb") as f:
+            return f.read(), mime_type
 
 def _convert_to_degrees(value):
     d = float(value[0])
@@ -24,8 +211,9 @@ def get_lat_lon(exif_data):
     if not exif_data: return None
 
     gps_info_tag = next((k for k, v in ExifTags.TAGS.items() if v == "GPSInfo"), None)
-    gps_info = exif_data.get(gps_info_tag)
-    
+    return gps_to_lat_lon(exif_data.get(gps_info_tag))
+
+def gps_to_lat_lon(gps_info):
     if not gps_info: return None
 
     lat = gps_info.get(2)
@@ -44,73 +232,378 @@ def get_lat_lon(exif_data):
             return None
     return None
 
-def get_location_name(lat, lon):
+def _parse_exif_date(value):
     try:
-        location = geolocator.reverse((lat, lon), language='zh-cn', timeout=10)
-        if location:
-            address = location.raw.get('address', {})
-            city = address.get('city') or address.get('town') or address.get('county')
-            state = address.get('state')
-            parts = [p for p in [state, city] if p]
-            return " ".join(dict.fromkeys(parts)) 
-    except:
-        pass
-    return None
-
-def get_exif_data(pil_image):
-    capture_date = None
-    location_str = None
+        return datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
 
+def read_exif(pil_image):
     try:
-        exif_raw = pil_image._getexif()
-        if exif_raw:
-            for tag, value in exif_raw.items():
-                if ExifTags.TAGS.get(tag) == "DateTimeOriginal":
-                    try:
-                        capture_date = datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
-                    except: pass
-            
-            lat_lon = get_lat_lon(exif_raw)
-            if lat_lon:
-                location_str = get_location_name(lat_lon[0], lat_lon[1])
-                
+        exif = pil_image.getexif()
     except Exception as e:
         print(f"EXIF error: {e}")
-    
-    return capture_date, location_str
+        return 1, None, None
+
+    orientation = exif.get(_ORIENTATION, 1)
+    exif_ifd = exif.get_ifd(_EXIF_IFD)
+    capture_date = _parse_exif_date(exif_ifd.get(_DATETIME_ORIGINAL)) or _parse_exif_date(exif.get(_DATETIME))
+    lat_lon = gps_to_lat_lon(exif.get_ifd(_GPS_IFD))
+    return orientation, capture_date, lat_lon
+
+def rendition_formats():
+    formats = [f for f in RENDITION_FORMATS if f in _RENDITION_ENCODERS and (f == "jpeg" or features.check(f))]
+    return formats or ["jpeg"]
+
+def _save_renditions(img, source_size, rendition_prefix):
+    renditions = []
+    formats = rendition_formats()
+    sizes = [s for s in RENDITION_SIZES if s < max(source_size)] or RENDITION_SIZES[-1:]
+    current = img
+    for size in sizes:
+        current = current.copy()
+        current.thumbnail((size, size))
+        for fmt in formats:
+            pil_format, ext = _RENDITION_ENCODERS[fmt]
+            path = f"{rendition_prefix}_{size}.{ext}"
+            current.save(path, pil_format, quality=RENDITION_QUALITY)
+            renditions.append({
+                "width": current.width,
+                "height": current.height,
+                "format": fmt,
+                "path": path,
+                "file_size": os.path.getsize(path),
+            })
+    return renditions
+
+def dhash(img, size=8):
+    gray = img.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR)
+    pixels = gray.tobytes()
+    bits = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{size * size // 4}x}"
+
+def _unit(vec, weight=1.0):
+    norm = np.linalg.norm(vec)
+    return vec * (weight / norm) if norm > 0 else vec
+
+def visual_features(img):
+    # 颜色 + 纹理 + 构图的紧凑描述子：HSV 联合直方图 128 维、2x2 分块梯度方向直方图 32 维、4x4 平均色 48 维
+    small = img.convert("RGB").resize((VISUAL_GRID, VISUAL_GRID), Image.Resampling.BILINEAR)
+
+    hsv = np.asarray(small.convert("HSV"), dtype=np.int32)
+    bins = (hsv[..., 0] * 8 >> 8) * 16 + (hsv[..., 1] * 4 >> 8) * 4 + (hsv[..., 2] * 4 >> 8)
+    color = np.sqrt(np.bincount(bins.ravel(), minlength=128).astype(np.float32))
+
+    gray = np.asarray(small.convert("L"), dtype=np.float32)
+    gx = np.zeros_like(gray)
+    gy = np.zeros_like(gray)
+    gx[:, 1:-1] = gray[:, 2:] - gray[:, :-2]
+    gy[1:-1, :] = gray[2:, :] - gray[:-2, :]
+    orientation = np.minimum((np.arctan2(gy, gx) % np.pi) * (8 / np.pi), 7).astype(np.int32)
+    half = VISUAL_GRID // 2
+    rows, cols = np.indices(gray.shape)
+    cells = (rows // half) * 2 + cols // half
+    texture = np.sqrt(np.bincount((cells * 8 + orientation).ravel(), weights=np.hypot(gx, gy).ravel(), minlength=32))
+
+    layout = np.asarray(small.resize((4, 4), Image.Resampling.BOX), dtype=np.float32).ravel() / 255
+
+    vec = np.concatenate([_unit(color), _unit(texture, 0.8), _unit(layout, 0.8)]).astype(np.float32)
+    return _unit(vec)
+
+def quantize(vec):
+    # 按向量自身的最大分量缩放到 int8 满量程：纯色图、文档页这类能量集中在少数维度的向量也不会被截断。
+    # 各向量缩放比例不同，比较时要按长度归一化
+    peak = np.abs(vec).max(axis=-1, keepdims=True)
+    peak[peak == 0] = 1.0
+    return np.rint(vec * (127 / peak)).astype(np.int8)
+
+def image_visual(path):
+    # 描述子按空间网格统计，必须和上传时 analyze_image 一样先按 EXIF 转正
+    with Image.open(path) as img:
+        orientation, _, _ = read_exif(img)
+        if img.format == "JPEG":
+            img.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        if orientation in _TRANSPOSE:
+            img = img.transpose(_TRANSPOSE[orientation])
+        return quantize(visual_features(_to_rgb(img))).tobytes()
 
-def process_image(file: UploadFile):
-    file_ext = file.filename.split(".")[-1]
-    unique_filename = f"{uuid.uuid4()}.{file_ext}"
-    
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
-    thumbnail_path = os.path.join(THUMBNAIL_DIR, unique_filename)
+def image_phash(path):
+    with Image.open(path) as img:
+        orientation, _, _ = read_exif(img)
+        if img.format == "JPEG":
+            img.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        if orientation in _TRANSPOSE:
+            img = img.transpose(_TRANSPOSE[orientation])
+        return dhash(_to_rgb(img))
 
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+def analyze_image(file_path, thumbnail_path, rendition_prefix=None, thumb_size=THUMBNAIL_SIZE):
+    # 可能运行在进程池里，各阶段耗时随结果带回主进程再记录
+    timings = {}
+    mark = time.perf_counter()
 
+    def lap(stage):
+        nonlocal mark
+        now = time.perf_counter()
+        timings[stage] = now - mark
+        mark = now
+
+    with Image.open(file_path) as img:
+        width, height = img.size
+        orientation, capture_date, lat_lon = read_exif(img)
+        lap("exif")
+
+        target = max([thumb_size] + (RENDITION_SIZES if rendition_prefix else []))
+        if img.format == "JPEG":
+            img.draft("RGB", (target, target))
+        img.thumbnail((target, target))
+        if orientation in _TRANSPOSE:
+            img = img.transpose(_TRANSPOSE[orientation])
+        if orientation in (5, 6, 7, 8):
+            width, height = height, width
+        img = _to_rgb(img)
+        lap("decode")
+
+        renditions = _save_renditions(img, (width, height), rendition_prefix) if rendition_prefix else []
+        lap("renditions")
+
+        img.thumbnail((thumb_size, thumb_size))
+        img.save(thumbnail_path, "JPEG", quality=85)
+        lap("thumbnail")
+        phash = dhash(img)
+        visual = quantize(visual_features(img)).tobytes()
+        lap("features")
+
+    return {
+        "timings": timings,
+        "width": width,
+        "height": height,
+        "capture_date": capture_date,
+        "lat_lon": lat_lon,
+        "renditions": renditions,
+        "phash": phash,
+        "visual": visual,
+    }
+
+def render_variant(src_path, dest_path, width, height, pil_format, quality):
+    with Image.open(src_path) as img:
+        orientation, _, _ = read_exif(img)
+        src_w, src_h = img.size
+        if orientation in (5, 6, 7, 8):
+            src_w, src_h = src_h, src_w
+        box_w = width or src_w
+        box_h = height or src_h
+        scale = min(box_w / src_w, box_h / src_h, 1.0)
+        target = (max(1, round(src_w * scale)), max(1, round(src_h * scale)))
+
+        if img.format == "JPEG":
+            draft_size = target if orientation not in (5, 6, 7, 8) else (target[1], target[0])
+            img.draft("RGB", draft_size)
+        if orientation in _TRANSPOSE:
+            img = img.transpose(_TRANSPOSE[orientation])
+        img = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0) if img.size != target else img
+        if pil_format == "JPEG":
+            img = _to_rgb(img)
+        elif img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+
+        tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+        img.save(tmp_path, pil_format, quality=quality)
+        os.replace(tmp_path, dest_path)
+    return os.path.getsize(dest_path)
+
+def is_not_modified(headers, etag, mtime):
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+def blob_dir(content_hash: str) -> str:
+    # 按内容哈希前缀两级分桶，原图与缩略图、多尺寸派生图放在同一目录
+    return f"{BLOB_DIR}/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+
+def is_blob_path(path: Optional[str]) -> bool:
+    return bool(path) and path.startswith(BLOB_DIR + "/")
+
+def sniff_extension(path: str) -> str:
     try:
-        with Image.open(file_path) as img:
-            img = ImageOps.exif_transpose(img)
-            width, height = img.size
-            
-            capture_time, location_name = get_exif_data(img)
-            
-            img.thumbnail((400, 400))
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            img.save(thumbnail_path, "JPEG")
-            
-            return {
-                "filename": file.filename,
-                "file_path": file_path,
-                "thumbnail_path": thumbnail_path,
-                "file_size": os.path.getsize(file_path),
-                "width": width,
-                "height": height,
-                "capture_date": capture_time or datetime.now(),
-                "location": location_name
-            }
-    except Exception as e:
-        if os.path.exists(file_path): os.remove(file_path)
-        raise e
+        with Image.open(path) as img:
+            fmt = img.format
+    except Exception:
+        raise ValueError("无法识别的图片文件")
+    if fmt not in _FORMAT_EXTENSIONS:
+        raise ValueError(f"不支持的图片格式: {fmt}")
+    return _FORMAT_EXTENSIONS[fmt]
+
+def save_stream(stream, filename: str):
+    started = time.perf_counter()
+    staging_dir = os.path.join(STAGING_DIR, uuid.uuid4().hex)
+    os.makedirs(staging_dir)
+    tmp_path = os.path.join(staging_dir, "upload.tmp")
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as buffer:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                buffer.write(chunk)
+                size += len(chunk)
+            buffer.flush()
+            os.fsync(buffer.fileno())
+        # 扩展名以文件内容为准，不信任客户端提交的文件名
+        ext = sniff_extension(tmp_path)
+        staged_path = os.path.join(staging_dir, f"original.{ext}")
+        os.replace(tmp_path, staged_path)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    content_hash = digest.hexdigest()
+    metrics.observe_stage("write", time.perf_counter() - started)
+    return {
+        "staging_dir": staging_dir,
+        "staged_path": staged_path,
+        "file_path": f"{blob_dir(content_hash)}/original.{ext}",
+        "file_size": size,
+        "content_hash": content_hash,
+    }
+
+def discard_staged(saved: dict):
+    shutil.rmtree(saved["staging_dir"], ignore_errors=True)
+
+def save_upload(file: UploadFile):
+    return save_stream(file.file, file.filename)
+
+def is_image_name(filename: str) -> bool:
+    return os.path.splitext(filename or "")[1].lower().lstrip(".") in IMAGE_EXTENSIONS
+
+def is_archive_name(filename: str) -> bool:
+    return (filename or "").lower().endswith(ARCHIVE_EXTENSIONS)
+
+def _archive_members(stream):
+    if zipfile.is_zipfile(stream):
+        stream.seek(0)
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, lambda info=info: archive.open(info)
+    else:
+        stream.seek(0)
+        with tarfile.open(fileobj=stream, mode="r:*") as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, member.size, lambda member=member: archive.extractfile(member)
+
+def save_archive_members(stream):
+    # 逐个解出图片成员并落盘；生成器可在线程池中逐步推进，解压与后续图片处理流水线并行
+    for name, size, open_member in _archive_members(stream):
+        base = os.path.basename(name)
+        if not is_image_name(base) or base.startswith(".") or "__MACOSX/" in name:
+            continue
+        if size > ARCHIVE_MAX_MEMBER_BYTES:
+            yield base, ValueError(f"文件过大 ({size} 字节)")
+            continue
+        try:
+            with open_member() as member:
+                yield base, save_stream(member, base)
+        except Exception as e:
+            yield base, e
+
+_process_pool = None
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None and IMAGE_PROCESS_WORKERS > 0:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=IMAGE_PROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _process_pool
+
+def warm_process_pool():
+    pool = get_process_pool()
+    if pool is not None:
+        for future in [pool.submit(os.getpid) for _ in range(IMAGE_PROCESS_WORKERS)]:
+            future.result()
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True)
+        _process_pool = None
+
+async def run_cpu(fn, *args):
+    pool = get_process_pool()
+    if pool is None:
+        return await run_in_threadpool(fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+def _analysis_args(staging_dir: str, source_path: str):
+    return source_path, os.path.join(staging_dir, "thumb.jpg"), os.path.join(staging_dir, "r")
+
+def _analysis_info(meta: dict, content_hash: str):
+    for stage, seconds in meta["timings"].items():
+        metrics.observe_stage(stage, seconds)
+    target_dir = blob_dir(content_hash)
+    return {
+        "thumbnail_path": f"{target_dir}/thumb.jpg",
+        "width": meta["width"],
+        "height": meta["height"],
+        "capture_date": meta["capture_date"],
+        "lat_lon": meta["lat_lon"],
+        "renditions": [dict(r, path=f"{target_dir}/{os.path.basename(r['path'])}") for r in meta["renditions"]],
+        "phash": meta["phash"],
+        "visual": meta["visual"],
+    }
+
+async def analyze_saved(saved: dict, filename: str):
+    staging_dir = saved["staging_dir"]
+    try:
+        meta = await run_cpu(analyze_image, *_analysis_args(staging_dir, saved["staged_path"]))
+    except Exception:
+        discard_staged(saved)
+        raise
+
+    info = _analysis_info(meta, saved["content_hash"])
+    return dict(
+        info,
+        filename=filename,
+        staging_dir=staging_dir,
+        file_path=saved["file_path"],
+        file_size=saved["file_size"],
+        content_hash=saved["content_hash"],
+        capture_date=info["capture_date"] or datetime.now(),
+    )
+
+def analyze_stored(source_path: str, content_hash: str):
+    # 后台任务补做上传时推迟的分析：缩略图与派生图写入新的暂存目录，由 storage.commit 转入 blob 目录
+    staging_dir = os.path.join(STAGING_DIR, uuid.uuid4().hex)
+    os.makedirs(staging_dir)
+    try:
+        pool = get_process_pool()
+        args = _analysis_args(staging_dir, source_path)
+        meta = pool.submit(analyze_image, *args).result() if pool is not None else analyze_image(*args)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    return dict(_analysis_info(meta, content_hash), staging_dir=staging_dir, content_hash=content_hash)
+
+async def process_image(file: UploadFile):
+    saved = await run_in_threadpool(save_upload, file)
+    return await analyze_saved(saved, file.filename)
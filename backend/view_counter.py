@@ -0,0 +1,89 @@
+import os
+import threading
+from collections import Counter
+from typing import Optional
+
+from sqlalchemy import bindparam, func, update
+
+import models, database
+
+VIEW_FLUSH_INTERVAL = float(os.getenv("VIEW_FLUSH_INTERVAL", "5"))
+VIEW_FLUSH_BATCH = int(os.getenv("VIEW_FLUSH_BATCH", "1000"))
+
+
+class ViewCounter:
+    """浏览量写回缓冲：请求只在内存中累加，后台线程按间隔批量 UPDATE view_count = view_count + n。"""
+
+    def __init__(self, interval: float = VIEW_FLUSH_INTERVAL, session_factory=None):
+        self.interval = max(interval, 0.1)
+        self.session_factory = session_factory or database.SessionLocal
+        self._pending: Counter = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, image_id: int, n: int = 1):
+        with self._lock:
+            self._pending[image_id] += n
+
+    def pending(self, image_id: int) -> int:
+        with self._lock:
+            return self._pending.get(image_id, 0)
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, Counter()
+            if not batch:
+                return 0
+            items = list(batch.items())
+            stmt = (
+                update(models.Image.__table__)
+                .where(models.Image.__table__.c.id == bindparam("image_id"))
+                .values(view_count=func.coalesce(models.Image.__table__.c.view_count, 0) + bindparam("n"))
+            )
+            db = self.session_factory()
+            try:
+                for i in range(0, len(items), VIEW_FLUSH_BATCH):
+                    chunk = items[i:i + VIEW_FLUSH_BATCH]
+                    db.execute(stmt, [{"image_id": image_id, "n": n} for image_id, n in chunk])
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                with self._lock:
+                    self._pending.update(batch)
+                print(f"[Views] 写回浏览量失败，稍后重试: {e}")
+                return 0
+            finally:
+                db.close()
+            return len(items)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="view-counter", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+
+counter = ViewCounter()
+
+
+def record(image_id: int):
+    counter.record(image_id)
+
+
+def pending(image_id: int) -> int:
+    return counter.pending(image_id)
@@ -0,0 +1,92 @@
+import os
+from typing import List, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import models, image_events
+from search_index import VectorIndex
+from utils import DATA_DIR, VISUAL_DIM, PerOwnerRegistry, Singleton
+
+VISUAL_INDEX_DIR = os.path.join(DATA_DIR, "visual_index")
+VISUAL_MODEL = f"visual-v1-{VISUAL_DIM}"
+
+
+def decode(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.int8)
+
+
+class VisualIndex:
+    """以图搜图：每个 owner 一张 int8 量化的视觉描述子表，向量来自入库时写入的 images.visual。"""
+
+    def __init__(self, root: str = VISUAL_INDEX_DIR):
+        self.root = root
+        self._indexes = PerOwnerRegistry(self._load)
+
+    def _load(self, db: Session, owner_id: int) -> VectorIndex:
+        index = VectorIndex(os.path.join(self.root, str(owner_id)), VISUAL_DIM, VISUAL_MODEL, dtype=np.int8)
+        total = db.execute(
+            select(func.count()).select_from(models.Image)
+            .where(models.Image.owner_id == owner_id, models.Image.visual.isnot(None))
+        ).scalar()
+        if not index.load() or index.count != total:
+            self._rebuild(db, owner_id, index)
+        return index
+
+    def _rebuild(self, db: Session, owner_id: int, index: VectorIndex, batch_size: int = 5000):
+        index.reset()
+        rows = db.execute(
+            select(models.Image.id, models.Image.visual)
+            .where(models.Image.owner_id == owner_id, models.Image.visual.isnot(None))
+            .order_by(models.Image.id)
+            .execution_options(yield_per=batch_size)
+        )
+        for batch in rows.partitions():
+            index.upsert_many([row.id for row in batch], np.stack([decode(row.visual) for row in batch]))
+        print(f"[Visual] 重建 owner {owner_id} 的视觉索引，共 {index.count} 张")
+
+    def index_image(self, db: Session, image):
+        if not image.visual:
+            return
+        with self._indexes.lock(image.owner_id):
+            self._indexes.get(db, image.owner_id).upsert_many([image.id], decode(image.visual)[None, :])
+
+    def remove_image(self, db: Session, owner_id: int, image_id: int):
+        with self._indexes.lock(owner_id):
+            self._indexes.get(db, owner_id).remove(image_id)
+
+    def similar(self, db: Session, owner_id: int, visual: bytes, top_k: int) -> List[Tuple[int, float]]:
+        query = decode(visual).astype(np.float32)
+        query /= max(float(np.linalg.norm(query)), 1.0)
+        with self._indexes.lock(owner_id):
+            return self._indexes.get(db, owner_id).search(query, top_k)
+
+
+_default = Singleton(VisualIndex)
+
+
+def get_index() -> VisualIndex:
+    return _default.get()
+
+
+@image_events.on_changed
+def index_image(db: Session, image):
+    try:
+        get_index().index_image(db, image)
+    except Exception as e:
+        print(f"[Visual] 更新视觉索引失败 (image {image.id}): {e}")
+
+
+@image_events.on_removed
+def remove_image(db: Session, owner_id: int, image_id: int):
+    try:
+        get_index().remove_image(db, owner_id, image_id)
+    except Exception as e:
+        print(f"[Visual] 删除视觉索引失败 (image {image_id}): {e}")
+
+
+def similar(db: Session, owner_id: int, image: models.Image, top_k: int) -> List[Tuple[int, float]]:
+    # 多取一个再排除自身；完全相同内容的其他图片得分接近 1，照常返回
+    hits = get_index().similar(db, owner_id, image.visual, top_k + 1)
+    return [(image_id, score) for image_id, score in hits if image_id != image.id][:top_k]